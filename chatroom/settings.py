@@ -14,6 +14,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 load_dotenv()
 import os
+import sys
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -48,8 +49,11 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'room.CustomUser'
 
 MIDDLEWARE = [
+    'room.middleware.MetricsMiddleware',   # 放最前面：處理時間涵蓋其他 middleware
+    'room.middleware.SlowQueryLogMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'room.profiling.ProfilingMiddleware',   # 同步區段：process_view 與 view 同一個 thread
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -86,6 +90,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # 背景 flusher（room.logsink）與請求會同時寫入；IMMEDIATE 讓寫入 transaction
+        # 一開始就取得寫鎖並等待 timeout，而不是中途升級失敗拋出 database is locked
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -128,6 +138,71 @@ MEDIA_ROOT = BASE_DIR / 'media'
 LOGIN_URL = '/login/'  # 與 room:login 匹配
 LOGIN_REDIRECT_URL = '/profile/'  # 登入後重定向到 profile
 
+# Redis（快取、AI 額度、跨行程佇列等共用）
+REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0')
+
+# 執行 manage.py test 時改用同步寫入，測試可直接斷言資料
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+
+# Django cache（判分快取、進行中考卷索引、AI 對話歷史、profiler 等）：多 worker 必須共用，
+# 否則題目修改 / 結束考試時的清除只發生在處理該請求的 worker；CACHE_BACKEND=memory 為單一行程的行程內快取
+if TESTING or os.getenv('CACHE_BACKEND', 'redis') == 'memory':
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+else:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': REDIS_URL}}
+
+# InteractionLog 寫入管道：sync（同步）/ buffered（行程內背景批次）/ redis（多 worker 共用佇列）
+INTERACTION_LOG_SINK = {
+    'BACKEND': 'sync' if TESTING else os.getenv('INTERACTION_LOG_BACKEND', 'buffered'),
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 1.0,
+}
+
+# AI 提問額度：redis（Lua 原子扣除，多 worker 共用）/ memory（行程內，測試用）
+AI_QUOTA = {
+    'BACKEND': 'memory' if TESTING else os.getenv('AI_QUOTA_BACKEND', 'redis'),
+    'TTL': 60 * 60 * 24 * 14,
+}
+
+# LLM 後端：gemini（google.genai）/ stub（本機模擬模型，離線壓測 / CI 用；
+# 可另設 LATENCY_MEAN、LATENCY_STDDEV、TOKENS_PER_SECOND、ERROR_RATE、RATE_LIMIT_RATE、SEED 等，見 gemini_api/backends.py）
+AI_BACKEND = {
+    'BACKEND': os.getenv('AI_BACKEND', 'gemini'),
+}
+
+# 相同 AI 請求合併：local（行程內）/ redis（跨 worker，短效鎖 + 結果 key）
+AI_SINGLEFLIGHT = {
+    'BACKEND': 'local' if TESTING else os.getenv('AI_SINGLEFLIGHT_BACKEND', 'redis'),
+    'LOCK_TTL': 30,
+    'RESULT_TTL': 10,
+}
+
+# /metrics 指標：redis（多 worker 合計）/ memory（行程內，測試用）；設定 METRICS_TOKEN 時需帶 Bearer token，
+# 未設定時只接受內部位址
+METRICS = {
+    'BACKEND': 'memory' if TESTING else os.getenv('METRICS_BACKEND', 'redis'),
+    'FLUSH_INTERVAL': 5.0,
+    'TOKEN': os.getenv('METRICS_TOKEN'),
+}
+
+# 取樣 profiler（/profiling/ 由教師控制）；預設停用，PROFILING_ENABLED=1 才掛上 middleware
+PROFILING = {
+    'ENABLED': os.getenv('PROFILING_ENABLED', '0') == '1',
+    'INTERVAL': 0.005,
+    'MAX_PROFILES': 20,
+}
+
+# 慢查詢記錄（room/slowlog.py，JSON lines，manage.py slow_queries 彙總）：單次超過 THRESHOLD_MS，
+# 或同一形狀、同一呼叫位置在一個請求內執行 REPEAT_THRESHOLD 次以上（N+1）
+SLOW_QUERY_LOG = {
+    'ENABLED': not TESTING and os.getenv('SLOW_QUERY_LOG_ENABLED', '1') == '1',
+    'THRESHOLD_MS': int(os.getenv('SLOW_QUERY_THRESHOLD_MS', '100')),
+    'REPEAT_THRESHOLD': 10,
+    'PATH': os.getenv('SLOW_QUERY_LOG_PATH', str(BASE_DIR / 'logs' / 'slow_queries.log')),
+    'MAX_BYTES': 10 * 1024 * 1024,
+    'BACKUP_COUNT': 5,
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,188 @@
+"""
+考題 AI 回覆快取（近似重複提問比對）。
+
+同一題目下，學生問的常是「同一個問題換個說法」。這裡以 (paper_id, question_id)
+分桶，桶內存放最近的 (提問簽章, 回覆)：
+
+- 正規化：NFKC、轉小寫、去標點、合併空白
+- 相似度：字元 3-gram shingle 的 MinHash 簽章（MINHASH_PERMUTATIONS 個雜湊），
+  估計 Jaccard 相似度 ≥ MATCH_THRESHOLD 視為同一問題，直接回傳快取的回覆
+- 過期 / 淘汰：每筆 TTL 秒後失效；每桶最多 BUCKET_ENTRIES 筆、最多 MAX_BUCKETS 桶，
+  兩層都以 LRU（OrderedDict）淘汰
+
+快取在行程內（命中只要幾毫秒，不經網路）；是否啟用由考卷的 ai_answer_cache 決定。
+hits / misses / stores / evictions 計數可由 stats() 取得。
+"""
+import hashlib
+import os
+import re
+import struct
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+ANSWER_CACHE_TTL = int(os.getenv("GEMINI_ANSWER_CACHE_TTL", "600"))
+MATCH_THRESHOLD = float(os.getenv("GEMINI_ANSWER_CACHE_THRESHOLD", "0.8"))
+MAX_BUCKETS = int(os.getenv("GEMINI_ANSWER_CACHE_BUCKETS", "512"))
+BUCKET_ENTRIES = int(os.getenv("GEMINI_ANSWER_CACHE_BUCKET_ENTRIES", "32"))
+MINHASH_PERMUTATIONS = 64
+SHINGLE_SIZE = 3
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# 固定種子的 (a, b) 參數：簽章在行程重啟後仍可比較（方便除錯與測試）
+_PERMUTATIONS = [
+    (
+        int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % (_MERSENNE_PRIME - 1) + 1,
+        int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME,
+    )
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+_PUNCTUATION = re.compile(r"[^\w\s]", re.UNICODE)
+
+
+def normalize(prompt: str) -> str:
+    text = unicodedata.normalize("NFKC", prompt).lower()
+    text = _PUNCTUATION.sub(" ", text)
+    return " ".join(text.split())
+
+
+def shingles(text: str) -> set:
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def _shingle_hash(shingle: str) -> int:
+    return struct.unpack("<I", hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest())[0]
+
+
+def signature(text: str) -> tuple:
+    """MinHash 簽章：每個排列取所有 shingle 雜湊值的最小值。"""
+    hashes = [_shingle_hash(s) for s in shingles(text)]
+    return tuple(
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+        for a, b in _PERMUTATIONS
+    )
+
+
+def similarity(sig_a: tuple, sig_b: tuple) -> float:
+    """兩個簽章相同位置相等的比例 ≈ 原 shingle 集合的 Jaccard 相似度。"""
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+class _Entry:
+    __slots__ = ("text", "signature", "answer", "expires_at")
+
+    def __init__(self, text, sig, answer, expires_at):
+        self.text = text
+        self.signature = sig
+        self.answer = answer
+        self.expires_at = expires_at
+
+
+class AnswerCache:
+    def __init__(self, ttl=None, threshold=None, max_buckets=None, bucket_entries=None):
+        self.ttl = ttl or ANSWER_CACHE_TTL
+        self.threshold = threshold or MATCH_THRESHOLD
+        self.max_buckets = max_buckets or MAX_BUCKETS
+        self.bucket_entries = bucket_entries or BUCKET_ENTRIES
+        self._buckets = OrderedDict()   # scope -> OrderedDict[normalized text -> _Entry]
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(("hits", "misses", "stores", "evictions", "expired"), 0)
+
+    def lookup(self, scope, prompt: str):
+        """回傳快取的回覆（完全相同或近似的提問），沒有則 None。"""
+        text = normalize(prompt)
+        if not text:
+            return None
+        sig = None
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(scope)
+            if bucket is not None:
+                self._buckets.move_to_end(scope)
+                self._drop_expired(bucket, now)
+                entry = bucket.get(text)
+                if entry is None and bucket:
+                    sig = signature(text)
+                    best = max(bucket.values(), key=lambda e: similarity(sig, e.signature))
+                    if similarity(sig, best.signature) >= self.threshold:
+                        entry = best
+                if entry is not None:
+                    bucket.move_to_end(entry.text)
+                    self._counters["hits"] += 1
+                    return entry.answer
+            self._counters["misses"] += 1
+        return None
+
+    def store(self, scope, prompt: str, answer: str):
+        text = normalize(prompt)
+        if not text or not answer:
+            return
+        entry = _Entry(text, signature(text), answer, time.monotonic() + self.ttl)
+        with self._lock:
+            bucket = self._buckets.get(scope)
+            if bucket is None:
+                bucket = self._buckets[scope] = OrderedDict()
+                while len(self._buckets) > self.max_buckets:
+                    _, evicted = self._buckets.popitem(last=False)
+                    self._counters["evictions"] += len(evicted)
+            self._buckets.move_to_end(scope)
+            bucket[text] = entry
+            bucket.move_to_end(text)
+            while len(bucket) > self.bucket_entries:
+                bucket.popitem(last=False)
+                self._counters["evictions"] += 1
+            self._counters["stores"] += 1
+
+    def _drop_expired(self, bucket, now):
+        for key in [key for key, entry in bucket.items() if entry.expires_at <= now]:
+            del bucket[key]
+            self._counters["expired"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            data = dict(self._counters)
+            data["buckets"] = len(self._buckets)
+            data["entries"] = sum(len(bucket) for bucket in self._buckets.values())
+        lookups = data["hits"] + data["misses"]
+        data["hit_ratio"] = data["hits"] / lookups if lookups else 0.0
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            for key in self._counters:
+                self._counters[key] = 0
+
+
+_cache = AnswerCache()
+
+
+def scope_for(paper_id, question_id):
+    """
+    快取分桶：同一張考卷的同一題。沒有題目時回傳 None（不查也不存）：
+    同一句「選項 B 是什麼意思？」在不同題目的答案不同，不能整張考卷共用分桶。
+    """
+    if not question_id:
+        return None
+    return (int(paper_id), int(question_id))
+
+
+def lookup(scope, prompt):
+    return _cache.lookup(scope, prompt)
+
+
+def store(scope, prompt, answer):
+    _cache.store(scope, prompt, answer)
+
+
+def stats():
+    return _cache.stats()
+
+
+def clear():
+    _cache.clear()
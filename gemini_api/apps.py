@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class GeminiApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'gemini_api'
+
+    def ready(self):
+        from . import metrics  # noqa: F401  註冊 /metrics collectors
@@ -0,0 +1,206 @@
+"""
+LLM 後端。GeminiAPIWrapper 只透過這裡的介面呼叫模型：
+
+- await generate(history, prompt) -> str
+- async for text in stream(history, prompt)
+- for text in stream_sync(history, prompt)（同步 stream_response 用）
+
+上游限流一律以 RateLimited 表示，排程器（scheduler）據此退避重試。
+每次上游呼叫以 observe_call 記錄延遲與結果（ok / rate_limited / error / cancelled），
+token 用量記入 ai_tokens_total（輸出於 /metrics）。
+後端由 settings.AI_BACKEND 選擇：
+
+- 'gemini'：google.genai（gemini_api.gemini.GeminiBackend）
+- 'stub'：本機模擬模型，不需網路與 API key；延遲分布、串流速率、錯誤率與 429 比例
+  皆可設定，供壓測與 CI 使用。回覆內容由提問決定（同一提問永遠得到同一回覆），
+  延遲與錯誤的抽樣可用 SEED 固定
+"""
+import asyncio
+import contextlib
+import hashlib
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from room import metrics
+
+DEFAULTS = {
+    'BACKEND': 'gemini',
+    # 以下為 stub 後端參數
+    'LATENCY_MEAN': 0.8,        # 秒；首段回覆前的延遲（對數常態分布）
+    'LATENCY_STDDEV': 0.3,
+    'TOKENS_PER_SECOND': 60,
+    'REPLY_TOKENS': 80,
+    'CHUNK_TOKENS': 8,          # 串流時每段的 token 數
+    'ERROR_RATE': 0.0,          # 回傳一般錯誤的比例
+    'RATE_LIMIT_RATE': 0.0,     # 回傳 429 的比例
+    'SEED': None,
+}
+
+BACKENDS = {
+    'gemini': 'gemini_api.gemini.GeminiBackend',
+    'stub': 'gemini_api.backends.StubBackend',
+}
+
+
+class RateLimited(Exception):
+    """上游限流（HTTP 429 / 503）。"""
+
+
+class BackendError(Exception):
+    """stub 後端注入的一般錯誤。"""
+
+
+AI_CALL_SECONDS = metrics.Histogram(
+    'ai_call_duration_seconds', "每次上游模型呼叫的時間（含串流傳完）", labels=('backend', 'mode', 'outcome'),
+)
+AI_TOKENS = metrics.Counter('ai_tokens_total', "模型 token 用量", labels=('backend', 'kind'))
+
+
+@contextlib.contextmanager
+def observe_call(backend, mode):
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except RateLimited:
+        outcome = 'rate_limited'
+        raise
+    except Exception:
+        outcome = 'error'
+        raise
+    except BaseException:   # CancelledError、串流中途關閉（GeneratorExit）
+        outcome = 'cancelled'
+        raise
+    finally:
+        AI_CALL_SECONDS.observe(time.perf_counter() - started, backend=backend.name, mode=mode, outcome=outcome)
+
+
+def count_tokens(backend, prompt_tokens, completion_tokens):
+    if prompt_tokens:
+        AI_TOKENS.inc(prompt_tokens, backend=backend.name, kind='prompt')
+    if completion_tokens:
+        AI_TOKENS.inc(completion_tokens, backend=backend.name, kind='completion')
+
+
+class StubBackend:
+    name = 'stub'
+
+    def __init__(self, options):
+        self.latency_mean = options['LATENCY_MEAN']
+        self.latency_stddev = options['LATENCY_STDDEV']
+        self.tokens_per_second = options['TOKENS_PER_SECOND']
+        self.reply_tokens = options['REPLY_TOKENS']
+        self.chunk_tokens = max(1, options['CHUNK_TOKENS'])
+        self.error_rate = options['ERROR_RATE']
+        self.rate_limit_rate = options['RATE_LIMIT_RATE']
+        self._random = random.Random(options['SEED'])
+        self._lock = threading.Lock()
+        # 對數常態分布參數：讓抽樣的平均 / 標準差等於設定值
+        if self.latency_mean > 0:
+            self._sigma = math.sqrt(math.log(1 + (self.latency_stddev / self.latency_mean) ** 2))
+            self._mu = math.log(self.latency_mean) - self._sigma ** 2 / 2
+        self.calls = 0
+
+    def _sample(self):
+        """抽樣一次呼叫的 (延遲, 擲骰結果)；注入的錯誤在延遲之後才發生（與真實上游相同）。"""
+        with self._lock:
+            self.calls += 1
+            latency = self._random.lognormvariate(self._mu, self._sigma) if self.latency_mean > 0 else 0
+            return latency, self._random.random()
+
+    def _raise_fault(self, roll):
+        if roll < self.rate_limit_rate:
+            raise RateLimited("stub: 429 Resource has been exhausted")
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise BackendError("stub: injected error")
+
+    def reply(self, prompt: str) -> list:
+        """提問決定的回覆，切成 token（含結尾空白，串接即為完整回覆）。"""
+        digest = hashlib.blake2b(prompt.encode("utf-8"), digest_size=4).hexdigest()
+        words = [f"模擬回覆[{digest}]"] + [f"t{int(digest, 16) % 97 + i}" for i in range(self.reply_tokens - 1)]
+        return [word + " " for word in words]
+
+    def _chunks(self, prompt):
+        tokens = self.reply(prompt)
+        return ["".join(tokens[i:i + self.chunk_tokens]) for i in range(0, len(tokens), self.chunk_tokens)]
+
+    def _chunk_delay(self):
+        return self.chunk_tokens / self.tokens_per_second if self.tokens_per_second else 0
+
+    def _count_tokens(self, prompt):
+        count_tokens(self, len(prompt.split()), self.reply_tokens)
+
+    async def generate(self, history, prompt) -> str:
+        with observe_call(self, 'generate'):
+            latency, roll = self._sample()
+            tokens = self.reply(prompt)
+            await asyncio.sleep(latency + (len(tokens) / self.tokens_per_second if self.tokens_per_second else 0))
+            self._raise_fault(roll)
+        self._count_tokens(prompt)
+        return "".join(tokens)
+
+    async def stream(self, history, prompt):
+        with observe_call(self, 'stream'):
+            latency, roll = self._sample()
+            await asyncio.sleep(latency)
+            self._raise_fault(roll)
+            for i, chunk in enumerate(self._chunks(prompt)):
+                if i:
+                    await asyncio.sleep(self._chunk_delay())
+                yield chunk
+        self._count_tokens(prompt)
+
+    def stream_sync(self, history, prompt):
+        with observe_call(self, 'stream'):
+            latency, roll = self._sample()
+            time.sleep(latency)
+            self._raise_fault(roll)
+            for i, chunk in enumerate(self._chunks(prompt)):
+                if i:
+                    time.sleep(self._chunk_delay())
+                yield chunk
+        self._count_tokens(prompt)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _build(options):
+    path = BACKENDS.get(options['BACKEND'], options['BACKEND'])
+    try:
+        backend = import_string(path)
+    except ImportError as e:
+        raise ImproperlyConfigured(f"未知的 AI_BACKEND 後端：{options['BACKEND']}") from e
+    return backend(options)
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _build({**DEFAULTS, **getattr(settings, 'AI_BACKEND', {})})
+    return _backend
+
+
+def configure(**options):
+    """以 options 建立的後端取代 settings.AI_BACKEND（壓測用；不帶參數即恢復依 settings 建立）。"""
+    global _backend
+    with _backend_lock:
+        _backend = _build({**DEFAULTS, **options}) if options else None
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting == 'AI_BACKEND':
+        _backend = None
@@ -1,37 +1,105 @@
 import json
+
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+
+from room import quota
+from room.logsink import alog_interaction
+from room.models import ExamPaper
+
+from . import answer_cache
 from .gemini import GeminiAPIWrapper
+from .metrics import WEBSOCKET_CONNECTIONS
+from .scheduler import Busy
 
 
 class GeminiChatConsumer(AsyncWebsocketConsumer):
+    """
+    ws/gemini/chat/：AI 回覆逐段串流。
+    送入 {"prompt": ..., "paper_id"?: int, "question_id"?: int}；回傳
+    start → chunk（data: 新的一段文字）... → done（remaining: 考場情境的剩餘次數）或 error。
+    額度在開始前扣除、失敗時回補，InteractionLog 於串流結束後以完整回覆寫入一次（與 ai_webhook 相同）。
+    """
+
     async def connect(self):
-        self.session_key = self.scope["session"].session_key
-        if not self.session_key:
-            await self.scope["session"].save()
-            self.session_key = self.scope["session"].session_key
+        session = self.scope["session"]
+        if not session.session_key:
+            await session.asave()
+        self.session_key = session.session_key
+        user = self.scope.get("user")
+        self.user_id = user.pk if user is not None and user.is_authenticated else None
 
         await self.accept()
-        await self.send(json.dumps({"type": "info", "message": "WebSocket connected."}))
+        WEBSOCKET_CONNECTIONS.inc(consumer="gemini_chat")
+        self.counted = True
+        await self._send("info", message="WebSocket connected.")
 
     async def disconnect(self, close_code):
-        pass  # 可釋放資源
+        if getattr(self, "counted", False):
+            WEBSOCKET_CONNECTIONS.dec(consumer="gemini_chat")
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        prompt = data.get("prompt")
+    async def _send(self, type_, **fields):
+        await self.send(json.dumps({"type": type_, **fields}, ensure_ascii=False))
 
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data or "")
+        except ValueError:
+            await self._send("error", message="Invalid JSON")
+            return
+
+        prompt = (data.get("prompt") or "").strip()
         if not prompt:
-            await self.send(json.dumps({"type": "error", "message": "缺少 prompt"}))
+            await self._send("error", message="缺少 prompt")
             return
 
-        wrapper = GeminiAPIWrapper(self.session_key)
+        # 考場情境：先扣 1 次（與 ai_webhook 相同的額度服務）
+        paper_id = data.get("paper_id")
+        subject = limit = remaining = cache_scope = None
+        if paper_id is not None:
+            try:
+                paper_id = int(paper_id)
+                limit, cache_enabled = await ExamPaper.objects.values_list(
+                    'ai_total_limit', 'ai_answer_cache'
+                ).aget(id=paper_id)
+            except (ExamPaper.DoesNotExist, ValueError, TypeError):
+                await self._send("error", message="考卷不存在")
+                return
+            if cache_enabled:
+                try:
+                    cache_scope = answer_cache.scope_for(paper_id, data.get("question_id"))
+                except (ValueError, TypeError):
+                    cache_scope = None   # 沒有有效的題目：不查也不存
 
-        await self.send(json.dumps({"type": "start"}))
+            subject = quota.subject_for(self.user_id, self.session_key)
+            try:
+                ok, remaining = await sync_to_async(quota.consume)(subject, paper_id, limit)
+            except quota.Unavailable:
+                await self._send("error", message="AI 額度服務暫時無法使用，請稍後再試")
+                return
+            if not ok:
+                await self._send("error", message="已達 AI 提問上限！", remaining=0)
+                return
 
-        async for chunk in wrapper.async_stream_response(prompt):
-            await self.send(json.dumps({
-                "type": "chunk",
-                "data": chunk
-            }))
+        wrapper = GeminiAPIWrapper(self.session_key, owner=quota.subject_for(self.user_id, self.session_key))
+        await self._send("start", remaining=remaining)
+
+        parts = []
+        try:
+            async for chunk in wrapper.async_stream_response(prompt, cache_scope=cache_scope):
+                parts.append(chunk)
+                await self._send("chunk", data=chunk)
+        except Exception as ai_err:
+            if subject is not None:
+                remaining = await sync_to_async(quota.try_refund)(subject, paper_id, limit)
+            message = str(ai_err) if isinstance(ai_err, Busy) else f"AI 服務錯誤：{ai_err}"
+            await self._send("error", message=message, remaining=remaining)
+            return
 
-        await self.send(json.dumps({"type": "done"}))
\ No newline at end of file
+        await alog_interaction(
+            user_id=self.user_id,
+            question=prompt,
+            response="".join(parts),
+            exam_paper_id=paper_id,
+        )
+        await self._send("done", remaining=remaining)
@@ -1,78 +1,260 @@
 # gemini_api/gemini.py (或你的 wrapper 檔案路徑)
+import asyncio
 import os
-from datetime import timedelta
+import threading
+import weakref
+
+import httpx
 from django.core.cache import cache
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 from dotenv import load_dotenv
+
+from . import answer_cache, loops, scheduler, singleflight
+from .backends import RateLimited, count_tokens, get_backend, observe_call
+from .history import ConversationHistory
 load_dotenv()
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-CLIENT = genai.Client(api_key=GOOGLE_API_KEY)
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")  # 選填：替代端點（壓測 stub server 等）
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "64"))
 
 MODEL_ID = "gemini-2.0-flash-001"   # 或你要用的模型
 REDIS_EXPIRE_SECONDS = 7200         # 2 小時
 
+# client.aio 走 httpx.AsyncClient 連線池，等待模型回應時不佔用任何 thread。
+# 連線不能跨 event loop 共用，所以每個 loop 一個 client：Daphne 每個行程只有一個 loop
+# （= 一個行程一個長駐連線池）；WSGI 下 async view 每個請求各自一個 loop，client 在該 loop 關閉前
+# 由 loops.close_with_loop 關閉。
+# 同時進行的請求數由 scheduler（全行程共用的公平排程器）控制。
+_client_options = {}
+_sync_client = None
+_loop_clients = weakref.WeakKeyDictionary()   # event loop -> genai.Client
+_client_lock = threading.Lock()
+
+
+def build_client(base_url=None, api_key=None) -> genai.Client:
+    http_options = types.HttpOptions(
+        base_url=base_url or GEMINI_BASE_URL,
+        async_client_args={
+            "limits": httpx.Limits(
+                max_connections=GEMINI_MAX_CONNECTIONS,
+                max_keepalive_connections=GEMINI_MAX_CONNECTIONS,
+            ),
+        },
+    )
+    return genai.Client(api_key=api_key or GOOGLE_API_KEY, http_options=http_options)
+
+
+def configure_client(**options):
+    """以 build_client(**options) 的參數重建之後取得的 client（壓測 / 測試指向 stub server 用）。"""
+    global _client_options, _sync_client
+    with _client_lock:
+        _client_options = options
+        _sync_client = None
+        _loop_clients.clear()
+
+
+def get_client() -> genai.Client:
+    """同步路徑用的共用 client；第一次使用時才建立（import 時不做認證相關初始化）。"""
+    global _sync_client
+    if _sync_client is None:
+        with _client_lock:
+            if _sync_client is None:
+                _sync_client = build_client(**_client_options)
+    return _sync_client
+
+
+async def _loop_client() -> genai.Client:
+    """目前 event loop 的 client。"""
+    loop = asyncio.get_running_loop()
+    client = _loop_clients.get(loop)
+    if client is None:
+        client = _loop_clients[loop] = build_client(**_client_options)
+        await loops.close_with_loop(client.aio.aclose)
+    return client
+
+
 def _cache_key(session_key: str) -> str:
     return f"genai_history:{session_key}"
 
-# 把純文字包成 Content（user / model）
-def _user_msg(text: str) -> dict:
-    # 新 SDK 支援 dict 形式的 Content（TypedDict）
-    return {
-        "role": "user",
-        "parts": [ {"text": text} ]
-    }
+def _chat_config(history: ConversationHistory):
+    # 較舊輪次的摘要以 system 指令帶入，不佔用對話輪次
+    instruction = history.system_instruction()
+    return types.GenerateContentConfig(system_instruction=instruction) if instruction else None
 
-def _model_msg(text: str) -> dict:
-    return {
-        "role": "model",
-        "parts": [ {"text": text} ]
-    }
 
-class GeminiAPIWrapper:
-    def __init__(self, session_key: str):
-        self.session_key = session_key
-        # 1) 從 Redis 讀取你自己維護的歷史（list[dict]）
-        self.history = cache.get(_cache_key(session_key)) or []
+# 上游回這些狀態碼時視為限流（交給 scheduler 退避重試）
+RATE_LIMIT_STATUS = {429, 503}
+
+
+def _raise_if_rate_limited(exc: errors.APIError):
+    if exc.code in RATE_LIMIT_STATUS:
+        raise RateLimited(str(exc)) from exc
+
+
+def _count_usage(backend, usage):
+    if usage is not None:
+        count_tokens(backend, usage.prompt_token_count, usage.candidates_token_count)
+
+
+class GeminiBackend:
+    """AI_BACKEND = 'gemini'：google.genai（client 依上方規則建立與共用）。"""
+
+    name = 'gemini'
 
-        # 2) 以現有歷史建立 chat（注意：這裡是**帶入**，不是去讀 chat.history）
-        #    history 可直接給 dict 形式（SDK 會轉型）
-        self.chat = CLIENT.chats.create(
+    def __init__(self, options):
+        self.options = options
+
+    @staticmethod
+    async def _achat(history: ConversationHistory):
+        # 以視窗內的歷史建立 chat（注意：這裡是**帶入**，不是去讀 chat.history；SDK 會複製一份）
+        return (await _loop_client()).aio.chats.create(
             model=MODEL_ID,
-            # 如需 system 指令或其它參數，可放到 config
-            # config=types.GenerateContentConfig(system_instruction="..."),
-            history=self.history
+            config=_chat_config(history),
+            history=history.contents(),
         )
 
-    async def async_get_response(self, prompt: str) -> str:
+    async def generate(self, history: ConversationHistory, prompt: str) -> str:
+        with observe_call(self, 'generate'):
+            try:
+                response = await (await self._achat(history)).send_message(prompt)
+            except errors.APIError as exc:
+                _raise_if_rate_limited(exc)
+                raise
+        _count_usage(self, response.usage_metadata)
+        return response.text or ""
+
+    async def stream(self, history: ConversationHistory, prompt: str):
+        # 串流的 token 用量在最後一段的 usage_metadata
+        usage = None
+        with observe_call(self, 'stream'):
+            try:
+                chat = await self._achat(history)
+                async for chunk in await chat.send_message_stream(prompt):
+                    usage = chunk.usage_metadata or usage
+                    if chunk.text:
+                        yield chunk.text
+            except errors.APIError as exc:
+                _raise_if_rate_limited(exc)
+                raise
+        _count_usage(self, usage)
+
+    def stream_sync(self, history: ConversationHistory, prompt: str):
+        chat = get_client().chats.create(model=MODEL_ID, config=_chat_config(history), history=history.contents())
+        usage = None
+        with observe_call(self, 'stream'):
+            try:
+                for chunk in chat.send_message_stream(prompt):
+                    usage = chunk.usage_metadata or usage
+                    if chunk.text:
+                        yield chunk.text
+            except errors.APIError as exc:
+                _raise_if_rate_limited(exc)
+                raise
+        _count_usage(self, usage)
+
+
+class GeminiAPIWrapper:
+    def __init__(self, session_key: str, owner: str = None):
+        self.session_key = session_key
+        # 排程器公平排隊的單位（學生）；未指定時以 session 計
+        self.owner = owner or session_key
+        # 歷史（ConversationHistory）在第一次呼叫時才從快取讀取：async 路徑用 cache.aget，不阻塞 event loop
+        self.history = None
+
+    async def _aload_history(self) -> ConversationHistory:
+        if self.history is None:
+            self.history = ConversationHistory.loads(await cache.aget(_cache_key(self.session_key)))
+        return self.history
+
+    def _load_history(self) -> ConversationHistory:
+        if self.history is None:
+            self.history = ConversationHistory.loads(cache.get(_cache_key(self.session_key)))
+        return self.history
+
+    async def _asave_turn(self, prompt: str, text: str):
+        # 新一輪加入視窗（舊輪次折疊進摘要），以精簡格式存回快取並續命 2 小時
+        self.history.append(prompt, text)
+        await cache.aset(_cache_key(self.session_key), self.history.dumps(), REDIS_EXPIRE_SECONDS)
+
+    async def async_get_response(self, prompt: str, cache_scope=None) -> str:
         """
         取完整結果（非串流）。你原本 ask_ai 就是 await 這個。
+        模型由 settings.AI_BACKEND 選擇（gemini 走 SDK 的原生 async 介面 client.aio，不經過 thread pool）。
+        cache_scope：answer_cache.scope_for(...)；有給時先查回覆快取，命中就不呼叫模型。
+        同時進行中的相同請求經 singleflight 合併成一次模型呼叫，各自仍寫入自己的歷史。
         """
-        # 新 SDK 的 chat 是同步方法；在 async context 用 thread 包
-        import asyncio
-        response = await asyncio.to_thread(self.chat.send_message, prompt)
-        text = response.text or ""
-
-        # 3) 由你**自己**把新輪對話寫回 self.history（user + model）
-        self.history.append(_user_msg(prompt))
-        self.history.append(_model_msg(text))
+        history = await self._aload_history()
+        if cache_scope is not None:
+            cached = answer_cache.lookup(cache_scope, prompt)
+            if cached is not None:
+                await self._asave_turn(prompt, cached)
+                return cached
 
-        # 4) 存回 Redis，續命 2 小時
-        cache.set(_cache_key(self.session_key), self.history, REDIS_EXPIRE_SECONDS)
+        text = await singleflight.do(self._flight_key(history, prompt, cache_scope),
+                                     lambda: self._agenerate(history, prompt))
+        await self._asave_turn(prompt, text)
+        if cache_scope is not None:
+            answer_cache.store(cache_scope, prompt, text)
         return text
 
+    @staticmethod
+    def _flight_key(history: ConversationHistory, prompt: str, cache_scope=None) -> str:
+        # 啟用回覆快取的題目本來就共用回覆：正規化後相同的提問即可合併；
+        # 否則要連同對話內容完全相同（例如考試一開始、歷史都是空的）才合併
+        if cache_scope is not None:
+            return singleflight.key_for(MODEL_ID, list(cache_scope), answer_cache.normalize(prompt))
+        return singleflight.key_for(MODEL_ID, history.summary, history.turns, prompt)
+
+    async def _agenerate(self, history: ConversationHistory, prompt: str) -> str:
+        # 經排程器取得名額（全域上限 + 依學生輪流），上游限流時退避重試
+        backend = get_backend()
+        return await scheduler.get_scheduler().call(self.owner, lambda: backend.generate(history, prompt))
+
+    async def async_stream_response(self, prompt: str, cache_scope=None):
+        """
+        async_get_response 的串流版（GeminiChatConsumer 使用）：模型每產生一段就 yield 一段，
+        串流結束後以累積的完整輸出寫入歷史與回覆快取。中途中斷（例如連線關閉）則不寫入。
+        """
+        history = await self._aload_history()
+        if cache_scope is not None:
+            cached = answer_cache.lookup(cache_scope, prompt)
+            if cached is not None:
+                await self._asave_turn(prompt, cached)
+                yield cached
+                return
+
+        backend = get_backend()
+        sched = scheduler.get_scheduler()
+        parts = []
+        async with sched.slot(self.owner):
+            for attempt in range(sched.retries + 1):
+                try:
+                    async for text in backend.stream(history, prompt):
+                        parts.append(text)
+                        yield text
+                    break
+                except RateLimited as exc:
+                    if parts:
+                        raise   # 已送出部分內容，不能重來
+                    await sched.retry_or_raise(exc, attempt)
+
+        text = "".join(parts)
+        await self._asave_turn(prompt, text)
+        if cache_scope is not None:
+            answer_cache.store(cache_scope, prompt, text)
+
     def stream_response(self, prompt: str):
         """
         如果你要同步串流（給 StreamingHttpResponse 用），也一樣自己維護歷史。
         """
-        for chunk in self.chat.send_message_stream(prompt):
-            if chunk.text:
-                yield chunk.text
-
-        # 串流結束後再一次性更新歷史與快取
-        # （這裡用最後整段輸出；如需逐塊累積可自行改）
-        final_text = getattr(self.chat, "last_text", None) or ""
-        self.history.append(_user_msg(prompt))
-        self.history.append(_model_msg(final_text))
-        cache.set(_cache_key(self.session_key), self.history, REDIS_EXPIRE_SECONDS)
\ No newline at end of file
+        history = self._load_history()
+        parts = []
+        for text in get_backend().stream_sync(history, prompt):
+            parts.append(text)
+            yield text
+
+        # 串流結束後再一次性更新歷史與快取（以累積的完整輸出為準）
+        self.history.append(prompt, "".join(parts))
+        cache.set(_cache_key(self.session_key), self.history.dumps(), REDIS_EXPIRE_SECONDS)
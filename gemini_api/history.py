@@ -0,0 +1,121 @@
+"""
+GeminiAPIWrapper 的對話歷史管理。
+
+- 滑動視窗：只保留最近幾輪，總長度不超過 HISTORY_WINDOW_BYTES（UTF-8 位元組）
+- 滾動摘要：被擠出視窗的舊輪次折疊成一行「問 → 答」摘要，摘要本身也有上限
+  （HISTORY_SUMMARY_BYTES，超過時丟掉最舊的摘要行）；摘要以 system_instruction 帶給模型
+- 精簡序列化：快取內存的是 zlib 壓縮的 JSON bytes，而不是 list[dict]
+
+因此每次呼叫送出的 payload 與快取大小都有上限，不隨考試時間增長。
+"""
+import json
+import os
+import zlib
+
+HISTORY_WINDOW_BYTES = int(os.getenv("GEMINI_HISTORY_WINDOW_BYTES", "8000"))
+HISTORY_SUMMARY_BYTES = int(os.getenv("GEMINI_HISTORY_SUMMARY_BYTES", "2000"))
+HISTORY_TURN_BYTES = 4000      # 單則訊息上限，避免一則超長訊息吃掉整個視窗
+SUMMARY_QUESTION_CHARS = 60
+SUMMARY_ANSWER_CHARS = 120
+
+_FORMAT_VERSION = 1
+_ROLES = {"user": "u", "model": "m"}
+_ROLE_NAMES = {v: k for k, v in _ROLES.items()}
+
+
+def _size(text: str) -> int:
+    return len(text.encode("utf-8"))
+
+
+def _truncate(text: str, limit_bytes: int) -> str:
+    encoded = text.encode("utf-8")
+    if len(encoded) <= limit_bytes:
+        return text
+    return encoded[:limit_bytes].decode("utf-8", errors="ignore") + "…"
+
+
+def _clip(text: str, chars: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= chars else text[:chars] + "…"
+
+
+def _text_of(content: dict) -> str:
+    return "".join(part.get("text") or "" for part in content.get("parts") or [])
+
+
+class ConversationHistory:
+    """最近的對話輪次（視窗內）+ 較舊輪次的滾動摘要。"""
+
+    def __init__(self, turns=None, summary="", window_bytes=None, summary_bytes=None):
+        self.turns = list(turns or [])     # [(role, text), ...]，role 為 'user' / 'model'
+        self.summary = summary
+        self.window_bytes = window_bytes or HISTORY_WINDOW_BYTES
+        self.summary_bytes = summary_bytes or HISTORY_SUMMARY_BYTES
+
+    def __len__(self):
+        return len(self.turns)
+
+    # ---- 更新 ----
+
+    def append(self, prompt: str, answer: str):
+        """加入一輪問答，超出視窗的舊輪次折疊進摘要。"""
+        self.turns.append(("user", _truncate(prompt, HISTORY_TURN_BYTES)))
+        self.turns.append(("model", _truncate(answer, HISTORY_TURN_BYTES)))
+        self._compact()
+
+    def _compact(self):
+        total = sum(_size(text) for _, text in self.turns)
+        folded = []
+        # 一次移出一輪（user + model），至少保留最後一輪
+        while total > self.window_bytes and len(self.turns) > 2:
+            pair, self.turns = self.turns[:2], self.turns[2:]
+            total -= sum(_size(text) for _, text in pair)
+            folded.append(pair)
+        if folded:
+            self._fold(folded)
+
+    def _fold(self, pairs):
+        lines = self.summary.splitlines() if self.summary else []
+        for pair in pairs:
+            texts = dict(pair)
+            lines.append(
+                f"問：{_clip(texts.get('user', ''), SUMMARY_QUESTION_CHARS)} → "
+                f"答：{_clip(texts.get('model', ''), SUMMARY_ANSWER_CHARS)}"
+            )
+        while lines and _size("\n".join(lines)) > self.summary_bytes:
+            lines.pop(0)
+        self.summary = "\n".join(lines)
+
+    # ---- 給模型 ----
+
+    def contents(self) -> list:
+        """chats.create(history=...) 使用的 Content dict 列表。"""
+        return [{"role": role, "parts": [{"text": text}]} for role, text in self.turns]
+
+    def system_instruction(self):
+        if not self.summary:
+            return None
+        return "以下是與此學生先前對話的摘要，回答時可參考：\n" + self.summary
+
+    # ---- 序列化 ----
+
+    def dumps(self) -> bytes:
+        payload = {
+            "v": _FORMAT_VERSION,
+            "s": self.summary,
+            "t": [[_ROLES[role], text] for role, text in self.turns],
+        }
+        return zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    @classmethod
+    def loads(cls, data, **options) -> "ConversationHistory":
+        """還原快取內容；None → 空歷史；舊格式 list[dict] 會轉換並套用視窗。"""
+        if not data:
+            return cls(**options)
+        if isinstance(data, list):
+            history = cls([(c.get("role", "user"), _text_of(c)) for c in data], **options)
+            history._compact()
+            return history
+        payload = json.loads(zlib.decompress(data).decode("utf-8"))
+        turns = [(_ROLE_NAMES[role], text) for role, text in payload.get("t", [])]
+        return cls(turns, payload.get("s", ""), **options)
@@ -0,0 +1,38 @@
+"""
+綁定 event loop 的連線（genai 的 httpx.AsyncClient、redis.asyncio）在 loop 關閉前釋放。
+
+WSGI 下 async view 每個請求由 asgiref 以 asyncio.run 開一個新的 loop。連線若等到 loop 關閉後
+才被回收，其 __del__ 會把 aclose() 排到「當下」正在跑的另一個 loop，去關閉屬於已關閉 loop 的
+socket，於是出現「Task exception was never retrieved ... RuntimeError: Event loop is closed」。
+
+asyncio 沒有 loop 關閉的 hook，但 asyncio.run 結束前會呼叫 loop.shutdown_asyncgens()，收掉
+仍停在 yield 的 async generator。這裡為每個 loop 掛一個這樣的 generator，在 loop 還能使用時
+依序執行登記的 aclose()。Daphne 的長駐 loop 則一直沿用連線，行程結束時才關閉。
+"""
+import asyncio
+import weakref
+
+_closers = weakref.WeakKeyDictionary()   # event loop -> (aclose 函式列表, async generator)
+
+
+async def _close_on_shutdown(callbacks):
+    try:
+        yield
+    finally:
+        for aclose in reversed(callbacks):
+            try:
+                await aclose()
+            except Exception:
+                pass   # 連線已斷或對方已關閉：loop 即將結束，不影響其他連線的關閉
+
+
+async def close_with_loop(aclose):
+    """登記 aclose()，在目前的 event loop 關閉前執行。"""
+    loop = asyncio.get_running_loop()
+    entry = _closers.get(loop)
+    if entry is None:
+        callbacks = []
+        closer = _close_on_shutdown(callbacks)
+        entry = _closers[loop] = (callbacks, closer)
+        await closer.asend(None)   # 執行到 yield：之後由 loop 追蹤，shutdown_asyncgens 時收掉
+    entry[0].append(aclose)
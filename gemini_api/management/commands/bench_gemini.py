@@ -0,0 +1,94 @@
+import asyncio
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gemini_api import backends, gemini, singleflight
+from gemini_api.stubserver import StubGeminiServer
+from room import metrics
+
+
+class Command(BaseCommand):
+    help = "以本機 stub server 壓測 GeminiAPIWrapper：同時送出大量提問，觀察 thread 數與延遲"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=500, help="同時送出的提問數")
+        parser.add_argument('--latency', type=float, default=0.5, help="stub 模型回應延遲（秒）")
+        parser.add_argument('--mode', choices=['async', 'thread'], default='async',
+                            help="async：client.aio（目前實作）；thread：舊作法 asyncio.to_thread(同步 chat)")
+        parser.add_argument('--backend', choices=['server', 'stub'], default='server',
+                            help="server：gemini 後端 + 本機 stub HTTP server；stub：AI_BACKEND='stub'（不經 HTTP）")
+
+    def handle(self, *args, **options):
+        if options['backend'] == 'stub' and options['mode'] == 'thread':
+            raise CommandError("--mode thread 只能搭配 --backend server")
+        # 每個提問內容不同，避免被 singleflight 合併；合併與指標都只在行程內進行。
+        # 對話歷史走 Django cache，沒有 Redis 時以 CACHE_BACKEND=memory 執行
+        singleflight.configure(BACKEND='local')
+        metrics.configure(BACKEND='memory')
+        try:
+            if options['backend'] == 'stub':
+                backends.configure(BACKEND='stub', LATENCY_MEAN=options['latency'],
+                                   LATENCY_STDDEV=options['latency'] / 3, SEED=0)
+                result = asyncio.run(self._run(options['concurrency'], options['mode']))
+            else:
+                backends.configure(BACKEND='gemini')
+                with StubGeminiServer(latency=options['latency']) as server:
+                    gemini.configure_client(base_url=server.base_url, api_key='stub')
+                    try:
+                        result = asyncio.run(self._run(options['concurrency'], options['mode']))
+                    finally:
+                        gemini.configure_client()
+        finally:
+            backends.configure()
+            singleflight.configure()
+            metrics.configure()
+
+        latencies = sorted(result['latencies'])
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+        self.stdout.write(
+            f"backend={options['backend']} mode={options['mode']} prompts={len(latencies)} errors={result['errors']} "
+            f"elapsed={result['elapsed']:.2f}s p50={statistics.median(latencies or [0]):.3f}s p95={p95:.3f}s"
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"threads: baseline={result['baseline']} peak={result['peak']} (+{result['peak'] - result['baseline']})"
+        ))
+
+    async def _run(self, concurrency, mode):
+        # 先熱身一次：建立連線池與快取用的 thread，之後的增量才是提問本身造成的
+        await self._ask(mode, 'warmup')
+        baseline = peak = threading.active_count()
+        done = asyncio.Event()
+
+        async def sample():
+            nonlocal peak
+            while not done.is_set():
+                peak = max(peak, threading.active_count())
+                await asyncio.sleep(0.01)
+
+        latencies, errors = [], 0
+
+        async def one(i):
+            nonlocal errors
+            started = time.perf_counter()
+            try:
+                await self._ask(mode, f'bench-{i}')
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+        sampler = asyncio.create_task(sample())
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await sampler
+        return {'latencies': latencies, 'errors': errors, 'elapsed': elapsed, 'baseline': baseline, 'peak': peak}
+
+    async def _ask(self, mode, session_key):
+        if mode == 'async':
+            return await gemini.GeminiAPIWrapper(session_key).async_get_response(f'hello {session_key}')
+        chat = gemini.get_client().chats.create(model=gemini.MODEL_ID, history=[])
+        return (await asyncio.to_thread(chat.send_message, f'hello {session_key}')).text
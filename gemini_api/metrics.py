@@ -0,0 +1,51 @@
+"""
+AI 相關模組的 /metrics 指標（由 room.metrics 輸出）。
+
+answer_cache、scheduler、singleflight 本身只維護行程內的 stats() / counters，
+這裡以 collector 在 flush 時讀取並轉成指標；模型呼叫延遲與 token 用量見 backends.py，
+WebSocket 連線數由 consumer 更新。
+"""
+from room import metrics
+
+from . import answer_cache, scheduler, singleflight
+
+ANSWER_CACHE_EVENTS = metrics.Counter(
+    'ai_answer_cache_events_total', "AI 回覆快取事件（hit / miss 可算命中率）", labels=('event',),
+)
+ANSWER_CACHE_ENTRIES = metrics.Gauge('ai_answer_cache_entries', "AI 回覆快取目前筆數")
+SINGLEFLIGHT_CALLS = metrics.Counter(
+    'ai_singleflight_calls_total', "相同請求合併：leader 實際呼叫模型、shared 共用結果", labels=('role',),
+)
+SCHEDULER_EVENTS = metrics.Counter(
+    'ai_scheduler_events_total', "排程器事件（admitted / rejected / retries / rate_limited）", labels=('event',),
+)
+SCHEDULER_WAIT_SECONDS = metrics.Counter('ai_scheduler_wait_seconds_total', "排隊等待名額的總時間")
+SCHEDULER_ACTIVE = metrics.Gauge('ai_scheduler_active', "進行中的模型呼叫數")
+SCHEDULER_QUEUED = metrics.Gauge('ai_scheduler_queued', "排隊中的模型呼叫數")
+WEBSOCKET_CONNECTIONS = metrics.Gauge('websocket_connections', "目前的 WebSocket 連線數", labels=('consumer',))
+
+
+@metrics.register_collector
+def _collect_answer_cache():
+    stats = answer_cache.stats()
+    for event in ('hits', 'misses', 'stores', 'evictions', 'expired'):
+        yield ANSWER_CACHE_EVENTS, {'event': event}, stats[event]
+    yield ANSWER_CACHE_ENTRIES, {}, stats['entries']
+
+
+@metrics.register_collector
+def _collect_singleflight():
+    backend = singleflight._backend   # 尚未使用過就不建立（redis 後端建立時需要連線設定）
+    if backend is not None:
+        for role in ('leaders', 'shared'):
+            yield SINGLEFLIGHT_CALLS, {'role': role}, backend.counters[role]
+
+
+@metrics.register_collector
+def _collect_scheduler():
+    stats = scheduler.stats()
+    for event in ('admitted', 'rejected', 'retries', 'rate_limited'):
+        yield SCHEDULER_EVENTS, {'event': event}, stats[event]
+    yield SCHEDULER_WAIT_SECONDS, {}, stats['wait_seconds_sum']
+    yield SCHEDULER_ACTIVE, {}, stats['active']
+    yield SCHEDULER_QUEUED, {}, stats['queued']
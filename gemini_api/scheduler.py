@@ -0,0 +1,201 @@
+"""
+上游 AI 呼叫的公平排程器。
+
+- 全域併發上限：整個行程同時進行的模型呼叫不超過 max_concurrency（跨 event loop：
+  WSGI 下每個 async 請求各自的 loop、Daphne 的單一 loop 共用同一個額度）
+- 依使用者公平排隊：每位使用者（owner）一條佇列，空出的名額依序輪流（round-robin）
+  分給各使用者的下一個請求，一個人狂按不會擠掉全班
+- 佇列上限：總排隊數或單一使用者排隊數超過上限時立即拒絕（Busy），不讓請求無限堆積
+- 上游限流（backends.RateLimited，即 429 / 503）時以指數退避 + full jitter 重試，重試期間保留名額（自然降速）
+
+stats() 提供 active / queued / 等待時間等指標。參數由環境變數設定，測試可用 configure()。
+"""
+import asyncio
+import contextlib
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from .backends import RateLimited
+
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", os.getenv("GEMINI_MAX_CONNECTIONS", "64")))
+MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "1000"))
+MAX_QUEUE_PER_OWNER = int(os.getenv("GEMINI_MAX_QUEUE_PER_OWNER", "3"))
+RETRIES = int(os.getenv("GEMINI_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))   # 秒
+BACKOFF_CAP = float(os.getenv("GEMINI_BACKOFF_CAP", "8"))       # 秒
+
+class Busy(Exception):
+    """排隊已滿或上游持續限流；retry_after 為建議的重試秒數。"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("loop", "future", "enqueued_at")
+
+    def __init__(self, loop, future, enqueued_at):
+        self.loop = loop
+        self.future = future
+        self.enqueued_at = enqueued_at
+
+
+class FairScheduler:
+    def __init__(self, max_concurrency=None, max_queue=None, max_queue_per_owner=None,
+                 retries=None, backoff_base=None, backoff_cap=None):
+        self.max_concurrency = max_concurrency or MAX_CONCURRENCY
+        self.max_queue = max_queue if max_queue is not None else MAX_QUEUE
+        self.max_queue_per_owner = max_queue_per_owner or MAX_QUEUE_PER_OWNER
+        self.retries = retries if retries is not None else RETRIES
+        self.backoff_base = backoff_base if backoff_base is not None else BACKOFF_BASE
+        self.backoff_cap = backoff_cap if backoff_cap is not None else BACKOFF_CAP
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._queues = OrderedDict()   # owner -> deque[_Waiter]；順序即輪流順序
+        self._counters = dict.fromkeys(("admitted", "rejected", "retries", "rate_limited"), 0)
+        self._wait_sum = 0.0
+        self._wait_max = 0.0
+
+    # ---- 名額 ----
+
+    async def acquire(self, owner):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._active < self.max_concurrency and not self._queued:
+                self._active += 1
+                self._counters["admitted"] += 1
+                return
+            queue = self._queues.get(owner)
+            if self._queued >= self.max_queue or (queue and len(queue) >= self.max_queue_per_owner):
+                self._counters["rejected"] += 1
+                raise Busy("AI 服務忙碌中，請稍後再試")
+            waiter = _Waiter(loop, loop.create_future(), time.monotonic())
+            if queue is None:
+                queue = self._queues[owner] = deque()
+            queue.append(waiter)
+            self._queued += 1
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                queue = self._queues.get(owner)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    self._queued -= 1
+                    if not queue:
+                        del self._queues[owner]
+                    granted = False
+                else:
+                    # 已被分配名額（_grant 已執行）：名額要交給下一位
+                    granted = waiter.future.done() and not waiter.future.cancelled()
+            if granted:
+                self.release()
+            raise
+
+        waited = time.monotonic() - waiter.enqueued_at
+        with self._lock:
+            self._counters["admitted"] += 1
+            self._wait_sum += waited
+            self._wait_max = max(self._wait_max, waited)
+
+    def release(self):
+        """歸還名額：輪到的使用者取出一個請求，該使用者移到隊尾。"""
+        with self._lock:
+            if not self._queues:
+                self._active -= 1
+                return
+            owner, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+        # 名額直接轉交（active 不變）；future 屬於等待者的 loop，要在該 loop 內完成
+        try:
+            waiter.loop.call_soon_threadsafe(self._grant, waiter)
+        except RuntimeError:   # 等待者的 loop 已關閉
+            self.release()
+
+    def _grant(self, waiter):
+        if waiter.future.cancelled():
+            self.release()
+        else:
+            waiter.future.set_result(None)
+
+    # ---- 呼叫 ----
+
+    @contextlib.asynccontextmanager
+    async def slot(self, owner):
+        await self.acquire(owner)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def backoff(self, attempt) -> float:
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    async def retry_or_raise(self, exc, attempt):
+        """上游限流（RateLimited）：退避後返回讓呼叫端重試，重試用盡則丟出 Busy。"""
+        self._count("rate_limited")
+        if attempt >= self.retries:
+            raise Busy("AI 服務暫時限流，請稍後再試", retry_after=int(self.backoff_cap)) from exc
+        self._count("retries")
+        await asyncio.sleep(self.backoff(attempt))
+
+    async def call(self, owner, fn):
+        """取得名額後 await fn()；上游限流時退避重試（期間保留名額），重試用盡則丟出 Busy。"""
+        async with self.slot(owner):
+            for attempt in range(self.retries + 1):
+                try:
+                    return await fn()
+                except RateLimited as exc:
+                    await self.retry_or_raise(exc, attempt)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            data = dict(self._counters)
+            data.update(
+                active=self._active,
+                queued=self._queued,
+                queued_owners=len(self._queues),
+                max_concurrency=self.max_concurrency,
+                wait_seconds_sum=self._wait_sum,
+                wait_seconds_max=self._wait_max,
+            )
+        return data
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> FairScheduler:
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = FairScheduler()
+    return _scheduler
+
+
+def configure(**options):
+    """以 FairScheduler(**options) 取代目前的排程器（測試 / 壓測用；不帶參數即恢復預設）。"""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = FairScheduler(**options) if options else None
+
+
+def stats() -> dict:
+    return get_scheduler().stats()
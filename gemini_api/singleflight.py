@@ -0,0 +1,217 @@
+"""
+相同 AI 請求的 single-flight 合併。
+
+全班同時按下 AI 按鈕時，大量一模一樣的請求（同樣的對話內容 + 同樣的提問，或啟用
+回覆快取的考卷上正規化後相同的提問）會同時送往模型。這裡讓同一時間的相同請求只
+送出一次，其他請求等待並共用結果：
+
+- 行程內：key -> concurrent.futures.Future。不綁定 event loop，WSGI 下每個 async
+  請求各自的 loop、Daphne 的單一 loop 都能共用同一個結果
+- 跨行程（'redis' 後端）：行程內的 leader 再以 SET NX 搶短效鎖（值為 leader 的 token）；
+  搶到的呼叫模型，把結果寫入以該 token 為名的短效結果 key 後釋放鎖。其他行程記下鎖的
+  token 並輪詢對應的結果 key，所以只有與該 leader 同時進行的請求共用結果；之後的請求
+  重新搶鎖、重新呼叫，不會變成 RESULT_TTL 秒的回覆快取。leader 失敗或逾時鎖會釋放 /
+  過期，等待者改由自己呼叫；Redis 無法連線時退回只在行程內合併
+
+只合併「模型呼叫」本身；每位學生的額度扣除、對話歷史與 InteractionLog 仍由各自的
+請求處理。後端由 settings.AI_SINGLEFLIGHT 選擇（'local' / 'redis'）。
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import threading
+import time
+import uuid
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import loops
+
+DEFAULTS = {
+    'BACKEND': 'redis',
+    'LOCK_TTL': 30,          # 秒；leader 鎖的上限（應大於一次模型呼叫的時間）
+    'RESULT_TTL': 10,        # 秒；結果 key 只需撐到當時的等待者讀取
+    'POLL_INTERVAL': 0.05,   # 秒
+    'KEY_PREFIX': 'ai_flight',
+}
+
+
+class LeaderAbandoned(Exception):
+    """leader 被取消，等待者需自行呼叫。"""
+
+
+def key_for(*parts) -> str:
+    """請求內容的雜湊（parts 需可 JSON 序列化）。"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LocalFlight:
+    def __init__(self, options):
+        self._calls = {}   # key -> concurrent.futures.Future
+        self._lock = threading.Lock()
+        self.counters = {'leaders': 0, 'shared': 0}
+
+    async def do(self, key, fn):
+        """await fn()；同一 key 進行中時直接等待同一結果。"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+                self.counters['leaders'] += 1
+            else:
+                self.counters['shared'] += 1
+
+        if not leader:
+            try:
+                # shield：等待者被取消時不連帶取消共用的 future
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except LeaderAbandoned:
+                return await fn()
+
+        try:
+            result = await self._lead(key, fn)
+        except asyncio.CancelledError:
+            future.set_exception(LeaderAbandoned())
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def _lead(self, key, fn):
+        return await fn()
+
+
+# 只刪除自己持有的鎖
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisFlight(LocalFlight):
+    def __init__(self, options):
+        super().__init__(options)
+        try:
+            import redis.asyncio  # noqa: F401
+        except ImportError as e:
+            raise ImproperlyConfigured("AI_SINGLEFLIGHT 使用 redis 後端需要安裝 redis 套件") from e
+        self.url = options.get('REDIS_URL') or settings.REDIS_URL
+        self.prefix = options['KEY_PREFIX']
+        self.lock_ttl_ms = int(options['LOCK_TTL'] * 1000)
+        self.result_ttl_ms = int(options['RESULT_TTL'] * 1000)
+        self.poll_interval = options['POLL_INTERVAL']
+        # redis.asyncio 的連線綁定 event loop，與 gemini._loop_client 相同以 loop 為單位，loop 關閉前關閉
+        self._clients = weakref.WeakKeyDictionary()
+
+    async def _client(self):
+        import redis.asyncio as aioredis
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = aioredis.Redis.from_url(self.url)
+            await loops.close_with_loop(client.aclose)
+        return client
+
+    async def _lead(self, key, fn):
+        from redis import RedisError
+
+        lock_key, result_key = f"{self.prefix}:lock:{key}", f"{self.prefix}:result:{key}"
+        token = uuid.uuid4().hex
+        try:
+            client = await self._client()
+            acquired, cached = await self._acquire(client, lock_key, result_key, token)
+        except RedisError:
+            return await fn()   # Redis 無法連線：只在行程內合併，不影響 AI 呼叫本身
+        if cached is not None:
+            self.counters['shared'] += 1
+            return json.loads(cached)
+        if not acquired:
+            return await fn()   # 其他行程的 leader 遲遲沒有結果：不再等待
+
+        try:
+            result = await fn()
+            with contextlib.suppress(RedisError):
+                await client.set(f"{result_key}:{token}", json.dumps(result, ensure_ascii=False),
+                                 px=self.result_ttl_ms)
+            return result
+        finally:
+            with contextlib.suppress(RedisError):
+                await client.eval(_RELEASE_LUA, 1, lock_key, token)
+
+    async def _acquire(self, client, lock_key, result_key, token):
+        """輪詢到搶到鎖 (True, None)、讀到持鎖 leader 的結果 (False, 結果) 或逾時 (False, None)。"""
+        deadline = time.monotonic() + self.lock_ttl_ms / 1000
+        leader = None
+        while True:
+            # leader 先寫入結果才釋放鎖：先查上次看到的 leader 有沒有結果，再搶鎖
+            if leader is not None:
+                cached = await client.get(f"{result_key}:{leader.decode()}")
+                if cached is not None:
+                    return False, cached
+            if await client.set(lock_key, token, nx=True, px=self.lock_ttl_ms):
+                return True, None
+            leader = await client.get(lock_key) or leader
+            if time.monotonic() >= deadline:
+                return False, None
+            await asyncio.sleep(self.poll_interval)
+
+
+BACKENDS = {
+    'local': LocalFlight,
+    'redis': RedisFlight,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _build(options):
+    try:
+        backend = BACKENDS[options['BACKEND']]
+    except KeyError:
+        raise ImproperlyConfigured(f"未知的 AI_SINGLEFLIGHT 後端：{options['BACKEND']}")
+    return backend(options)
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _build({**DEFAULTS, **getattr(settings, 'AI_SINGLEFLIGHT', {})})
+    return _backend
+
+
+def configure(**options):
+    """以 options 建立的後端取代 settings.AI_SINGLEFLIGHT（壓測用；不帶參數即恢復依 settings 建立）。"""
+    global _backend
+    with _backend_lock:
+        _backend = _build({**DEFAULTS, **options}) if options else None
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting == 'AI_SINGLEFLIGHT':
+        _backend = None
+
+
+async def do(key, fn):
+    return await get_backend().do(key, fn)
@@ -0,0 +1,138 @@
+"""
+Gemini API 的本機 stub server（壓測 / 整合測試用）。
+
+只實作 generateContent 與 streamGenerateContent（SSE），固定延遲後回覆
+一段假文字；rate_limited=N 時前 N 個請求回 429（測試退避重試）；pause_after=N 時串流送出
+N 段後暫停，直到呼叫 resume()（測試逐段送達的順序）。以 asyncio streams 撰寫，不需額外套件。在背景 thread 執行自己的
+event loop，啟動後以 base_url 交給 gemini.build_client(base_url=...)。
+"""
+import asyncio
+import json
+import threading
+
+
+def _candidate(text, finish=True):
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if finish:
+        candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate], "usageMetadata": {"promptTokenCount": 1, "candidatesTokenCount": 1}}
+
+
+_RATE_LIMITED = {"error": {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}}
+
+
+class StubGeminiServer:
+    def __init__(self, latency=0.5, reply="stub reply", chunks=3, rate_limited=0, pause_after=None,
+                 host="127.0.0.1", port=0):
+        self.latency = latency
+        self.reply = reply
+        self.chunks = max(1, chunks)
+        self.rate_limited = rate_limited
+        self.pause_after = pause_after
+        self.sent_chunks = 0
+        self._resume = threading.Event()
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="gemini-stub-server", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+
+    def resume(self):
+        """讓 pause_after 暫停中的串流送出其餘段落。"""
+        self._resume.set()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port, backlog=4096)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            pending = asyncio.all_tasks(self._loop)
+            for task in pending:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self._loop.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length:
+                    await reader.readexactly(length)
+                self.requests += 1
+                if self.requests <= self.rate_limited:
+                    body = json.dumps(_RATE_LIMITED).encode("utf-8")
+                    writer.write(
+                        b"HTTP/1.1 429 Too Many Requests\r\nContent-Type: application/json\r\n"
+                        b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+                    )
+                    await writer.drain()
+                    continue
+
+                path = request_line.split()[1].decode("latin-1")
+                if ":streamGenerateContent" in path:
+                    await self._stream(writer)
+                    break  # SSE 回應以關閉連線結束
+                await asyncio.sleep(self.latency)
+                body = json.dumps(_candidate(self.reply)).encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _stream(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+        step = max(1, -(-len(self.reply) // self.chunks))
+        pieces = [self.reply[i:i + step] for i in range(0, len(self.reply), step)]
+        for i, piece in enumerate(pieces):
+            if i == self.pause_after:
+                await asyncio.get_running_loop().run_in_executor(None, self._resume.wait, 10)
+            await asyncio.sleep(self.latency / len(pieces))
+            event = _candidate(piece, finish=(i == len(pieces) - 1))
+            writer.write(b"data: " + json.dumps(event).encode("utf-8") + b"\r\n\r\n")
+            await writer.drain()
+            self.sent_chunks += 1
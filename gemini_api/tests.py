@@ -1,3 +1,379 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+from unittest import mock
 
-# Create your tests here.
+from asgiref.testing import ApplicationCommunicator
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from room import quota
+from room.models import CustomUser, ExamPaper, ExamQuestion, InteractionLog
+
+from . import answer_cache, backends, gemini, scheduler, singleflight
+from .consumer import GeminiChatConsumer
+from .history import ConversationHistory
+from .stubserver import StubGeminiServer
+
+
+class AsyncGeminiClientTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = StubGeminiServer(latency=0.05, reply='stub answer').start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        gemini.configure_client(base_url=self.server.base_url, api_key='stub')
+        self.addCleanup(gemini.configure_client)
+
+    def test_concurrent_prompts_do_not_use_threads(self):
+        async def burst():
+            await gemini.GeminiAPIWrapper('warmup').async_get_response('hi')
+            baseline = threading.active_count()
+            answers = await asyncio.gather(
+                *(gemini.GeminiAPIWrapper(f's{i}').async_get_response('hi') for i in range(50))
+            )
+            return baseline, threading.active_count(), answers
+
+        baseline, after, answers = asyncio.run(burst())
+        self.assertEqual(set(answers), {'stub answer'})
+        self.assertEqual(after, baseline)
+
+    def test_history_round_trips_through_cache_across_event_loops(self):
+        # 每次 asyncio.run 都是新的 event loop（WSGI 下的 async view 即是如此）
+        asyncio.run(gemini.GeminiAPIWrapper('abc').async_get_response('first'))
+        wrapper = gemini.GeminiAPIWrapper('abc')
+        asyncio.run(wrapper.async_get_response('second'))
+        self.assertEqual([role for role, _ in wrapper.history.turns], ['user', 'model', 'user', 'model'])
+        self.assertEqual(ConversationHistory.loads(cache.get(gemini._cache_key('abc'))).turns, wrapper.history.turns)
+
+    def test_loop_client_is_closed_before_its_event_loop(self):
+        # 否則 client 在 loop 關閉後才被回收，aclose() 會跑到別的 loop 上（Event loop is closed）
+        async def ask():
+            await gemini.GeminiAPIWrapper('closing').async_get_response('hi')
+            return await gemini._loop_client()
+
+        client = asyncio.run(ask())
+        self.assertTrue(client.aio._api_client._async_httpx_client.is_closed)
+
+    def test_answer_cache_skips_model_for_repeated_prompt(self):
+        answer_cache.clear()
+        self.addCleanup(answer_cache.clear)
+        scope = answer_cache.scope_for(1, 2)
+        before = self.server.requests
+        asyncio.run(gemini.GeminiAPIWrapper('a').async_get_response('什麼是二元搜尋樹？', cache_scope=scope))
+        wrapper = gemini.GeminiAPIWrapper('b')
+        answer = asyncio.run(wrapper.async_get_response('什麼是二元搜尋樹?? ', cache_scope=scope))
+        self.assertEqual(answer, 'stub answer')
+        self.assertEqual(self.server.requests, before + 1)
+        self.assertEqual(len(wrapper.history), 2)   # 命中的回覆仍寫入該學生的對話歷史
+        self.assertEqual((answer_cache.stats()['hits'], answer_cache.stats()['misses']), (1, 1))
+
+    def test_identical_concurrent_prompts_share_one_upstream_call(self):
+        async def burst():
+            wrappers = [gemini.GeminiAPIWrapper(f'flight{i}') for i in range(20)]
+            answers = await asyncio.gather(*(w.async_get_response('同一個問題') for w in wrappers))
+            return wrappers, answers
+
+        before = self.server.requests
+        wrappers, answers = asyncio.run(burst())
+        self.assertEqual(self.server.requests, before + 1)
+        self.assertEqual(set(answers), {'stub answer'})
+        self.assertTrue(all(len(w.history) == 2 for w in wrappers))
+
+        # 對話內容不同就不能共用回覆
+        asyncio.run(gemini.GeminiAPIWrapper('flight0').async_get_response('同一個問題'))
+        self.assertEqual(self.server.requests, before + 2)
+
+
+class GeminiChatConsumerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.student = CustomUser.objects.create_user(username='s1', password='pw', student_id='S1')
+        question = ExamQuestion.objects.create(title='q', content='<p>q</p>', question_type='tf', is_correct=True,
+                                               points=10, ai_limit=2, created_by=self.student)
+        self.paper = ExamPaper.objects.create(title='p', created_by=self.student)
+        self.paper.questions.add(question)
+        self.subject = quota.subject_for(self.student.pk)
+        quota.reset(self.subject, self.paper.id)
+
+    async def _converse(self, prompt, on_event=None):
+        # channels.testing 依賴 daphne；直接以 asgiref 的 ApplicationCommunicator 走 websocket 協定
+        scope = {'type': 'websocket', 'path': '/ws/gemini/chat/', 'headers': [], 'subprotocols': [],
+                 'session': SessionStore(), 'user': self.student}
+        communicator = ApplicationCommunicator(GeminiChatConsumer.as_asgi(), scope)
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.accept')
+        self.assertEqual(json.loads((await communicator.receive_output())['text'])['type'], 'info')
+        await communicator.send_input({'type': 'websocket.receive',
+                                       'text': json.dumps({'prompt': prompt, 'paper_id': self.paper.id})})
+        events = []
+        while not events or events[-1]['type'] not in ('done', 'error'):
+            event = json.loads((await communicator.receive_output(timeout=5))['text'])
+            events.append(event)
+            if on_event is not None:
+                on_event(event)
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait()
+        return events
+
+    async def test_chunks_stream_before_the_answer_completes(self):
+        sent_before_first_chunk = []
+
+        def on_event(event):
+            # stub 送出第一段後暫停：此時收到首段，表示沒有等完整回覆才轉送
+            if event['type'] == 'chunk' and not sent_before_first_chunk:
+                sent_before_first_chunk.append(server.sent_chunks)
+                server.resume()
+
+        with StubGeminiServer(latency=0.1, reply='abcdefgh', chunks=4, pause_after=1) as server:
+            gemini.configure_client(base_url=server.base_url, api_key='stub')
+            try:
+                events = await self._converse('hi', on_event)
+            finally:
+                gemini.configure_client()
+
+        chunks = [e for e in events if e['type'] == 'chunk']
+        self.assertEqual(''.join(e['data'] for e in chunks), 'abcdefgh')
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(sent_before_first_chunk, [1])
+        self.assertEqual((events[-1]['type'], events[-1]['remaining']), ('done', 1))
+        log = await InteractionLog.objects.aget(user=self.student)
+        self.assertEqual((log.response, log.exam_paper_id), ('abcdefgh', self.paper.id))
+
+    async def test_failed_stream_refunds_quota_without_logging(self):
+        gemini.configure_client(base_url='http://127.0.0.1:9/', api_key='stub')   # 無人監聽
+        try:
+            events = await self._converse('hi')
+        finally:
+            gemini.configure_client()
+        self.assertEqual((events[-1]['type'], events[-1]['remaining']), ('error', 2))
+        self.assertFalse(await InteractionLog.objects.filter(user=self.student).aexists())
+
+
+class ConversationHistoryTests(SimpleTestCase):
+    def test_window_and_summary_stay_bounded(self):
+        history = ConversationHistory(window_bytes=500, summary_bytes=300)
+        for i in range(200):
+            history.append(f'問題 {i} ' + 'x' * 50, f'回答 {i} ' + 'y' * 80)
+            payload = sum(len(text.encode()) for _, text in history.turns)
+            self.assertLessEqual(payload, 500)
+            self.assertLessEqual(len(history.summary.encode()), 300)
+        self.assertEqual(history.turns[-1][1], '回答 199 ' + 'y' * 80)
+        self.assertIn('問題 19', history.summary.splitlines()[-1])
+        self.assertNotIn('問題 0 ', history.summary)
+        self.assertIn(history.summary, history.system_instruction())
+
+        restored = ConversationHistory.loads(history.dumps())
+        self.assertEqual((restored.turns, restored.summary), (history.turns, history.summary))
+
+    def test_loads_legacy_list(self):
+        legacy = [{'role': r, 'parts': [{'text': str(i)}]} for i, r in enumerate(['user', 'model'] * 3)]
+        history = ConversationHistory.loads(legacy)
+        self.assertEqual(history.contents(), legacy)
+
+
+class FairSchedulerTests(SimpleTestCase):
+    def test_slots_rotate_between_owners(self):
+        async def run():
+            sched = scheduler.FairScheduler(max_concurrency=1, max_queue_per_owner=10)
+            order, gate = [], asyncio.Event()
+
+            async def job(owner, name, hold=False):
+                async with sched.slot(owner):
+                    order.append(name)
+                    if hold:
+                        await gate.wait()
+
+            tasks = [asyncio.create_task(job('a', 'a1', hold=True))]
+            await asyncio.sleep(0)
+            tasks += [asyncio.create_task(job('a', f'a{i}')) for i in range(2, 5)]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.create_task(job('b', 'b1')))   # 比 a 的其他請求晚到
+            await asyncio.sleep(0)
+            gate.set()
+            await asyncio.gather(*tasks)
+            return order, sched.stats()
+
+        order, stats = asyncio.run(run())
+        self.assertEqual(order, ['a1', 'a2', 'b1', 'a3', 'a4'])
+        self.assertEqual((stats['active'], stats['queued'], stats['admitted']), (0, 0, 5))
+        self.assertGreater(stats['wait_seconds_sum'], 0)
+
+    def test_full_queues_reject_immediately_and_cancelled_waiters_free_their_place(self):
+        async def run():
+            sched = scheduler.FairScheduler(max_concurrency=1, max_queue=2, max_queue_per_owner=1)
+            await sched.acquire('holder')
+            waiting = asyncio.create_task(sched.acquire('a'))
+            await asyncio.sleep(0)
+            with self.assertRaises(scheduler.Busy):
+                await sched.acquire('a')          # 單一使用者排隊上限
+            other = asyncio.create_task(sched.acquire('b'))
+            await asyncio.sleep(0)
+            with self.assertRaises(scheduler.Busy):
+                await sched.acquire('c')          # 總排隊上限
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+            sched.release()                       # 名額略過已取消的 a，交給 b
+            await other
+            sched.release()
+            return sched.stats()
+
+        stats = asyncio.run(run())
+        self.assertEqual((stats['active'], stats['queued'], stats['rejected']), (0, 0, 2))
+
+    def test_upstream_rate_limits_back_off_then_surface_as_busy(self):
+        scheduler.configure(backoff_base=0.01, retries=2)
+        self.addCleanup(scheduler.configure)
+        with StubGeminiServer(latency=0.01, reply='ok', rate_limited=2) as server:
+            gemini.configure_client(base_url=server.base_url, api_key='stub')
+            self.addCleanup(gemini.configure_client)
+            self.assertEqual(asyncio.run(gemini.GeminiAPIWrapper('r1').async_get_response('hi')), 'ok')
+            self.assertEqual(server.requests, 3)
+
+            server.rate_limited = 100
+            with self.assertRaises(scheduler.Busy):
+                asyncio.run(gemini.GeminiAPIWrapper('r2').async_get_response('hi'))
+        stats = scheduler.stats()
+        self.assertEqual((stats['retries'], stats['rate_limited'], stats['active']), (4, 5, 0))
+
+
+@override_settings(AI_BACKEND={'BACKEND': 'stub', 'LATENCY_MEAN': 0.05, 'LATENCY_STDDEV': 0.01,
+                               'TOKENS_PER_SECOND': 400, 'REPLY_TOKENS': 20, 'CHUNK_TOKENS': 5, 'SEED': 1})
+class StubBackendTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_replies_are_deterministic_and_stream_in_chunks(self):
+        async def run():
+            wrapper = gemini.GeminiAPIWrapper('stub1')
+            full = await wrapper.async_get_response('同一題')
+            chunks = [c async for c in gemini.GeminiAPIWrapper('stub2').async_stream_response('同一題')]
+            return full, chunks
+
+        full, chunks = asyncio.run(run())
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(''.join(chunks), full)
+        self.assertEqual(full, ''.join(backends.get_backend().reply('同一題')))
+        self.assertNotEqual(full, ''.join(backends.get_backend().reply('另一題')))
+        self.assertEqual(''.join(gemini.GeminiAPIWrapper('stub3').stream_response('同一題')), full)
+
+    def test_injected_faults(self):
+        scheduler.configure(backoff_base=0.001, retries=1)
+        self.addCleanup(scheduler.configure)
+        with override_settings(AI_BACKEND={'BACKEND': 'stub', 'LATENCY_MEAN': 0, 'RATE_LIMIT_RATE': 1.0}):
+            with self.assertRaises(scheduler.Busy):
+                asyncio.run(gemini.GeminiAPIWrapper('f1').async_get_response('hi'))
+            self.assertEqual(backends.get_backend().calls, 2)   # 重試一次
+        with override_settings(AI_BACKEND={'BACKEND': 'stub', 'LATENCY_MEAN': 0, 'ERROR_RATE': 1.0}):
+            with self.assertRaises(backends.BackendError):
+                asyncio.run(gemini.GeminiAPIWrapper('f2').async_get_response('hi'))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_leader_failure_reaches_followers(self):
+        async def fail():
+            await asyncio.sleep(0.05)
+            raise RuntimeError('upstream down')
+
+        flight = singleflight.LocalFlight({})
+
+        async def burst():
+            return await asyncio.gather(*(flight.do('k', fail) for _ in range(3)), return_exceptions=True)
+
+        results = asyncio.run(burst())
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+        self.assertEqual(flight.counters, {'leaders': 1, 'shared': 2})
+
+
+    def test_redis_result_is_shared_only_with_requests_during_the_call(self):
+        class FakeRedis:
+            def __init__(self):
+                self.data = {}
+
+            async def get(self, key):
+                return self.data.get(key)
+
+            async def set(self, key, value, nx=False, px=None):
+                if nx and key in self.data:
+                    return None
+                self.data[key] = value.encode()
+                return True
+
+            async def eval(self, script, numkeys, key, token):
+                if self.data.get(key) == token.encode():
+                    del self.data[key]
+
+        flight = singleflight.RedisFlight({**singleflight.DEFAULTS, 'POLL_INTERVAL': 0.01})
+        fake = FakeRedis()
+
+        async def client():
+            return fake
+
+        flight._client = client
+        calls = []
+
+        async def answer():
+            calls.append(1)
+            return f'answer {len(calls)}'
+
+        # 另一個行程的 leader 正在呼叫：等到它的結果
+        fake.data[f'{flight.prefix}:lock:k'] = b'other'
+
+        async def other_leader_finishes():
+            await asyncio.sleep(0.05)
+            fake.data[f'{flight.prefix}:result:k:other'] = b'"from other"'
+            del fake.data[f'{flight.prefix}:lock:k']
+
+        async def follow():
+            return (await asyncio.gather(flight.do('k', answer), other_leader_finishes()))[0]
+
+        self.assertEqual(asyncio.run(follow()), 'from other')
+        # 之後的請求不讀舊結果，重新呼叫
+        self.assertEqual(asyncio.run(flight.do('k', answer)), 'answer 1')
+        self.assertEqual(asyncio.run(flight.do('k', answer)), 'answer 2')
+
+    def test_redis_backend_falls_back_to_local_when_redis_is_down(self):
+        flight = singleflight.RedisFlight({**singleflight.DEFAULTS, 'REDIS_URL': 'redis://127.0.0.1:9/0'})
+
+        async def answer():
+            return 'stub answer'
+
+        self.assertEqual(asyncio.run(flight.do('k', answer)), 'stub answer')
+
+
+class AnswerCacheTests(SimpleTestCase):
+    def test_near_duplicates_match_within_scope_only(self):
+        store = answer_cache.AnswerCache()
+        scope = answer_cache.scope_for(1, 10)
+        store.store(scope, 'Please explain how quicksort chooses its pivot element', 'pivot answer')
+        self.assertEqual(store.lookup(scope, 'please explain how quicksort chooses its pivot element!'), 'pivot answer')
+        self.assertEqual(store.lookup(scope, 'Please explain how quicksort chooses the pivot element'), 'pivot answer')
+        self.assertIsNone(store.lookup(scope, 'What is the time complexity of merge sort?'))
+        self.assertIsNone(store.lookup(answer_cache.scope_for(1, 11), 'Please explain how quicksort chooses its pivot element'))
+        self.assertIsNone(answer_cache.scope_for(1, None))   # 沒有題目就不分桶（不查也不存）
+        self.assertEqual(store.stats()['hits'], 2)
+        self.assertEqual(store.stats()['misses'], 2)
+
+    def test_ttl_and_lru_eviction(self):
+        store = answer_cache.AnswerCache(ttl=60, bucket_entries=2, max_buckets=2)
+        scope = answer_cache.scope_for(1, 1)
+        with mock.patch('gemini_api.answer_cache.time.monotonic', return_value=0):
+            store.store(scope, 'first question about stacks', 'a1')
+            store.store(scope, 'second question about queues', 'a2')
+            store.lookup(scope, 'first question about stacks')      # 變成最近使用
+            store.store(scope, 'third question about heaps', 'a3')   # 淘汰 queues
+            self.assertIsNone(store.lookup(scope, 'second question about queues'))
+            self.assertEqual(store.lookup(scope, 'first question about stacks'), 'a1')
+            store.store(answer_cache.scope_for(2, 1), 'x question', 'b')
+            store.store(answer_cache.scope_for(3, 1), 'y question', 'c')  # 淘汰最久未用的分桶
+            self.assertEqual(store.stats()['buckets'], 2)
+        with mock.patch('gemini_api.answer_cache.time.monotonic', return_value=61):
+            self.assertIsNone(store.lookup(answer_cache.scope_for(3, 1), 'y question'))
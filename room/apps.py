@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class RoomConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'room'
+
+    def ready(self):
+        from . import metrics, signals, slowlog  # noqa: F401  註冊 signal handlers（含資料庫查詢計數、慢查詢記錄）
@@ -0,0 +1,208 @@
+"""
+成績匯出（CSV / XLSX 串流）。
+
+以 ExamAnswer.objects.iterator(chunk_size=...) 逐批讀取，邊讀邊輸出：
+每題一列（row_type=answer），每份作答結束時補一列總分（row_type=total）。
+總分列的 score 是 ExamRecord.score（含曲線），raw_score 為各題得分加總。
+記憶體用量與匯出筆數無關，第一個位元組在第一批資料讀到後即送出。
+XLSX 直接以 zipfile 串流寫出 SpreadsheetML，不需要額外套件。
+
+ASGI（Daphne）下 StreamingHttpResponse 拿到同步 iterator 會先以 sync_to_async(list) 讀完整份內容，
+所以 view 以 aiter_chunks 包成 async iterator，每段各自經 sync_to_async 取出後立即送出。
+"""
+import csv
+import datetime
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import ExamAnswer
+
+EXPORT_CHUNK_SIZE = 2000
+
+HEADER = (
+    'row_type', 'student_id', 'student_name', 'class_name', 'paper_id', 'paper_title',
+    'question_id', 'question_title', 'points', 'score', 'is_correct', 'student_answer', 'submitted_at',
+    'raw_score',
+)
+
+
+def parse_day(value):
+    """'YYYY-MM-DD' → 當地時區當天 00:00；空值回傳 None，格式錯誤拋出 ValueError。"""
+    if not value:
+        return None
+    day = parse_date(value)
+    if day is None:
+        raise ValueError(f"日期格式錯誤：{value}")
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def export_queryset(paper_id=None, since=None, until=None):
+    """匯出範圍：指定考卷，或以考卷發佈時間（since <= publish_time < until）圈出一個學期。"""
+    answers = ExamAnswer.objects.select_related(
+        'exam_record__student', 'exam_record__exam_paper', 'exam_question'
+    ).order_by('exam_record__exam_paper_id', 'exam_record_id', 'exam_question_id')
+    if paper_id:
+        answers = answers.filter(exam_record__exam_paper_id=paper_id)
+    if since:
+        answers = answers.filter(exam_record__exam_paper__publish_time__gte=since)
+    if until:
+        answers = answers.filter(exam_record__exam_paper__publish_time__lt=until)
+    return answers
+
+
+def _total_row(record, raw_score):
+    submitted_at = record.submitted_at.isoformat() if record.submitted_at else ''
+    return ('total',) + _record_cells(record) + (
+        '', '', record.exam_paper.total_points, record.score, '', '', submitted_at, raw_score,
+    )
+
+
+def _record_cells(record):
+    student = record.student
+    return (
+        student.student_id, student.get_full_name() or student.username, student.class_name or '',
+        record.exam_paper_id, record.exam_paper.title,
+    )
+
+
+def iter_rows(paper_id=None, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """產生表頭與資料列（tuple）。"""
+    yield HEADER
+    current = None
+    raw_score = 0
+    for answer in export_queryset(paper_id, since, until).iterator(chunk_size=chunk_size):
+        record = answer.exam_record
+        if current is not None and current.id != record.id:
+            yield _total_row(current, raw_score)
+            raw_score = 0
+        current = record
+        raw_score += answer.score
+        question = answer.exam_question
+        yield ('answer',) + _record_cells(record) + (
+            question.id, question.title, question.points, answer.score,
+            int(answer.is_correct), answer.student_answer or '', '', '',
+        )
+    if current is not None:
+        yield _total_row(current, raw_score)
+
+
+class _Echo:
+    """csv.writer 用的假檔案：write 直接回傳內容。"""
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows, flush_every=500):
+    writer = csv.writer(_Echo())
+    lines = ['\ufeff']  # BOM：讓 Excel 正確辨識 UTF-8
+    for i, row in enumerate(rows, start=1):
+        lines.append(writer.writerow(['' if v is None else v for v in row]))
+        if i % flush_every == 0:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+    yield ''.join(lines).encode('utf-8')
+
+
+class _ChunkBuffer:
+    """zipfile 的輸出目標（不可 seek），累積寫入的位元組供產生器取出。"""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+_XLSX_STATIC = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="成績" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+# XML 1.0 不允許的控制字元
+_ILLEGAL_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _xlsx_cell(value) -> str:
+    if value is None or value == '':
+        return '<c/>'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (int, float)):
+        return f'<c><v>{value}</v></c>'
+    text = escape(_ILLEGAL_XML.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def stream_xlsx(rows, flush_every=500):
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, content in _XLSX_STATIC.items():
+            zf.writestr(name, content)
+        yield buffer.take()
+
+        with zf.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            for i, row in enumerate(rows, start=1):
+                sheet.write(('<row>' + ''.join(_xlsx_cell(v) for v in row) + '</row>').encode('utf-8'))
+                if i % flush_every == 0:
+                    yield buffer.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield buffer.take()
+
+
+async def aiter_chunks(chunks):
+    """
+    以 async iterator 逐段送出 stream_csv / stream_xlsx 的輸出（每段最多 flush_every 列）。
+    每段在 thread_sensitive 的 thread 取出：整個請求都在同一個 thread，iterator() 的資料庫 cursor 不會跨 thread。
+    """
+    chunks = iter(chunks)
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    while (chunk := await next_chunk(chunks, None)) is not None:
+        yield chunk
+
+
+FORMATS = {
+    'csv': (stream_csv, 'text/csv; charset=utf-8'),
+    'xlsx': (stream_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
@@ -0,0 +1,85 @@
+"""
+成績簿查詢層（student_exam_history 使用）。
+
+分頁後只載入當頁的 StudentExamHistory，再以固定數量的查詢取回對應的
+ExamRecord、ExamAnswer 與 ExamQuestion，查詢數不隨紀錄或題數增加。
+"""
+from django.core.paginator import Paginator
+from django.db.models import Prefetch, Q
+
+from .models import ExamAnswer, ExamRecord, StudentExamHistory
+
+GRADEBOOK_PAGE_SIZE = 20
+
+
+def gradebook_queryset(paper_id=None, class_name=None, student_id=None):
+    """依考卷、班級、學號篩選的 StudentExamHistory（已 select_related 學生與考卷）。"""
+    histories = StudentExamHistory.objects.select_related('student', 'exam_paper').order_by('-completed_at', '-id')
+    if paper_id:
+        histories = histories.filter(exam_paper_id=paper_id)
+    if class_name:
+        histories = histories.filter(student__class_name=class_name)
+    if student_id:
+        histories = histories.filter(student__student_id=student_id)
+    return histories
+
+
+def _answer_rows(exam_record):
+    rows = []
+    for answer in exam_record.answer_details.all():
+        question = answer.exam_question
+        rows.append({
+            'question_title': question.title,
+            'question_content': question.content,
+            'student_answer': answer.student_answer,
+            'score': answer.score,
+            'is_correct': answer.is_correct,
+            'question_type': question.get_question_type_display(),
+            'question_id': question.id,
+            'points': question.points,
+        })
+    return rows
+
+
+def build_records(histories):
+    """把一頁 StudentExamHistory 轉成模板使用的 dict；ExamRecord 與答案一次批次載入。"""
+    histories = list(histories)
+    if not histories:
+        return []
+
+    pairs = Q()
+    for h in histories:
+        pairs |= Q(student_id=h.student_id, exam_paper_id=h.exam_paper_id)
+    records = ExamRecord.objects.filter(pairs).prefetch_related(
+        Prefetch(
+            'answer_details',
+            queryset=ExamAnswer.objects.select_related('exam_question').order_by('exam_question_id'),
+        )
+    )
+    records_by_key = {(r.student_id, r.exam_paper_id): r for r in records}
+
+    detailed_records = []
+    for history in histories:
+        exam_record = records_by_key.get((history.student_id, history.exam_paper_id))
+        if not exam_record:
+            continue
+        student = history.student
+        detailed_records.append({
+            'history_id': history.id,
+            'student_id': student.student_id,
+            'student_name': student.get_full_name() or student.username,
+            'class_name': student.class_name,
+            'exam_paper_id': history.exam_paper_id,
+            'exam_title': history.exam_paper.title,
+            'total_score': history.total_score,
+            'completed_at': history.completed_at,
+            'answers': _answer_rows(exam_record),
+        })
+    return detailed_records
+
+
+def load_gradebook_page(page_number=1, per_page=GRADEBOOK_PAGE_SIZE, **filters):
+    """回傳 (page, detailed_records)；只有當頁資料會被載入。"""
+    paginator = Paginator(gradebook_queryset(**filters), per_page)
+    page = paginator.get_page(page_number)
+    return page, build_records(page.object_list)
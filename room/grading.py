@@ -0,0 +1,188 @@
+"""
+判分引擎：把 ExamQuestion 編譯成判分物件，並以考卷為單位快取。
+
+- 單選（sc）：正解編譯為 int
+- 多選（mcq）：正解編譯為位元遮罩（bit i 代表第 i 個選項）
+- 是非（tf）：正解為 bool
+- 簡答（sa）：正解為 strip + lower 後的字串
+
+題目儲存 / 刪除、考卷題目異動時由 room.signals 呼叫 invalidate_* 清除快取。
+"""
+import ast
+from collections import namedtuple
+
+from django.core.cache import cache
+
+from . import metrics
+
+TRUE_WORDS = frozenset(['true', '1', 't', 'yes', 'y', '是', '對', '正確'])
+
+GRADER_CACHE_TIMEOUT = 60 * 60  # 1 小時；題目異動時會主動清除
+
+Grade = namedtuple('Grade', ['is_correct', 'score'])
+
+GRADER_CACHE_LOOKUPS = metrics.Counter(
+    'grader_cache_lookups_total', "考卷判分快取查詢（hit / miss 可算命中率）", labels=('result',),
+)
+
+
+def _paper_cache_key(paper_id) -> str:
+    return f"grading:paper:{paper_id}"
+
+
+def parse_option_mask(value):
+    """把 "0,2" / [0, "2"] / 1 轉成位元遮罩；格式錯誤回傳 None。"""
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        parts = value
+    else:
+        parts = str(value).split(',')
+    mask = 0
+    for part in parts:
+        part = str(part).strip()
+        if not part:
+            continue
+        try:
+            idx = int(part)
+        except ValueError:
+            return None
+        if idx < 0:
+            return None
+        mask |= 1 << idx
+    return mask
+
+
+def parse_tf(value):
+    """學生的是非題答案轉成 bool。"""
+    return str(value).strip().lower() in TRUE_WORDS
+
+
+def normalize_text(value) -> str:
+    return str(value).strip().lower()
+
+
+def decode_stored_answer(text):
+    """
+    ExamAnswer.student_answer 還原成判分用的值：多選題的列表答案以 str(list) 存入，
+    例如 "['0', '2']"，需還原成列表才會與提交當下的判分結果一致。
+    """
+    if isinstance(text, str) and text.startswith('['):
+        try:
+            value = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            return text
+        if isinstance(value, (list, tuple)):
+            return list(value)
+    return text
+
+
+def is_blank(answer) -> bool:
+    """None、空字串、空列表（或全為空值的列表）視為未作答。"""
+    if answer is None:
+        return True
+    if isinstance(answer, str):
+        return not answer.strip()
+    if isinstance(answer, (list, tuple)):
+        return not any(answer)
+    return False
+
+
+class CompiledQuestion:
+    """單一題目的編譯結果；可被 pickle 存入快取。"""
+    __slots__ = ('question_id', 'question_type', 'points', 'key', 'label', 'has_key')
+
+    def __init__(self, question_id, question_type, points, key, label, has_key):
+        self.question_id = question_id
+        self.question_type = question_type
+        self.points = points
+        self.key = key
+        self.label = label
+        self.has_key = has_key
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def is_correct(self, answer) -> bool:
+        if self.key is None or is_blank(answer):
+            return False
+        qtype = self.question_type
+        if qtype == 'sc':
+            if isinstance(answer, (list, tuple)):
+                return False
+            try:
+                return int(str(answer).strip()) == self.key
+            except (ValueError, TypeError):
+                return False
+        if qtype == 'mcq':
+            return parse_option_mask(answer) == self.key
+        if qtype == 'tf':
+            return parse_tf(answer) == self.key
+        if qtype in ('sa', 'essay'):
+            return normalize_text(answer) == self.key
+        return False
+
+    def grade(self, answer) -> Grade:
+        is_correct = self.is_correct(answer)
+        return Grade(is_correct, self.points if is_correct else 0)
+
+
+def compile_question(question) -> CompiledQuestion:
+    """把 ExamQuestion 編譯成 CompiledQuestion；正解格式錯誤時 key 為 None（一律判錯）。"""
+    raw = question.correct_option_indices
+    qtype = question.question_type
+    key = None
+    if qtype == 'sc':
+        try:
+            key = int(str(raw).strip()) if raw not in (None, '') else None
+        except (ValueError, TypeError):
+            key = None
+    elif qtype == 'mcq':
+        key = parse_option_mask(raw) if raw else None
+    elif qtype == 'tf':
+        key = question.is_correct
+    elif qtype in ('sa', 'essay'):
+        key = normalize_text(raw) if raw else None
+
+    return CompiledQuestion(
+        question_id=question.id,
+        question_type=qtype,
+        points=question.points,
+        key=key,
+        label=question.title or question.content[:50],
+        has_key=bool(raw or question.is_correct),
+    )
+
+
+def get_paper_graders(paper) -> dict:
+    """
+    取得考卷所有題目的判分物件 {question_id: CompiledQuestion}（保留題目順序）。
+    paper 可為 ExamPaper 物件或其 id；快取命中時不會查詢資料庫。
+    """
+    paper_id = getattr(paper, 'pk', paper)
+    key = _paper_cache_key(paper_id)
+    graders = cache.get(key)
+    GRADER_CACHE_LOOKUPS.inc(result='miss' if graders is None else 'hit')
+    if graders is None:
+        if hasattr(paper, 'questions'):
+            questions = paper.questions.all()
+        else:
+            from .models import ExamQuestion
+            questions = ExamQuestion.objects.filter(exampaper__id=paper_id)
+        graders = {q.id: compile_question(q) for q in questions}
+        cache.set(key, graders, GRADER_CACHE_TIMEOUT)
+    return graders
+
+
+def invalidate_paper(paper_id):
+    cache.delete(_paper_cache_key(paper_id))
+
+
+def invalidate_papers(paper_ids):
+    keys = [_paper_cache_key(pid) for pid in paper_ids]
+    if keys:
+        cache.delete_many(keys)
@@ -0,0 +1,342 @@
+"""
+InteractionLog 寫入管道（write-behind）。
+
+請求路徑只把紀錄放進佇列，由背景 flusher 依筆數或時間批次 bulk_create，
+稽核紀錄的 INSERT 不再算進請求延遲。後端由 settings.INTERACTION_LOG_SINK 選擇：
+
+- 'sync'：立即寫入（測試用；在 transaction 內寫入會隨 transaction 一起 rollback）
+- 'buffered'：行程內佇列 + 背景執行緒
+- 'redis'：多 worker 共用 Redis list，每個行程的 flusher 都會搶批次寫入
+
+非同步後端只在 transaction commit 後才入列；行程結束時（atexit）會把佇列寫完。
+批次寫入資料庫成功後才確認（ack），寫入失敗時整批留在佇列中等待重試，不會遺失。
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+from django.dispatch import receiver
+from django.utils.dateparse import parse_datetime
+
+from .models import InteractionLog
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKEND': 'buffered',
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 1.0,   # 秒
+    'REDIS_KEY': 'interaction_log:queue',
+    'MAX_RETRY_INTERVAL': 30.0,   # 秒；取批次或寫入失敗時的退避上限
+    'PROCESSING_TIMEOUT': 60,     # 秒；redis 後端的 worker 心跳過期後，其未確認的批次放回佇列
+}
+
+# 由資料庫自動填入，不需要放進佇列；created_at 在建立物件時就已取得，保留入列時的時間
+_SKIP_FIELDS = {'id'}
+
+
+def _entry_fields():
+    return [f.attname for f in InteractionLog._meta.concrete_fields if f.attname not in _SKIP_FIELDS]
+
+
+def to_entry(log) -> dict:
+    """未儲存的 InteractionLog → 可序列化的 dict。"""
+    return {name: getattr(log, name) for name in _entry_fields()}
+
+
+def _write(entries, batch_size):
+    if entries:
+        InteractionLog.objects.bulk_create([InteractionLog(**e) for e in entries], batch_size=batch_size)
+
+
+class SyncSink:
+    synchronous = True
+
+    def __init__(self, options):
+        self.batch_size = options['BATCH_SIZE']
+
+    def enqueue(self, entries):
+        _write(entries, self.batch_size)
+
+    def close(self):
+        pass
+
+
+class _FlusherSink:
+    """背景 flusher 共用邏輯；子類別實作 _put / _take，以及寫入後的 _ack / 失敗時的 _requeue。"""
+    synchronous = False
+
+    def __init__(self, options):
+        self.batch_size = options['BATCH_SIZE']
+        self.flush_interval = options['FLUSH_INTERVAL']
+        self.max_retry_interval = options['MAX_RETRY_INTERVAL']
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='interaction-log-flusher', daemon=True)
+                    self._thread.start()
+
+    def enqueue(self, entries):
+        if entries:
+            self._put(entries)
+            self._ensure_started()
+
+    def _flush_batch(self, block: bool) -> int:
+        entries = self._take(self.batch_size, block)
+        if not entries:
+            return 0
+        try:
+            self._write_batch(entries)
+        except Exception:
+            self._requeue(entries)   # 資料庫暫時無法寫入：整批保留，由呼叫端退避後重試
+            raise
+        self._ack()
+        return len(entries)
+
+    def _write_batch(self, entries):
+        try:
+            _write(entries, self.batch_size)
+        except (DataError, IntegrityError):
+            # 資料本身有問題（例如使用者已被刪除）：逐筆寫入，只丟棄寫不進去的那幾筆。
+            # 外層 atomic 讓途中的連線錯誤整批 rollback，重試時不會重複寫入。
+            logger.warning("批次寫入 InteractionLog 失敗，改為逐筆寫入", exc_info=True)
+            with transaction.atomic():
+                for entry in entries:
+                    try:
+                        with transaction.atomic():
+                            InteractionLog.objects.create(**entry)
+                    except (DataError, IntegrityError):
+                        logger.exception("寫入 InteractionLog 失敗，丟棄：%r", entry)
+
+    def _ack(self):
+        pass
+
+    def _run(self):
+        delay = 0
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._flush_batch(block=True)
+                    delay = 0
+                except Exception:
+                    # Redis / 資料庫暫時無法使用：flusher 不能因此結束，退避後重試
+                    delay = min(max(delay * 2, self.flush_interval), self.max_retry_interval)
+                    logger.warning("InteractionLog flusher 發生錯誤，%.1f 秒後重試", delay, exc_info=True)
+                    close_old_connections()
+                    self._stop.wait(delay)
+            self.drain()
+        except Exception:
+            logger.exception("結束前寫入剩餘的 InteractionLog 失敗")
+        finally:
+            close_old_connections()
+
+    def drain(self):
+        """把佇列中剩餘的紀錄全部寫入（同步）。"""
+        while self._flush_batch(block=False):
+            pass
+
+    def close(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        try:
+            self.drain()
+        except Exception:
+            logger.exception("關閉時寫入剩餘的 InteractionLog 失敗")
+
+
+class BufferedSink(_FlusherSink):
+    def __init__(self, options):
+        super().__init__(options)
+        self._queue = queue.SimpleQueue()
+
+    def _put(self, entries):
+        for entry in entries:
+            self._queue.put(entry)
+
+    _requeue = _put
+
+    def _take(self, limit, block):
+        """湊滿 limit 筆或等到 flush_interval 為止。"""
+        entries = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(entries) < limit:
+            timeout = deadline - time.monotonic()
+            try:
+                if block and timeout > 0:
+                    entries.append(self._queue.get(timeout=timeout))
+                else:
+                    entries.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return entries
+
+
+class RedisSink(_FlusherSink):
+    """
+    取批次時以 LMOVE 把紀錄從佇列移到本 worker 的處理中 list，寫入資料庫成功後才刪除。
+    寫入失敗時紀錄留在處理中 list，下次優先重試；worker 中途結束時，其他 flusher 在
+    它的心跳過期（PROCESSING_TIMEOUT）後把紀錄放回佇列。
+    """
+
+    def __init__(self, options):
+        super().__init__(options)
+        try:
+            import redis
+        except ImportError as e:
+            raise ImproperlyConfigured("INTERACTION_LOG_SINK 使用 redis 後端需要安裝 redis 套件") from e
+        self._client = redis.Redis.from_url(options.get('REDIS_URL') or settings.REDIS_URL)
+        self._key = options['REDIS_KEY']
+        self.processing_timeout = options['PROCESSING_TIMEOUT']
+        self._next_reclaim = 0.0
+
+    def _worker_key(self, kind, worker=None):
+        # 以主機與 PID 區分 worker；fork 後的子行程各自使用自己的處理中 list
+        if worker is None:
+            worker = f"{socket.gethostname()}:{os.getpid()}"
+        return f"{self._key}:{kind}:{worker}"
+
+    def _put(self, entries):
+        self._client.rpush(self._key, *[self._encode(e) for e in entries])
+
+    @staticmethod
+    def _encode(entry):
+        return json.dumps({**entry, 'created_at': entry['created_at'].isoformat()}, ensure_ascii=False)
+
+    @staticmethod
+    def _decode(item):
+        entry = json.loads(item)
+        if 'created_at' in entry:   # 舊版入列的紀錄沒有 created_at，寫入時由預設值補上
+            entry['created_at'] = parse_datetime(entry['created_at'])
+        return entry
+
+    def _take(self, limit, block):
+        processing = self._worker_key('processing')
+        self._client.set(self._worker_key('heartbeat'), 1, ex=self.processing_timeout)
+        raw = self._client.lrange(processing, 0, -1)   # 上次寫入失敗、尚未確認的批次
+        if not raw:
+            count = min(limit, self._client.llen(self._key))
+            if count:
+                pipe = self._client.pipeline()   # MULTI/EXEC：整批一起移動
+                for _ in range(count):
+                    pipe.lmove(self._key, processing, 'LEFT', 'RIGHT')
+                raw = [item for item in pipe.execute() if item is not None]   # 其他 worker 可能先取走
+        if not raw and block:
+            self._reclaim_orphans()
+            self._stop.wait(self.flush_interval)
+        return [self._decode(item) for item in raw]
+
+    def _ack(self):
+        self._client.delete(self._worker_key('processing'))
+
+    def _requeue(self, entries):
+        pass   # 紀錄仍在處理中 list，下次 _take 會先取回
+
+    def _reclaim_orphans(self):
+        """把心跳已過期的 worker 留下的處理中紀錄放回佇列前端（每 PROCESSING_TIMEOUT 檢查一次）。"""
+        now = time.monotonic()
+        if now < self._next_reclaim:
+            return
+        self._next_reclaim = now + self.processing_timeout
+        prefix = self._worker_key('processing', worker='')
+        for name in self._client.scan_iter(match=prefix + '*'):
+            worker = name.decode()[len(prefix):]
+            if self._client.exists(self._worker_key('heartbeat', worker)):
+                continue
+            while self._client.lmove(name, self._key, 'RIGHT', 'LEFT') is not None:
+                pass
+
+
+BACKENDS = {
+    'sync': SyncSink,
+    'buffered': BufferedSink,
+    'redis': RedisSink,
+}
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                options = {**DEFAULTS, **getattr(settings, 'INTERACTION_LOG_SINK', {})}
+                try:
+                    backend = BACKENDS[options['BACKEND']]
+                except KeyError:
+                    raise ImproperlyConfigured(f"未知的 INTERACTION_LOG_SINK 後端：{options['BACKEND']}")
+                _sink = backend(options)
+    return _sink
+
+
+def shutdown():
+    """關閉並清空目前的 sink（atexit 與設定變更時呼叫）。"""
+    global _sink
+    with _sink_lock:
+        sink, _sink = _sink, None
+    if sink is not None:
+        sink.close()
+
+
+atexit.register(shutdown)
+
+
+@receiver(setting_changed)
+def _reset_sink(setting, **kwargs):
+    if setting == 'INTERACTION_LOG_SINK':
+        shutdown()
+
+
+def log_interactions(logs):
+    """寫入多筆（未儲存的）InteractionLog；非同步後端會等 transaction commit 後再入列。"""
+    entries = [to_entry(log) for log in logs]
+    if not entries:
+        return
+    sink = get_sink()
+    if sink.synchronous:
+        sink.enqueue(entries)
+    else:
+        # commit 之後才執行：此時請求已成功，入列失敗不能再讓它變成 500
+        transaction.on_commit(lambda: _enqueue_or_write(sink, entries))
+
+
+def _enqueue_or_write(sink, entries):
+    try:
+        sink.enqueue(entries)
+    except Exception:
+        logger.warning("InteractionLog 入列失敗，改為直接寫入資料庫", exc_info=True)
+        try:
+            _write(entries, sink.batch_size)
+        except Exception:
+            logger.exception("寫入 InteractionLog 失敗，丟棄 %d 筆", len(entries))
+
+
+def log_interaction(**fields):
+    log_interactions([InteractionLog(**fields)])
+
+
+async def alog_interaction(**fields):
+    """async view 使用：行程內佇列直接入列；其他後端（DB / Redis I/O）丟到 thread 執行。"""
+    sink = get_sink()
+    if isinstance(sink, BufferedSink):
+        sink.enqueue([to_entry(InteractionLog(**fields))])   # 行程內佇列，不會失敗
+    else:
+        await sync_to_async(log_interaction)(**fields)
@@ -0,0 +1,37 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from room.export import EXPORT_CHUNK_SIZE, FORMATS, iter_rows, parse_day
+
+
+class Command(BaseCommand):
+    help = "串流匯出成績（每題得分與總分）為 CSV 或 XLSX"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--paper', type=int, help="考卷 ID；不指定時依 --since/--until 匯出整個學期")
+        parser.add_argument('--since', help="考卷發佈時間起（YYYY-MM-DD，含）")
+        parser.add_argument('--until', help="考卷發佈時間迄（YYYY-MM-DD，不含）")
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+        parser.add_argument('-o', '--output', help="輸出檔案；預設寫到 stdout")
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_day(options['since'])
+            until = parse_day(options['until'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        stream, _ = FORMATS[options['format']]
+        rows = iter_rows(options['paper'], since, until, chunk_size=options['chunk_size'])
+
+        out = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in stream(rows):
+                out.write(chunk)
+        finally:
+            if options['output']:
+                out.close()
+            else:
+                out.flush()
@@ -0,0 +1,273 @@
+import asyncio
+import contextlib
+import contextvars
+import json
+import math
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from room import logsink
+from room.models import CustomUser, ExamPaper, ExamQuestion
+
+PASSWORD = 'loadtest-pass'
+
+_endpoint = contextvars.ContextVar('loadtest_endpoint', default=None)
+
+
+class QueryCounter:
+    """依目前的端點（contextvar，會帶進 sync_to_async 的 thread）計算 SQL 查詢數。"""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        endpoint = _endpoint.get()
+        if endpoint is not None:
+            with self._lock:
+                self.counts[endpoint] += 1
+        return execute(sql, params, many, context)
+
+    def _attach(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def _on_connect(self, sender, connection, **kwargs):
+        self._attach(connection)
+
+    def install(self):
+        # 每個 thread 各有自己的連線：新建立的連線由 signal 掛上，現有的直接掛上
+        connection_created.connect(self._on_connect, weak=False)
+        for connection in connections.all(initialized_only=True):
+            self._attach(connection)
+
+    def uninstall(self):
+        connection_created.disconnect(self._on_connect)
+        for connection in connections.all(initialized_only=True):
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+def _percentile(sorted_values, pct):
+    """nearest-rank 百分位：第 ceil(pct% × n) 小的值。"""
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = (
+        "考試流程壓測：建立 N 位學生與一張考卷，同時跑完 登入 → 選擇考卷 → 作答頁 → 自動儲存 → AI 提問 → 交卷，"
+        "以 JSON 輸出各端點的延遲百分位、吞吐量與 SQL 查詢數（方便版本間比較）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=50, help="學生人數")
+        parser.add_argument('--questions', type=int, default=10, help="考卷題數")
+        parser.add_argument('--ai-questions', type=int, default=2, help="每位學生的 AI 提問次數")
+        parser.add_argument('--concurrency', type=int, default=0, help="同時進行的學生數（0 = 全部）")
+        parser.add_argument('--think', type=float, default=0.0, help="每個步驟之間的隨機思考時間上限（秒）")
+        parser.add_argument('--ai-latency', type=float, default=0.5, help="stub 模型的平均延遲（秒）")
+        parser.add_argument('--prefix', default='loadtest', help="建立的帳號 / 考卷名稱前綴")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="JSON 報告輸出檔（預設印到 stdout）")
+        parser.add_argument('--keep', action='store_true', help="保留建立的學生、題目與考卷")
+        parser.add_argument('--no-redis', action='store_true',
+                            help="AI 額度、請求合併、指標與 Django cache 改用行程內後端（沒有 Redis 時使用）")
+
+    def handle(self, *args, **options):
+        if options['students'] < 1 or options['questions'] < 1:
+            raise CommandError("--students 與 --questions 至少為 1")
+        if CustomUser.objects.filter(username__startswith=f"{options['prefix']}_").exists():
+            raise CommandError(f"已有前綴為 {options['prefix']}_ 的帳號，請改用 --prefix 或先清除")
+
+        overrides = {
+            # LLM 一律用 stub 後端：不需網路，延遲可控
+            'AI_BACKEND': {'BACKEND': 'stub', 'LATENCY_MEAN': options['ai_latency'],
+                           'LATENCY_STDDEV': options['ai_latency'] / 3, 'SEED': options['seed']},
+        }
+        if options['no_redis']:
+            overrides.update(AI_QUOTA={'BACKEND': 'memory'}, AI_SINGLEFLIGHT={'BACKEND': 'local'},
+                             METRICS={'BACKEND': 'memory'},
+                             CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+
+        random.seed(options['seed'])
+        paper, students = self._seed(options)
+        counter = QueryCounter()
+        counter.install()
+        try:
+            # view 裡的 print 除錯輸出導到 stderr，stdout 只留 JSON 報告
+            with override_settings(**overrides), contextlib.redirect_stdout(sys.stderr):
+                result = asyncio.run(self._run(paper, students, options))
+        finally:
+            counter.uninstall()
+            logsink.shutdown()   # 讓緩衝中的 InteractionLog 寫完，再清除資料
+            if not options['keep']:
+                self._cleanup(options['prefix'])
+
+        report = self._report(result, counter.counts, options)
+        text = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+            self.stderr.write(f"報告已寫入 {options['output']}")
+        else:
+            self.stdout.write(text)
+
+    # ---- 準備資料 ----
+
+    def _seed(self, options):
+        prefix = options['prefix']
+        password = make_password(PASSWORD)   # 只雜湊一次；登入時的驗證成本照常計入
+        teacher = CustomUser.objects.create(username=f'{prefix}_teacher', student_id=f'{prefix}T',
+                                            password=password, is_staff=True)
+        questions = ExamQuestion.objects.bulk_create([
+            ExamQuestion(title=f'{prefix} q{i}', content='<p>q</p>', question_type='sc', options=['a', 'b', 'c'],
+                         correct_option_indices='0', points=10, ai_limit=1, created_by=teacher)
+            if i % 2 == 0 else
+            ExamQuestion(title=f'{prefix} q{i}', content='<p>q</p>', question_type='tf', is_correct=True,
+                         points=10, ai_limit=1, created_by=teacher)
+            for i in range(options['questions'])
+        ])
+        now = timezone.now()
+        paper = ExamPaper.objects.create(title=f'{prefix} paper', created_by=teacher,
+                                         publish_time=now - timezone.timedelta(minutes=5),
+                                         start_time=now - timezone.timedelta(minutes=5),
+                                         end_time=now + timezone.timedelta(hours=3))
+        paper.questions.set(questions)   # signals 維護 total_points / ai_total_limit
+        students = CustomUser.objects.bulk_create([
+            CustomUser(username=f'{prefix}_s{i}', student_id=f'{prefix}{i}', password=password, class_name=prefix)
+            for i in range(options['students'])
+        ])
+        return paper, students
+
+    def _cleanup(self, prefix):
+        # 題目、考卷、作答紀錄、互動紀錄皆隨帳號 CASCADE 刪除
+        CustomUser.objects.filter(username__startswith=f'{prefix}_').delete()
+
+    # ---- 執行 ----
+
+    async def _run(self, paper, students, options):
+        question_ids = await sync_to_async(lambda: list(paper.questions.values_list('id', 'question_type')))()
+        latencies = defaultdict(list)
+        statuses = defaultdict(Counter)
+        errors = Counter()
+        gate = asyncio.Semaphore(options['concurrency'] or len(students))
+
+        async def request(client, endpoint, method, path, expect, **kwargs):
+            token = _endpoint.set(endpoint)
+            started = time.perf_counter()
+            try:
+                # 與 ASGIHandler（Daphne）相同：每個請求一個 ThreadSensitiveContext，同步 view 各自一個 thread
+                async with ThreadSensitiveContext():
+                    response = await getattr(client, method)(path, **kwargs)
+            finally:
+                _endpoint.reset(token)
+            latencies[endpoint].append(time.perf_counter() - started)
+            statuses[endpoint][response.status_code] += 1
+            if response.status_code not in expect:
+                errors[endpoint] += 1
+            return response
+
+        async def think():
+            if options['think']:
+                await asyncio.sleep(random.uniform(0, options['think']))
+
+        async def student_flow(i, student):
+            async with gate:
+                client = AsyncClient(raise_request_exception=False)
+                await request(client, 'login', 'post', reverse('room:login'), {302},
+                              data={'student_id': student.student_id, 'password': PASSWORD})
+                await think()
+                await request(client, 'select_exam', 'get', reverse('room:select_exam'), {200})
+                await request(client, 'select_exam', 'post', reverse('room:select_exam'), {302},
+                              data={'exam_paper': paper.id})
+                await request(client, 'exam', 'get', reverse('room:exam'), {200})
+
+                answers = {}
+                for n, (qid, qtype) in enumerate(question_ids):
+                    await think()
+                    answer = '0' if qtype == 'sc' else 'true'
+                    answers[str(qid)] = answer
+                    body = {'paper_id': paper.id, 'question_id': qid, 'answer': answer}
+                    # 三種自動儲存路徑輪流使用
+                    if n % 3 == 0:
+                        await request(client, 'submit_single_answer', 'post', reverse('room:submit_single_answer'),
+                                      {200}, data=json.dumps(body), content_type='application/json')
+                    elif n % 3 == 1:
+                        await request(client, 'exam_json', 'post', reverse('room:exam'), {200},
+                                      data=json.dumps({'action': 'submit_answer', **body}),
+                                      content_type='application/json')
+                    else:
+                        batch = {'paper_id': paper.id, 'answers': [{'question_id': qid, 'answer': answer,
+                                                                    'client_seq': n}]}
+                        await request(client, 'answers_batch', 'post', reverse('room:submit_answers_batch'),
+                                      {200}, data=json.dumps(batch), content_type='application/json')
+
+                for n in range(options['ai_questions']):
+                    await think()
+                    body = {'prompt': f'{student.username} 的第 {n + 1} 個問題', 'paper_id': paper.id}
+                    await request(client, 'ai_webhook', 'post', reverse('room:ai_webhook'), {200},
+                                  data=json.dumps(body), content_type='application/json')
+
+                await think()
+                await request(client, 'submit', 'post', reverse('room:exam'), {302},
+                              data={'paper_id': paper.id, 'answers': json.dumps(answers)})
+
+        started = time.perf_counter()
+        outcomes = await asyncio.gather(*(student_flow(i, s) for i, s in enumerate(students)),
+                                        return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        failed = [o for o in outcomes if isinstance(o, BaseException)]
+        for exc in failed[:3]:
+            self.stderr.write(f"學生流程中斷：{exc!r}")
+        return {'latencies': latencies, 'statuses': statuses, 'errors': errors,
+                'elapsed': elapsed, 'completed': len(outcomes) - len(failed)}
+
+    # ---- 報告 ----
+
+    def _report(self, result, query_counts, options):
+        elapsed = result['elapsed']
+        endpoints = {}
+        total = 0
+        for endpoint, values in result['latencies'].items():
+            values = sorted(values)
+            total += len(values)
+            endpoints[endpoint] = {
+                'requests': len(values),
+                'errors': result['errors'][endpoint],
+                'status': {str(code): n for code, n in sorted(result['statuses'][endpoint].items())},
+                'p50_ms': round(_percentile(values, 50) * 1000, 1),
+                'p95_ms': round(_percentile(values, 95) * 1000, 1),
+                'p99_ms': round(_percentile(values, 99) * 1000, 1),
+                'mean_ms': round(statistics.fmean(values) * 1000, 1),
+                'max_ms': round(values[-1] * 1000, 1),
+                'rps': round(len(values) / elapsed, 2) if elapsed else 0,
+                'queries': query_counts[endpoint],
+                'queries_per_request': round(query_counts[endpoint] / len(values), 2),
+            }
+        return {
+            'config': {key: options[key] for key in ('students', 'questions', 'ai_questions', 'concurrency',
+                                                     'think', 'ai_latency', 'seed')},
+            'students_completed': result['completed'],
+            'elapsed_seconds': round(elapsed, 3),
+            'requests': total,
+            'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+            'errors': sum(result['errors'].values()),
+            'endpoints': endpoints,
+        }
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, Q
+
+from room.papers import paper_totals_queryset, refresh_paper_totals
+
+
+class Command(BaseCommand):
+    help = "重算 ExamPaper.total_points / ai_total_limit（題目配分與 AI 次數加總）；--verify 只檢查不寫入"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paper_ids', nargs='*', type=int, help="考卷 ID；不指定時處理全部考卷")
+        parser.add_argument('--verify', action='store_true', help="只列出與題目加總不一致的考卷，有不一致時回傳錯誤")
+
+    def handle(self, *args, **options):
+        paper_ids = options['paper_ids'] or None
+        papers = paper_totals_queryset()
+        if paper_ids:
+            papers = papers.filter(id__in=paper_ids)
+        stale = list(
+            papers.filter(~Q(total_points=F('computed_total_points')) | ~Q(ai_total_limit=F('computed_ai_total_limit')))
+            .values_list('id', 'title', 'total_points', 'computed_total_points', 'ai_total_limit', 'computed_ai_total_limit')
+        )
+        for pid, title, points, expected_points, ai_total, expected_ai in stale:
+            self.stdout.write(
+                f"考卷 {pid}「{title}」：總分 {points} → {expected_points}，AI 總額度 {ai_total} → {expected_ai}"
+            )
+
+        if options['verify']:
+            if stale:
+                raise CommandError(f"{len(stale)} 張考卷的加總與題目不一致")
+            self.stdout.write(self.style.SUCCESS("所有考卷的加總皆正確"))
+            return
+
+        updated = refresh_paper_totals(paper_ids)
+        self.stdout.write(self.style.SUCCESS(f"已重算 {updated} 張考卷（其中 {len(stale)} 張原本不一致）"))
@@ -0,0 +1,44 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from room.models import ExamPaper
+from room.regrade import regrade_paper, regrade_questions
+
+
+class Command(BaseCommand):
+    help = "依目前的正解重新判分（修改題目正解或配分後使用），並重算總分"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paper_ids', nargs='*', type=int, help="考卷 ID；可指定多個")
+        parser.add_argument('--question', type=int, action='append', default=[],
+                            help="只重新判分指定題目（可重複；不指定考卷時涵蓋所有考卷）")
+        parser.add_argument('--dry-run', action='store_true', help="只計算會改變的筆數，不寫入")
+
+    def handle(self, *args, **options):
+        paper_ids = options['paper_ids']
+        question_ids = options['question']
+        if not paper_ids and not question_ids:
+            raise CommandError("請指定考卷 ID 或 --question")
+        missing = set(paper_ids) - set(ExamPaper.objects.filter(id__in=paper_ids).values_list('id', flat=True))
+        if missing:
+            raise CommandError(f"考卷不存在：{sorted(missing)}")
+
+        commit = not options['dry_run']
+        started = time.perf_counter()
+        try:
+            if question_ids:
+                results = [regrade_questions(question_ids, paper_id=pid, commit=commit) for pid in paper_ids or [None]]
+            else:
+                results = [regrade_paper(pid, commit=commit) for pid in paper_ids]
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        checked = sum(r['answers'] for r in results)
+        changed = sum(r['changed'] for r in results)
+        papers = sorted({pid for r in results for pid in r['papers']})
+        verb = "將改變" if options['dry_run'] else "已更新"
+        self.stdout.write(self.style.SUCCESS(
+            f"檢查 {checked} 筆作答，{verb} {changed} 筆，影響考卷 {papers}（{time.perf_counter() - started:.2f}s）"
+        ))
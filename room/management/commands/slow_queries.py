@@ -0,0 +1,45 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from room import slowlog
+
+
+class Command(BaseCommand):
+    help = "彙總慢查詢記錄（SLOW_QUERY_LOG['PATH'] 各行程的檔案與輪替的舊檔）：依 SQL 形狀與呼叫位置合併排序"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help="記錄檔路徑；預設為 SLOW_QUERY_LOG['PATH']")
+        parser.add_argument('--view', help="只看指定路由名稱（例如 room:teacher_exam）")
+        parser.add_argument('--sort', choices=['total', 'count', 'max'], default='total',
+                            help="total：總耗時；count：總執行次數；max：單次最慢")
+        parser.add_argument('--limit', type=int, default=20)
+
+    def handle(self, *args, **options):
+        path = options['path'] or slowlog.options()['PATH']
+        groups = defaultdict(lambda: {'entries': 0, 'count': 0, 'slow': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                      'max_per_request': 0, 'views': set()})
+        for entry in slowlog.read_entries(path):
+            if options['view'] and entry.get('view') != options['view']:
+                continue
+            group = groups[entry['shape'], entry['callsite'], entry['function']]
+            group['entries'] += 1
+            group['count'] += entry['count']
+            group['slow'] += entry['slow']
+            group['total_ms'] += entry['total_ms']
+            group['max_ms'] = max(group['max_ms'], entry['max_ms'])
+            group['max_per_request'] = max(group['max_per_request'], entry['count'])
+            group['views'].add(entry.get('view') or '-')
+        if not groups:
+            raise CommandError(f"{path} 沒有符合的記錄")
+
+        sort_key = {'total': 'total_ms', 'count': 'count', 'max': 'max_ms'}[options['sort']]
+        ranked = sorted(groups.items(), key=lambda item: item[1][sort_key], reverse=True)
+        for (sql_shape, callsite, function), group in ranked[:options['limit']]:
+            self.stdout.write(self.style.WARNING(f"{callsite or '<專案外>'} {function or ''}".rstrip()))
+            self.stdout.write(
+                f"  總耗時 {group['total_ms']:.1f}ms，執行 {group['count']} 次（慢查詢 {group['slow']} 次），"
+                f"單次最慢 {group['max_ms']:.1f}ms；{group['entries']} 筆記錄，單一請求最多 {group['max_per_request']} 次"
+            )
+            self.stdout.write(f"  路由：{', '.join(sorted(group['views']))}")
+            self.stdout.write(f"  {sql_shape}")
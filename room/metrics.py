@@ -0,0 +1,431 @@
+"""
+Prometheus 格式的指標（/metrics）。
+
+請求路徑只更新行程內的累計值；多 worker 時由背景 flusher 每 FLUSH_INTERVAL 秒把
+增量推到共用後端，/metrics 輸出所有 worker 的合計，不會因 scrape 打到哪個 worker 而跳動：
+
+- Counter / Histogram：以增量累加（redis 用 HINCRBYFLOAT），worker 重啟後累計值仍保留
+- Gauge（連線數、排隊數等「行程當下的狀態」）：每個行程各寫一份快照並設 TTL，
+  輸出時加總仍存活的行程，行程結束後快照自然過期
+- collector：已有 stats() 的模組（AI 回覆快取、排程器、single-flight）在 flush 時回報；
+  Counter 型的數值是行程內累計值，會換算成增量再累加
+
+另外以 connection_created 在每條資料庫連線掛上 execute wrapper，配合 MetricsMiddleware
+記錄每個請求的查詢數與查詢時間（contextvar 會帶進 sync_to_async 的 thread）。
+後端由 settings.METRICS 選擇：'memory'（單一行程 / 測試）/ 'redis'（多 worker）。
+"""
+import contextvars
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKEND': 'redis',
+    'FLUSH_INTERVAL': 5.0,   # 秒；gauge 快照的 TTL 為其 3 倍
+    'KEY_PREFIX': 'metrics',
+    'TOKEN': None,           # 設定後 /metrics 需帶 Authorization: Bearer <TOKEN>
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_registry = {}           # 指標名稱 -> 指標
+_collectors = []
+_pending = {}            # (sample 名稱, labels) -> 尚未推送的增量
+_gauges = {}             # (sample 名稱, labels) -> 本行程的目前值
+_collected = {}          # collector 回報的 Counter 上次累計值
+_lock = threading.Lock()
+
+
+def _label_key(metric, labels):
+    if set(labels) != set(metric.labels):
+        raise ValueError(f"{metric.name} 的 labels 應為 {metric.labels}，收到 {tuple(labels)}")
+    return tuple((name, str(labels[name])) for name in metric.labels)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        if name in _registry:
+            raise ValueError(f"指標 {name} 已註冊")
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        _registry[name] = self
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = (self.name, _label_key(self, labels))
+        with _lock:
+            _pending[key] = _pending.get(key, 0) + value
+        _ensure_flusher()
+
+
+class Gauge(_Metric):
+    """行程內的目前值；各 worker 的值在輸出時加總。"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            _gauges[(self.name, _label_key(self, labels))] = value
+        _ensure_flusher()
+
+    def inc(self, value=1, **labels):
+        key = (self.name, _label_key(self, labels))
+        with _lock:
+            _gauges[key] = _gauges.get(key, 0) + value
+        _ensure_flusher()
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        label_key = _label_key(self, labels)
+        with _lock:
+            # 只累加 value 落入的 bucket（le >= value）；輸出時補齊其餘 bucket 為 0
+            for bound in self.buckets:
+                if value <= bound:
+                    key = (f'{self.name}_bucket', label_key + (('le', _format_value(bound)),))
+                    _pending[key] = _pending.get(key, 0) + 1
+            for suffix, amount in (('_bucket', 1), ('_sum', value), ('_count', 1)):
+                key = (self.name + suffix, label_key + ((('le', '+Inf'),) if suffix == '_bucket' else ()))
+                _pending[key] = _pending.get(key, 0) + amount
+        _ensure_flusher()
+
+
+def register_collector(fn):
+    """fn() 回傳 [(指標, labels dict, 值), ...]：Counter 為行程內累計值，Gauge 為目前值。"""
+    _collectors.append(fn)
+    return fn
+
+
+def _run_collectors():
+    for collector in _collectors:
+        try:
+            samples = list(collector())
+        except Exception:
+            logger.warning("metrics collector 失敗：%r", collector, exc_info=True)
+            continue
+        with _lock:
+            for metric, labels, value in samples:
+                key = (metric.name, _label_key(metric, labels))
+                if metric.kind == 'gauge':
+                    _gauges[key] = value
+                    continue
+                last = _collected.get(key, 0)
+                # 來源重設（例如 scheduler.configure()）時數值會變小：視為從 0 重新累計
+                delta = value - last if value >= last else value
+                _collected[key] = value
+                if delta:
+                    _pending[key] = _pending.get(key, 0) + delta
+
+
+def _take_pending():
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+        gauges = dict(_gauges)
+    return pending, gauges
+
+
+def _restore_pending(pending):
+    with _lock:
+        for key, value in pending.items():
+            _pending[key] = _pending.get(key, 0) + value
+
+
+# ---- 後端 ----
+
+class MemoryMetrics:
+    shared = False
+
+    def __init__(self, options):
+        self._samples = {}
+        self._gauges = {}
+
+    def push(self, worker, deltas, gauges):
+        for key, value in deltas.items():
+            self._samples[key] = self._samples.get(key, 0) + value
+        self._gauges[worker] = gauges
+
+    def read(self):
+        return dict(self._samples), list(self._gauges.values())
+
+
+class RedisMetrics:
+    shared = True
+
+    def __init__(self, options):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImproperlyConfigured("METRICS 使用 redis 後端需要安裝 redis 套件") from e
+        self._client = redis.Redis.from_url(options.get('REDIS_URL') or settings.REDIS_URL)
+        prefix = options['KEY_PREFIX']
+        self._samples_key = f'{prefix}:samples'
+        self._workers_key = f'{prefix}:workers'
+        self._gauge_prefix = f'{prefix}:gauges:'
+        self._gauge_ttl_ms = int(max(options['FLUSH_INTERVAL'] * 3, 15) * 1000)
+
+    @staticmethod
+    def _field(key):
+        name, labels = key
+        return json.dumps([name, labels], ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def _unfield(field):
+        name, labels = json.loads(field)
+        return name, tuple(tuple(pair) for pair in labels)
+
+    def push(self, worker, deltas, gauges):
+        pipe = self._client.pipeline(transaction=False)
+        for key, value in deltas.items():
+            pipe.hincrbyfloat(self._samples_key, self._field(key), value)
+        gauge_key = self._gauge_prefix + worker
+        pipe.delete(gauge_key)
+        if gauges:
+            pipe.hset(gauge_key, mapping={self._field(key): value for key, value in gauges.items()})
+            pipe.pexpire(gauge_key, self._gauge_ttl_ms)
+        pipe.sadd(self._workers_key, worker)
+        pipe.execute()
+
+    def read(self):
+        samples = {self._unfield(f): float(v) for f, v in self._client.hgetall(self._samples_key).items()}
+        workers = [w.decode() for w in self._client.smembers(self._workers_key)]
+        pipe = self._client.pipeline(transaction=False)
+        for worker in workers:
+            pipe.hgetall(self._gauge_prefix + worker)
+        snapshots = []
+        for worker, raw in zip(workers, pipe.execute()):
+            if raw:
+                snapshots.append({self._unfield(f): float(v) for f, v in raw.items()})
+            else:
+                self._client.srem(self._workers_key, worker)   # 快照已過期：行程已結束
+        return samples, snapshots
+
+
+BACKENDS = {
+    'memory': MemoryMetrics,
+    'redis': RedisMetrics,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+_flusher = None
+_flusher_pid = None
+
+
+def _options():
+    return {**DEFAULTS, **getattr(settings, 'METRICS', {})}
+
+
+def auth_token():
+    return _options()['TOKEN']
+
+
+def _build(options):
+    try:
+        backend = BACKENDS[options['BACKEND']]
+    except KeyError:
+        raise ImproperlyConfigured(f"未知的 METRICS 後端：{options['BACKEND']}")
+    return backend(options)
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _build(_options())
+    return _backend
+
+
+def configure(**options):
+    """以 options 建立的後端取代 settings.METRICS 的後端（壓測用；不帶參數即恢復依 settings 建立）。"""
+    global _backend
+    with _backend_lock:
+        _backend = _build({**DEFAULTS, **options}) if options else None
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting == 'METRICS':
+        _backend = None
+
+
+def _worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def flush():
+    """執行 collectors 並把累積的增量與 gauge 快照推到後端；推送失敗時保留到下次。"""
+    _run_collectors()
+    pending, gauges = _take_pending()
+    try:
+        get_backend().push(_worker_id(), pending, gauges)
+    except Exception:
+        _restore_pending(pending)
+        raise
+
+
+def _run_flusher(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except Exception:
+            logger.warning("推送指標失敗，下次再試", exc_info=True)
+
+
+def _ensure_flusher():
+    """共用後端才需要背景推送；fork 出來的 worker（pid 改變）各自啟動一條。"""
+    global _flusher, _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _backend_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    try:
+        shared = get_backend().shared
+    except ImproperlyConfigured:
+        logger.exception("METRICS 設定錯誤，不推送指標")
+        return
+    if shared:
+        _flusher = threading.Thread(target=_run_flusher, args=(_options()['FLUSH_INTERVAL'],),
+                                    name='metrics-flusher', daemon=True)
+        _flusher.start()
+
+
+# ---- 輸出 ----
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_sample(name, labels, value) -> str:
+    if labels:
+        inner = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+        return f'{name}{{{inner}}} {_format_value(value)}'
+    return f'{name} {_format_value(value)}'
+
+
+def render() -> str:
+    """所有 worker 合計後的 Prometheus text format（0.0.4）。"""
+    flush()
+    samples, snapshots = get_backend().read()
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            samples[key] = samples.get(key, 0) + value
+
+    lines = []
+    for name, metric in sorted(_registry.items()):
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        if metric.kind != 'histogram':
+            for (sample, labels), value in sorted(samples.items()):
+                if sample == name:
+                    lines.append(_format_sample(name, labels, value))
+            continue
+        label_sets = sorted(labels for (sample, labels) in samples if sample == f'{name}_count')
+        for labels in label_sets:
+            for bound in metric.buckets + (math.inf,):
+                le = (('le', _format_value(bound)),)
+                value = samples.get((f'{name}_bucket', labels + le), 0)
+                lines.append(_format_sample(f'{name}_bucket', labels + le, value))
+            lines.append(_format_sample(f'{name}_sum', labels, samples[(f'{name}_sum', labels)]))
+            lines.append(_format_sample(f'{name}_count', labels, samples[(f'{name}_count', labels)]))
+    return '\n'.join(lines) + '\n'
+
+
+# ---- 請求與資料庫 ----
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', "請求處理時間（到回應物件產生為止；串流回應不含傳送本文）",
+    labels=('view', 'method', 'status'),
+)
+DB_QUERIES = Histogram(
+    'http_request_db_queries', "每個請求的 SQL 查詢數", labels=('view',), buckets=COUNT_BUCKETS,
+)
+DB_SECONDS = Histogram(
+    'http_request_db_seconds', "每個請求的 SQL 查詢總時間", labels=('view',),
+)
+
+
+class _RequestStats:
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+_request_stats = contextvars.ContextVar('metrics_request_stats', default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.seconds += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def _instrument_connection(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def begin_request():
+    return _request_stats.set(_RequestStats()), time.perf_counter()
+
+
+def end_request(request, response, state):
+    token, started = state
+    elapsed = time.perf_counter() - started
+    stats = _request_stats.get()
+    _request_stats.reset(token)
+    # 以路由名稱為 label（404 等未對應路由的請求合併），避免路徑參數造成 label 爆量
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match is not None else '<unresolved>'
+    HTTP_REQUEST_SECONDS.observe(elapsed, view=view, method=request.method, status=response.status_code)
+    DB_QUERIES.observe(stats.queries, view=view)
+    DB_SECONDS.observe(stats.seconds, view=view)
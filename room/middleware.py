@@ -0,0 +1,61 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import metrics, slowlog
+
+
+class MetricsMiddleware:
+    """記錄每個請求的處理時間與 SQL 查詢數 / 時間（依路由名稱），輸出於 /metrics。"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # async view 走 async 路徑，不多一次 thread 切換
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state = metrics.begin_request()
+        response = self.get_response(request)
+        metrics.end_request(request, response, state)
+        return response
+
+    async def __acall__(self, request):
+        state = metrics.begin_request()
+        response = await self.get_response(request)
+        metrics.end_request(request, response, state)
+        return response
+
+
+class SlowQueryLogMiddleware:
+    """每個請求結束時寫入慢查詢與重複查詢（room.slowlog）；SLOW_QUERY_LOG['ENABLED'] 為 False 時停用。"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not slowlog.options()['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token = slowlog.begin_request()
+        response = self.get_response(request)
+        slowlog.end_request(request, response, token)
+        return response
+
+    async def __acall__(self, request):
+        token = slowlog.begin_request()
+        response = await self.get_response(request)
+        slowlog.end_request(request, response, token)
+        return response
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='exampaper',
+            index=models.Index(fields=['publish_time', 'end_time'], name='exampaper_open_window_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exampaper',
+            index=models.Index(fields=['end_time'], name='exampaper_end_time_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:30
+
+from django.db import migrations, models
+from django.db.models import IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_paper_totals(apps, schema_editor):
+    ExamPaper = apps.get_model('room', 'ExamPaper')
+    through = ExamPaper.questions.through
+
+    def question_sum(field):
+        total = (
+            through.objects.filter(exampaper_id=OuterRef('pk'))
+            .values('exampaper_id')
+            .annotate(total=Sum(f'examquestion__{field}'))
+            .values('total')
+        )
+        return Coalesce(Subquery(total, output_field=IntegerField()), Value(0))
+
+    ExamPaper.objects.update(total_points=question_sum('points'), ai_total_limit=question_sum('ai_limit'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0002_exampaper_time_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exampaper',
+            name='ai_total_limit',
+            field=models.PositiveIntegerField(default=0, verbose_name='AI 問答總額度'),
+        ),
+        migrations.RunPython(backfill_paper_totals, migrations.RunPython.noop),
+    ]
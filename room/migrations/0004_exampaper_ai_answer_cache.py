@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0003_exampaper_ai_total_limit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exampaper',
+            name='ai_answer_cache',
+            field=models.BooleanField(default=False, verbose_name='AI 回覆快取'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0004_exampaper_ai_answer_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exampaper',
+            name='curve',
+            field=models.JSONField(blank=True, null=True, verbose_name='總分曲線'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:42
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0005_exampaper_curve'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='interactionlog',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='創建時間'),
+        ),
+    ]
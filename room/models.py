@@ -46,7 +46,9 @@ class ExamQuestion(models.Model):
 class ExamPaper(models.Model):
     title = models.CharField(max_length=200, verbose_name="考卷名稱")
     questions = models.ManyToManyField(ExamQuestion, verbose_name="包含題目")
+    # 以下兩欄為題目加總的反正規化，由 room.signals 在題目 / 考卷題目集合變動時維護
     total_points = models.IntegerField(default=0, verbose_name="總分")
+    ai_total_limit = models.PositiveIntegerField(default=0, verbose_name="AI 問答總額度")
     created_by = models.ForeignKey(CustomUser, on_delete=models.CASCADE, verbose_name="創建者")
     publish_time = models.DateTimeField(default=timezone.now, verbose_name="發佈時間")
     start_time = models.DateTimeField(default=timezone.now, verbose_name="開始時間")
@@ -54,6 +56,10 @@ class ExamPaper(models.Model):
     pdf_file = models.FileField(upload_to='exam_papers/', null=True, blank=True, verbose_name="考卷 PDF")
     duration_minutes = models.IntegerField(default=60, validators=[MinValueValidator(1)], verbose_name="考試持續時間（分鐘）")
     description = models.TextField(blank=True, default='', verbose_name="考試描述")
+    # 啟用後同一題的重複 / 近似提問直接回傳快取的 AI 回覆（gemini_api.answer_cache）
+    ai_answer_cache = models.BooleanField(default=False, verbose_name="AI 回覆快取")
+    # 套用中的總分曲線 {"method", "params", "never_lower"}（room.regrade.apply_curve）；每次重算總分都會再套用
+    curve = models.JSONField(null=True, blank=True, verbose_name="總分曲線")
 
     def __str__(self):
         return self.title
@@ -61,6 +67,11 @@ class ExamPaper(models.Model):
     class Meta:
         verbose_name = "考卷"
         verbose_name_plural = "考卷"
+        indexes = [
+            # select_exam / exam 以「已發佈且未截止」篩選進行中的考卷
+            models.Index(fields=['publish_time', 'end_time'], name='exampaper_open_window_idx'),
+            models.Index(fields=['end_time'], name='exampaper_end_time_idx'),
+        ]
 
 class InteractionLog(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, verbose_name="使用者")
@@ -69,7 +80,8 @@ class InteractionLog(models.Model):
     exam_question = models.ForeignKey(ExamQuestion, on_delete=models.CASCADE, null=True, blank=True, verbose_name="相關題目")
     exam_paper = models.ForeignKey(ExamPaper, on_delete=models.CASCADE, null=True, blank=True, verbose_name="相關考卷")
     score = models.IntegerField(default=0, verbose_name="得分")
-    created_at = models.DateTimeField(auto_now_add=True, verbose_name="創建時間")
+    # 建立物件時即取得時間；寫入可能經由 room.logsink 延後，auto_now_add 會變成寫入時間
+    created_at = models.DateTimeField(default=timezone.now, verbose_name="創建時間")
 
     def __str__(self):
         return f"{self.user.username} - {self.question[:50]}"
@@ -133,7 +145,8 @@ class StudentExamHistory(models.Model):
         if not self.exam_paper_name:
             self.exam_paper_name = self.exam_paper.title
         if not self.question_content:
-            self.question_content = self.exam_paper.questions.first().content if self.exam_paper.questions.exists() else ""
+            first_content = self.exam_paper.questions.values_list('content', flat=True).first()
+            self.question_content = first_content or ""
         super().save(*args, **kwargs)
 
     class Meta:
@@ -0,0 +1,94 @@
+"""
+進行中考卷索引（publish_time <= now < end_time）。
+
+select_exam 與 exam 共用同一份快取（settings.CACHES，正式環境為所有 worker 共用的 Redis），
+考試開始時大量登入只會命中快取。
+快取在下一個發佈 / 截止時間點自動過期；考卷儲存、刪除、題目異動或
+end_exam 時由 room.signals 呼叫 invalidate_active_papers() 主動清除。
+
+ExamPaper.total_points / ai_total_limit 為題目配分與 AI 次數的加總，
+由 refresh_paper_totals() 在題目或題目集合變動時重算，讀取端不必再走題目關聯表。
+"""
+from django.core.cache import cache
+from django.db.models import Count, IntegerField, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+ACTIVE_PAPERS_CACHE_KEY = 'papers:active'
+ACTIVE_PAPERS_MAX_AGE = 300  # 秒；即使沒有時間邊界也定期重建
+
+
+def _build_index(now):
+    from .models import ExamPaper
+
+    papers = list(
+        ExamPaper.objects.filter(publish_time__lte=now, end_time__gt=now)
+        .annotate(question_count=Count('questions'))
+        .order_by('id')
+    )
+    boundaries = [p.end_time for p in papers]
+    next_publish = ExamPaper.objects.filter(publish_time__gt=now).aggregate(t=Min('publish_time'))['t']
+    if next_publish:
+        boundaries.append(next_publish)
+
+    expires_at = now + timezone.timedelta(seconds=ACTIVE_PAPERS_MAX_AGE)
+    if boundaries:
+        expires_at = min(expires_at, min(boundaries))
+    return {'papers': papers, 'expires_at': expires_at}
+
+
+def get_active_papers(now=None):
+    """
+    回傳目前可作答的 ExamPaper 列表（依 id 排序，附 question_count）。
+    未預先載入 questions；需要題目時請自行 prefetch_related_objects。
+    """
+    now = now or timezone.now()
+    index = cache.get(ACTIVE_PAPERS_CACHE_KEY)
+    if index is None or now >= index['expires_at']:
+        index = _build_index(now)
+        timeout = max(1, int((index['expires_at'] - now).total_seconds()) + 1)
+        cache.set(ACTIVE_PAPERS_CACHE_KEY, index, timeout)
+    return [p for p in index['papers'] if p.publish_time <= now < p.end_time]
+
+
+def invalidate_active_papers():
+    cache.delete(ACTIVE_PAPERS_CACHE_KEY)
+
+
+def _question_sum(field):
+    """子查詢：考卷所有題目某欄位的加總（無題目時為 0）。"""
+    from .models import ExamPaper
+
+    through = ExamPaper.questions.through
+    total = (
+        through.objects.filter(exampaper_id=OuterRef('pk'))
+        .values('exampaper_id')
+        .annotate(total=Sum(f'examquestion__{field}'))
+        .values('total')
+    )
+    return Coalesce(Subquery(total, output_field=IntegerField()), Value(0))
+
+
+def paper_totals_queryset():
+    """ExamPaper 附帶 computed_total_points / computed_ai_total_limit（由題目重新加總）。"""
+    from .models import ExamPaper
+
+    return ExamPaper.objects.annotate(
+        computed_total_points=_question_sum('points'),
+        computed_ai_total_limit=_question_sum('ai_limit'),
+    )
+
+
+def refresh_paper_totals(paper_ids=None) -> int:
+    """以單一 UPDATE 重算考卷的 total_points 與 ai_total_limit；paper_ids 為 None 時重算全部。"""
+    from .models import ExamPaper
+
+    papers = ExamPaper.objects.all()
+    if paper_ids is not None:
+        paper_ids = list(paper_ids)
+        if not paper_ids:
+            return 0
+        papers = papers.filter(id__in=paper_ids)
+    updated = papers.update(total_points=_question_sum('points'), ai_total_limit=_question_sum('ai_limit'))
+    invalidate_active_papers()  # 索引快取內的考卷物件帶有舊的加總
+    return updated
@@ -0,0 +1,234 @@
+"""
+熱點 view 的取樣 profiler（教師 / 管理員在 /profiling/ 控制）。
+
+觸發方式（兩者擇一）：
+- 取樣比例：管理頁設定 rate（0 ~ 1）與要觀察的路由名稱（空白 = 全部），依比例隨機挑選請求
+- 簽章 header：請求帶 X-Profile: <token>（管理頁產生，TimestampSigner 簽章，TOKEN_MAX_AGE 秒內有效），
+  該請求一定會被記錄，方便重現特定學生的慢請求
+
+被選中的請求在 view 執行期間由背景 thread 每 INTERVAL 秒讀取該 thread 的堆疊
+（sys._current_frames），累計成 collapsed stacks（「a;b;c 次數」，可直接交給
+flamegraph.pl / speedscope）。結果依路由名稱存入 Django cache，每個路由保留最近 MAX_PROFILES 筆；
+控制設定也存在 cache（行程內快取 CONTROL_TTL 秒）。正式環境的 CACHES 是 REDIS_URL 上的共用快取，
+所有 worker 看到同一份設定與結果。
+
+async view（ai_webhook、ask_ai 等）不取樣：它們在 event loop 上執行，這個 thread 的堆疊只會是
+async_to_sync 等待中的 frame，看不到 view 本身。
+
+settings.PROFILING['ENABLED'] 預設為 False（PROFILING_ENABLED=1 才啟用），停用時 ProfilingMiddleware
+直接移除（MiddlewareNotUsed），不在請求路徑上；啟用但 rate 為 0 且沒有 header 時，每個請求只多一次字典查詢。
+"""
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+
+DEFAULTS = {
+    'ENABLED': False,
+    'INTERVAL': 0.005,      # 秒；取樣間隔
+    'MAX_PROFILES': 20,     # 每個路由保留的筆數
+    'MAX_DEPTH': 128,
+    'CONTROL_TTL': 5,       # 秒；行程內快取控制設定的時間
+    'TOKEN_MAX_AGE': 3600,  # 秒；X-Profile token 有效期
+}
+
+HEADER = 'X-Profile'
+_CONTROL_KEY = 'profiling:control'
+_VIEWS_KEY = 'profiling:views'
+_SIGNER_SALT = 'room.profiling'
+_PROFILE_TIMEOUT = 60 * 60 * 24 * 7
+
+_control = None
+_control_expires = 0.0
+_control_lock = threading.Lock()
+
+# 堆疊中要省略的路徑前綴（Django / 標準函式庫的路徑只留相對路徑）
+_PATH_PREFIXES = sorted({p for p in (str(settings.BASE_DIR), sys.prefix, sys.base_prefix) if p}, key=len,
+                        reverse=True)
+
+
+def options() -> dict:
+    return {**DEFAULTS, **getattr(settings, 'PROFILING', {})}
+
+
+def get_control() -> dict:
+    """{'rate': float, 'views': [路由名稱]}；行程內快取 CONTROL_TTL 秒，避免每個請求讀 cache。"""
+    global _control, _control_expires
+    now = time.monotonic()
+    if _control is None or now >= _control_expires:
+        with _control_lock:
+            if _control is None or now >= _control_expires:
+                _control = cache.get(_CONTROL_KEY) or {'rate': 0.0, 'views': []}
+                _control_expires = now + options()['CONTROL_TTL']
+    return _control
+
+
+def set_control(rate: float, views) -> dict:
+    global _control
+    control = {'rate': min(max(float(rate), 0.0), 1.0), 'views': sorted(set(views))}
+    cache.set(_CONTROL_KEY, control, None)
+    with _control_lock:
+        _control = None   # 本行程立即生效；其他 worker 在 CONTROL_TTL 內生效
+    return control
+
+
+def make_token() -> str:
+    return signing.TimestampSigner(salt=_SIGNER_SALT).sign(uuid.uuid4().hex)
+
+
+def valid_token(token: str) -> bool:
+    try:
+        signing.TimestampSigner(salt=_SIGNER_SALT).unsign(token, max_age=options()['TOKEN_MAX_AGE'])
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def _frame_label(code, lineno) -> str:
+    filename = code.co_filename
+    for prefix in _PATH_PREFIXES:
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):].lstrip(os.sep)
+            break
+    return f'{code.co_name} ({filename}:{lineno})'
+
+
+class Sampler:
+    """在背景 thread 取樣指定 thread 的堆疊，累計成 collapsed stacks。"""
+
+    def __init__(self, thread_id, interval, max_depth):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiling-sampler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None and len(labels) < self.max_depth:
+                labels.append(_frame_label(frame.f_code, frame.f_lineno))
+                frame = frame.f_back
+            if labels:
+                self.stacks[';'.join(reversed(labels))] += 1
+
+
+def _profiles_key(view) -> str:
+    return f'profiling:profiles:{view}'
+
+
+def store(view, profile):
+    """存入該路由最近的 MAX_PROFILES 筆（新的在前）。"""
+    key = _profiles_key(view)
+    profiles = [profile] + (cache.get(key) or [])
+    cache.set(key, profiles[:options()['MAX_PROFILES']], _PROFILE_TIMEOUT)
+    views = cache.get(_VIEWS_KEY) or []
+    if view not in views:
+        cache.set(_VIEWS_KEY, sorted(views + [view]), _PROFILE_TIMEOUT)
+
+
+def views() -> list:
+    return cache.get(_VIEWS_KEY) or []
+
+
+def profiles(view) -> list:
+    return cache.get(_profiles_key(view)) or []
+
+
+def clear():
+    cache.delete_many([_profiles_key(view) for view in views()] + [_VIEWS_KEY])
+
+
+def collapsed(view) -> str:
+    """該路由所有保存筆數合併後的 collapsed stacks（flamegraph.pl / speedscope 可直接讀取）。"""
+    merged = Counter()
+    for profile in profiles(view):
+        merged.update(profile['stacks'])
+    return ''.join(f'{stack} {count}\n' for stack, count in merged.most_common())
+
+
+def top_frames(view, limit=20) -> list:
+    """依 self time（堆疊最內層）排序的函式：[(函式, 取樣數, 比例)]。"""
+    leaves = Counter()
+    for profile in profiles(view):
+        for stack, count in profile['stacks'].items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+    total = sum(leaves.values())
+    return [(frame, count, count / total) for frame, count in leaves.most_common(limit)]
+
+
+class ProfilingMiddleware:
+    """
+    放在 MIDDLEWARE 的同步區段（WhiteNoise 之後）：process_view 與 view 在同一個 thread，
+    取樣的就是 view 本身。
+    """
+
+    def __init__(self, get_response):
+        if not options()['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        sampler = getattr(request, '_profiling_sampler', None)
+        if sampler is not None:
+            sampler.stop()
+            view = request.resolver_match.view_name
+            store(view, {
+                'id': uuid.uuid4().hex,
+                'view': view,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(sampler.elapsed * 1000, 1),
+                'samples': sum(sampler.stacks.values()),
+                'interval_ms': sampler.interval * 1000,
+                'trigger': request._profiling_trigger,
+                'created_at': timezone.now(),
+                'stacks': dict(sampler.stacks),
+            })
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if iscoroutinefunction(view_func):
+            return None   # 取樣這個 thread 只會看到 async_to_sync 在等待
+        token = request.headers.get(HEADER)
+        if token:
+            if not valid_token(token):
+                return None
+            trigger = 'header'
+        else:
+            control = get_control()
+            if not control['rate']:
+                return None
+            if control['views'] and request.resolver_match.view_name not in control['views']:
+                return None
+            if random.random() >= control['rate']:
+                return None
+            trigger = 'rate'
+        opts = options()
+        request._profiling_trigger = trigger
+        request._profiling_sampler = Sampler(threading.get_ident(), opts['INTERVAL'], opts['MAX_DEPTH']).start()
+        return None
@@ -0,0 +1,222 @@
+"""
+AI 提問額度服務。
+
+額度以 (學生, 考卷) 為單位記錄「已使用次數」，剩餘 = ExamPaper.ai_total_limit - 已使用；
+教師調整 ai_limit 後剩餘次數立即反映，不必重設計數器。不再寫入 session：
+換裝置登入不會重置額度，一次檢查只需一次往返。後端由 settings.AI_QUOTA 選擇：
+
+- 'redis'：Lua 腳本原子化「檢查並扣除」，多 worker 共用，不會重複扣用
+- 'memory'：行程內 dict + lock（測試 / 單行程開發用）
+
+未登入的呼叫（例如帶 session_key 的外部 webhook）以 session 為單位計算。
+後端無法連線時丟出 Unavailable：頁面照常顯示（不含剩餘次數），AI 提問回 503。
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKEND': 'redis',
+    'TTL': 60 * 60 * 24 * 14,   # 秒；考試結束後計數器自動過期
+    'KEY_PREFIX': 'ai_quota',
+}
+
+
+class Unavailable(Exception):
+    """額度後端（Redis）暫時無法連線。"""
+
+
+def subject_for(user_id=None, session_key=None) -> str:
+    """額度歸屬：登入者以 user id，否則以 session。"""
+    if user_id:
+        return f"u{user_id}"
+    if session_key:
+        return f"s{session_key}"
+    raise ValueError("需要 user_id 或 session_key 才能計算 AI 額度")
+
+
+class MemoryQuota:
+    def __init__(self, options):
+        self.ttl = options['TTL']
+        self._used = {}   # key -> (used, expires_at)
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        used, expires_at = self._used.get(key, (0, None))
+        if expires_at is not None and now >= expires_at:
+            self._used.pop(key, None)
+            return 0
+        return used
+
+    def consume(self, key, limit):
+        now = time.monotonic()
+        with self._lock:
+            used = self._get(key, now)
+            if used >= limit:
+                return False, 0
+            self._used[key] = (used + 1, now + self.ttl)
+            return True, limit - used - 1
+
+    def refund(self, key, limit):
+        now = time.monotonic()
+        with self._lock:
+            used = self._get(key, now)
+            if used > 0:
+                self._used[key] = (used - 1, now + self.ttl)
+                used -= 1
+            return max(limit - used, 0)
+
+    def used_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return [self._get(key, now) for key in keys]
+
+    def reset(self, key):
+        with self._lock:
+            self._used.pop(key, None)
+
+
+# KEYS[1] = 計數器；ARGV = limit, ttl。回傳扣除後剩餘次數，額度用盡回傳 -1。
+_CONSUME_LUA = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local limit = tonumber(ARGV[1])
+if used >= limit then
+    return -1
+end
+used = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return limit - used
+"""
+
+# 回補一次（不低於 0）；回傳回補後的剩餘次數。
+_REFUND_LUA = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used > 0 then
+    used = redis.call('DECR', KEYS[1])
+end
+local remaining = tonumber(ARGV[1]) - used
+if remaining < 0 then
+    return 0
+end
+return remaining
+"""
+
+
+class RedisQuota:
+    def __init__(self, options):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImproperlyConfigured("AI_QUOTA 使用 redis 後端需要安裝 redis 套件") from e
+        self.ttl = options['TTL']
+        self._redis_error = redis.RedisError
+        self._client = redis.Redis.from_url(options.get('REDIS_URL') or settings.REDIS_URL)
+        self._consume = self._client.register_script(_CONSUME_LUA)
+        self._refund = self._client.register_script(_REFUND_LUA)
+
+    @contextmanager
+    def _available(self):
+        try:
+            yield
+        except self._redis_error as exc:
+            raise Unavailable(f"AI 額度服務暫時無法使用：{exc}") from exc
+
+    def consume(self, key, limit):
+        with self._available():
+            remaining = int(self._consume(keys=[key], args=[limit, self.ttl]))
+        if remaining < 0:
+            return False, 0
+        return True, remaining
+
+    def refund(self, key, limit):
+        with self._available():
+            return int(self._refund(keys=[key], args=[limit]))
+
+    def used_many(self, keys):
+        if not keys:
+            return []
+        with self._available():
+            values = self._client.mget(keys)
+        return [int(v) if v is not None else 0 for v in values]
+
+    def reset(self, key):
+        with self._available():
+            self._client.delete(key)
+
+
+BACKENDS = {
+    'memory': MemoryQuota,
+    'redis': RedisQuota,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+_key_prefix = DEFAULTS['KEY_PREFIX']
+
+
+def get_backend():
+    global _backend, _key_prefix
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                options = {**DEFAULTS, **getattr(settings, 'AI_QUOTA', {})}
+                try:
+                    backend = BACKENDS[options['BACKEND']]
+                except KeyError:
+                    raise ImproperlyConfigured(f"未知的 AI_QUOTA 後端：{options['BACKEND']}")
+                _key_prefix = options['KEY_PREFIX']
+                _backend = backend(options)
+    return _backend
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting == 'AI_QUOTA':
+        _backend = None
+
+
+def _key(subject, paper_id) -> str:
+    return f"{_key_prefix}:{paper_id}:{subject}"
+
+
+def consume(subject, paper_id, limit):
+    """原子化檢查並扣 1 次；回傳 (ok, remaining)。"""
+    backend = get_backend()
+    return backend.consume(_key(subject, paper_id), limit)
+
+
+def refund(subject, paper_id, limit) -> int:
+    """AI 呼叫失敗時回補剛扣的 1 次；回傳剩餘次數。"""
+    backend = get_backend()
+    return backend.refund(_key(subject, paper_id), limit)
+
+
+def try_refund(subject, paper_id, limit):
+    """refund()，但額度服務無法連線時只記錄警告並回傳 None（AI 的錯誤才是要回給使用者的）。"""
+    try:
+        return refund(subject, paper_id, limit)
+    except Unavailable as exc:
+        logger.warning("AI 額度回補失敗（%s, 考卷 %s）：%s", subject, paper_id, exc)
+        return None
+
+
+def remaining_many(subject, limits: dict) -> dict:
+    """{paper_id: limit} → {paper_id: remaining}；多張考卷一次讀取。"""
+    backend = get_backend()
+    paper_ids = list(limits)
+    used = backend.used_many([_key(subject, pid) for pid in paper_ids])
+    return {pid: max(limits[pid] - u, 0) for pid, u in zip(paper_ids, used)}
+
+
+def reset(subject, paper_id):
+    backend = get_backend()
+    backend.reset(_key(subject, paper_id))
@@ -0,0 +1,341 @@
+"""
+整卷調分：單題覆寫、單題加減分、總分曲線（線性 / 百分位）。
+
+所有調整都在單一 transaction 內完成：單題調整以一次 UPDATE 套用到整張考卷，
+個別學生調分以 bulk_update 寫入；總分以一次 GROUP BY 聚合重算，再 bulk_update
+回 ExamRecord 與 StudentExamHistory。
+
+曲線只調整總分（ExamRecord.score / StudentExamHistory.total_score），各題得分維持原樣；
+曲線設定存於 ExamPaper.curve，之後每次重算總分（單題調整、個別調分、重新判分）都會再套用，
+直到 clear_curve 移除。
+
+正解修改後的重新判分（regrade_questions / regrade_paper）以 NumPy 向量化：
+不重複的答案字串只解析一次（單選值、多選位元遮罩、是非、簡答文字），
+其餘全部是陣列索引與比較；只有結果改變的答案會被寫回。
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Greatest, Least
+
+from .grading import compile_question, decode_stored_answer, is_blank, normalize_text, parse_option_mask, parse_tf
+from .models import ExamAnswer, ExamPaper, ExamQuestion, ExamRecord, StudentExamHistory
+from .submission import grade_letter
+
+CURVE_METHODS = ('linear', 'percentile')
+
+
+class RegradeError(ValueError):
+    """調分參數錯誤。"""
+
+
+def _raw_totals(paper_id) -> dict:
+    """{exam_record_id: 各題得分加總}；單一聚合查詢。"""
+    return dict(
+        ExamAnswer.objects.filter(exam_record__exam_paper_id=paper_id)
+        .values_list('exam_record_id')
+        .annotate(total=Sum('score'))
+        .order_by()
+    )
+
+
+def _write_totals(paper_id, new_totals: dict) -> int:
+    """把 {exam_record_id: total} 寫回 ExamRecord 與 StudentExamHistory；回傳有變動的紀錄數。"""
+    records = list(ExamRecord.objects.filter(exam_paper_id=paper_id).only('id', 'student_id', 'score'))
+    changed = []
+    totals_by_student = {}
+    for record in records:
+        total = new_totals.get(record.id, 0)
+        totals_by_student[record.student_id] = total
+        if record.score != total:
+            record.score = total
+            changed.append(record)
+    ExamRecord.objects.bulk_update(changed, ['score'], batch_size=500)
+
+    histories = list(StudentExamHistory.objects.filter(exam_paper_id=paper_id, student_id__in=totals_by_student)
+                     .only('id', 'student_id', 'total_score', 'grade'))
+    for history in histories:
+        history.total_score = totals_by_student[history.student_id]
+        history.grade = grade_letter(history.total_score)
+    StudentExamHistory.objects.bulk_update(histories, ['total_score', 'grade'], batch_size=500)
+    return len(changed)
+
+
+def _curved(raw: dict, curve: dict, cap) -> dict:
+    curved = (_linear if curve['method'] == 'linear' else _percentile)(raw, **curve['params'])
+    totals = {}
+    for rid, value in curved.items():
+        value = min(max(round(value), 0), cap)
+        totals[rid] = max(value, raw[rid]) if curve['never_lower'] else value
+    return totals
+
+
+def recompute_totals(paper_id) -> int:
+    """依各題得分重算整張考卷的總分；考卷有曲線（ExamPaper.curve）時再套用曲線。"""
+    raw = _raw_totals(paper_id)
+    curve, cap = ExamPaper.objects.values_list('curve', 'total_points').get(pk=paper_id)
+    return _write_totals(paper_id, _curved(raw, curve, cap) if curve else raw)
+
+
+def _question_in_paper(paper_id, question_id) -> ExamQuestion:
+    question = ExamQuestion.objects.filter(id=question_id, exampaper__id=paper_id).first()
+    if question is None:
+        raise RegradeError("題目不在此考卷中。")
+    return question
+
+
+def override_question(paper_id, question_id, score) -> int:
+    """把某題所有學生的得分設為 score（0 ~ 配分，滿分視為正確）。回傳更新的答案數。"""
+    question = _question_in_paper(paper_id, question_id)
+    if not 0 <= score <= question.points:
+        raise RegradeError(f"分數需介於 0 到 {question.points}。")
+    with transaction.atomic():
+        updated = ExamAnswer.objects.filter(
+            exam_record__exam_paper_id=paper_id, exam_question_id=question_id
+        ).update(score=score, is_correct=(score == question.points))
+        recompute_totals(paper_id)
+    return updated
+
+
+def shift_question(paper_id, question_id, delta) -> int:
+    """某題所有學生加減 delta 分（限制在 0 ~ 配分）。回傳更新的答案數。"""
+    question = _question_in_paper(paper_id, question_id)
+    with transaction.atomic():
+        answers = ExamAnswer.objects.filter(exam_record__exam_paper_id=paper_id, exam_question_id=question_id)
+        updated = answers.update(score=Least(Greatest(F('score') + delta, Value(0)), Value(question.points)))
+        answers.update(is_correct=False)
+        answers.filter(score=question.points).update(is_correct=True)
+        recompute_totals(paper_id)
+    return updated
+
+
+def set_record_scores(exam_record, scores: dict):
+    """
+    單一學生逐題調分：scores 為 {question_id: score}，超出 0 ~ 配分者略過。
+    回傳 (新總分, 被略過的 question_id 列表)。
+    """
+    answers = list(exam_record.answer_details.select_related('exam_question'))
+    changed, rejected = [], []
+    for answer in answers:
+        if answer.exam_question_id not in scores:
+            continue
+        new_score = scores[answer.exam_question_id]
+        max_score = answer.exam_question.points
+        if not 0 <= new_score <= max_score:
+            rejected.append(answer.exam_question_id)
+            continue
+        answer.score = new_score
+        answer.is_correct = (new_score == max_score)  # 滿分視為正確
+        changed.append(answer)
+
+    total = sum(a.score for a in answers)
+    curved = ExamPaper.objects.filter(pk=exam_record.exam_paper_id, curve__isnull=False).exists()
+    with transaction.atomic():
+        ExamAnswer.objects.bulk_update(changed, ['score', 'is_correct'])
+        if curved:
+            # 百分位曲線與所有人的分數有關：整張考卷重算
+            recompute_totals(exam_record.exam_paper_id)
+            total = ExamRecord.objects.values_list('score', flat=True).get(pk=exam_record.pk)
+        else:
+            ExamRecord.objects.filter(pk=exam_record.pk).update(score=total)
+            StudentExamHistory.objects.filter(
+                student_id=exam_record.student_id, exam_paper_id=exam_record.exam_paper_id
+            ).update(total_score=total, grade=grade_letter(total))
+    exam_record.score = total
+    return total, rejected
+
+
+def _linear(raw: dict, scale=1.0, offset=0.0, **_):
+    return {rid: scale * total + offset for rid, total in raw.items()}
+
+
+def _percentile(raw: dict, floor=60.0, ceiling=100.0, **_):
+    """依名次百分位把總分映射到 [floor, ceiling]；同分者取平均名次。"""
+    ordered = sorted(raw.values())
+    n = len(ordered)
+    first_index, last_index = {}, {}
+    for i, total in enumerate(ordered):
+        first_index.setdefault(total, i)
+        last_index[total] = i
+    curved = {}
+    for rid, total in raw.items():
+        rank = (first_index[total] + last_index[total]) / 2
+        pct = rank / (n - 1) if n > 1 else 1.0
+        curved[rid] = floor + pct * (ceiling - floor)
+    return curved
+
+
+def apply_curve(paper_id, method, never_lower=True, **params) -> int:
+    """
+    對整張考卷的總分套用曲線（取代先前的曲線），並存入 ExamPaper.curve 供之後重算時再套用。
+    - linear：new = scale * raw + offset
+    - percentile：new = floor + 百分位 * (ceiling - floor)
+    結果四捨五入並限制在 0 ~ 考卷總分；never_lower=True 時不會低於原始分數。
+    回傳有變動的紀錄數。
+    """
+    if method not in CURVE_METHODS:
+        raise RegradeError(f"未知的曲線方式：{method}")
+    curve = {'method': method, 'params': params, 'never_lower': bool(never_lower)}
+    with transaction.atomic():
+        ExamPaper.objects.filter(pk=paper_id).update(curve=curve)
+        return recompute_totals(paper_id)
+
+
+def clear_curve(paper_id) -> int:
+    """移除考卷的曲線，總分回到各題得分加總。回傳有變動的紀錄數。"""
+    with transaction.atomic():
+        ExamPaper.objects.filter(pk=paper_id).update(curve=None)
+        return recompute_totals(paper_id)
+
+
+# ---------------------------------------------------------------------------
+# 正解修改後重新判分
+# ---------------------------------------------------------------------------
+
+REGRADE_WRITE_CHUNK = 900  # 每個 UPDATE 的 id 數（SQLite 參數上限 999）
+
+_SC, _MCQ, _TF, _SA = range(4)
+_TYPE_CODES = {'sc': _SC, 'mcq': _MCQ, 'tf': _TF, 'sa': _SA, 'essay': _SA}
+_INT64_MAX = (1 << 63) - 1
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImproperlyConfigured("重新判分需要安裝 numpy 套件") from e
+    return numpy
+
+
+def _fits_int64(value) -> bool:
+    return value is not None and -_INT64_MAX <= value <= _INT64_MAX
+
+
+def _encode_texts(np, texts, sa_keys: dict):
+    """
+    每個不重複答案字串編碼成與題型無關的欄位：
+    (空白, 單選值, 多選遮罩, 是非值, 簡答正解編號)；無法解析者為 -1。
+    """
+    n = len(texts)
+    blank = np.zeros(n, dtype=bool)
+    sc_value = np.full(n, -1, dtype=np.int64)
+    mcq_mask = np.full(n, -1, dtype=np.int64)
+    tf_value = np.zeros(n, dtype=np.int64)
+    sa_value = np.full(n, -1, dtype=np.int64)
+    for i, text in enumerate(texts):
+        answer = decode_stored_answer(text)
+        if is_blank(answer):
+            blank[i] = True
+            continue
+        if not isinstance(answer, list):
+            try:
+                value = int(str(answer).strip())
+            except ValueError:
+                value = None
+            if _fits_int64(value):
+                sc_value[i] = value
+        mask = parse_option_mask(answer)
+        if _fits_int64(mask):
+            mcq_mask[i] = mask
+        tf_value[i] = parse_tf(answer)
+        sa_value[i] = sa_keys.get(normalize_text(answer), -1)
+    return blank, sc_value, mcq_mask, tf_value, sa_value
+
+
+def _compile_keys(np, graders):
+    """題目 → 陣列：題型代碼、正解（依題型編碼）、正解是否有效、配分。"""
+    sa_keys = {}
+    qtype = np.zeros(len(graders), dtype=np.int8)
+    key = np.zeros(len(graders), dtype=np.int64)
+    valid = np.zeros(len(graders), dtype=bool)
+    points = np.zeros(len(graders), dtype=np.int64)
+    for i, grader in enumerate(graders):
+        code = _TYPE_CODES.get(grader.question_type)
+        points[i] = grader.points
+        if code is None or grader.key is None:
+            continue
+        qtype[i] = code
+        if code == _SA:
+            key[i] = sa_keys.setdefault(grader.key, len(sa_keys))
+        elif code == _TF:
+            key[i] = int(grader.key)
+        elif _fits_int64(grader.key):
+            key[i] = grader.key
+        else:
+            continue
+        valid[i] = True
+    return qtype, key, valid, points, sa_keys
+
+
+def _write_regrade(ids, question_index, correct, graders):
+    """只寫回結果改變的答案：依（題目、對錯）分組，每組一個 UPDATE ... WHERE id IN (...)。"""
+    for qi, grader in enumerate(graders):
+        in_question = question_index == qi
+        for outcome in (True, False):
+            group = ids[in_question & (correct == outcome)].tolist()
+            score = grader.points if outcome else 0
+            for start in range(0, len(group), REGRADE_WRITE_CHUNK):
+                ExamAnswer.objects.filter(id__in=group[start:start + REGRADE_WRITE_CHUNK]).update(
+                    is_correct=outcome, score=score
+                )
+
+
+def regrade_questions(question_ids, paper_id=None, commit=True) -> dict:
+    """
+    依目前的正解重新判分指定題目的所有作答（可限定單一考卷），並重算受影響考卷的總分。
+    commit=False 時只計算不寫入。
+    回傳 {'answers': 檢查筆數, 'changed': 改變筆數, 'papers': [受影響考卷 id]}。
+    """
+    np = _numpy()
+    graders = [compile_question(q) for q in ExamQuestion.objects.filter(id__in=list(question_ids)).order_by('id')]
+    if not graders:
+        return {'answers': 0, 'changed': 0, 'papers': []}
+
+    answers = ExamAnswer.objects.filter(exam_question_id__in=[g.question_id for g in graders])
+    if paper_id is not None:
+        answers = answers.filter(exam_record__exam_paper_id=paper_id)
+    rows = list(answers.values_list('id', 'exam_question_id', 'exam_record__exam_paper_id',
+                                    'student_answer', 'is_correct', 'score'))
+    if not rows:
+        return {'answers': 0, 'changed': 0, 'papers': []}
+
+    ids, question_ids_arr, paper_ids, texts, old_correct, old_score = zip(*rows)
+    ids = np.array(ids, dtype=np.int64)
+    paper_ids = np.array(paper_ids, dtype=np.int64)
+    old_correct = np.array(old_correct, dtype=bool)
+    old_score = np.array(old_score, dtype=np.int64)
+
+    qtype, key, valid, points, sa_keys = _compile_keys(np, graders)
+    question_index = np.searchsorted(np.array([g.question_id for g in graders], dtype=np.int64),
+                                     np.array(question_ids_arr, dtype=np.int64))
+
+    # 每個不重複的答案字串只解析一次
+    unique_texts, inverse = np.unique(np.array(['' if t is None else t for t in texts], dtype=object),
+                                      return_inverse=True)
+    blank, sc_value, mcq_mask, tf_value, sa_value = _encode_texts(np, unique_texts, sa_keys)
+
+    t = qtype[question_index]
+    k = key[question_index]
+    answered = valid[question_index] & ~blank[inverse]
+    correct = answered & (
+        ((t == _SC) & (sc_value[inverse] == k))
+        | ((t == _MCQ) & (mcq_mask[inverse] == k))
+        | ((t == _TF) & (tf_value[inverse] == k))
+        | ((t == _SA) & (sa_value[inverse] == k))
+    )
+    score = np.where(correct, points[question_index], 0)
+
+    changed = (correct != old_correct) | (score != old_score)
+    affected_papers = sorted(set(paper_ids[changed].tolist()))
+    if commit and changed.any():
+        with transaction.atomic():
+            _write_regrade(ids[changed], question_index[changed], correct[changed], graders)
+            for pid in affected_papers:
+                recompute_totals(pid)
+    return {'answers': len(rows), 'changed': int(changed.sum()), 'papers': affected_papers}
+
+
+def regrade_paper(paper_id, commit=True) -> dict:
+    """重新判分整張考卷的所有題目。"""
+    question_ids = ExamQuestion.objects.filter(exampaper__id=paper_id).values_list('id', flat=True)
+    return regrade_questions(list(question_ids), paper_id=paper_id, commit=commit)
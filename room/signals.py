@@ -0,0 +1,65 @@
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import ExamQuestion, ExamPaper
+from . import grading
+from .papers import invalidate_active_papers, refresh_paper_totals
+
+PAPER_TOTAL_FIELDS = ['total_points', 'ai_total_limit']
+
+
+def _paper_ids_for_question(question_id):
+    return list(ExamPaper.questions.through.objects.filter(
+        examquestion_id=question_id
+    ).values_list('exampaper_id', flat=True))
+
+
+@receiver(post_save, sender=ExamQuestion)
+def refresh_question_papers(sender, instance, created, **kwargs):
+    """題目被修改時，清除所有包含此題的考卷判分快取，並重算這些考卷的總分 / AI 總額度。"""
+    if created:
+        return  # 新題目尚未加入任何考卷
+    paper_ids = _paper_ids_for_question(instance.pk)
+    grading.invalidate_papers(paper_ids)
+    refresh_paper_totals(paper_ids)
+
+
+@receiver(pre_delete, sender=ExamQuestion)
+def remember_question_papers(sender, instance, **kwargs):
+    """刪除需在關聯被移除前處理：記下受影響的考卷並清除判分快取。"""
+    instance._exam_paper_ids = _paper_ids_for_question(instance.pk)
+    grading.invalidate_papers(instance._exam_paper_ids)
+
+
+@receiver(post_delete, sender=ExamQuestion)
+def refresh_papers_on_question_delete(sender, instance, **kwargs):
+    refresh_paper_totals(getattr(instance, '_exam_paper_ids', []))
+    invalidate_active_papers()
+
+
+@receiver([post_save, post_delete], sender=ExamPaper)
+def invalidate_paper_index(sender, instance, **kwargs):
+    """考卷新增、修改（含 end_exam 提前結束）或刪除時清除進行中考卷索引。"""
+    invalidate_active_papers()
+
+
+@receiver(m2m_changed, sender=ExamPaper.questions.through)
+def invalidate_paper_graders(sender, instance, action, reverse, pk_set, **kwargs):
+    """考卷題目集合變動時清除判分快取與進行中考卷索引（題數會變），並重算總分 / AI 總額度。"""
+    if action.startswith('post_'):
+        invalidate_active_papers()
+    if not reverse:
+        if action.startswith('post_'):
+            grading.invalidate_paper(instance.pk)
+            refresh_paper_totals([instance.pk])
+            # 呼叫端之後可能再 save() 這個物件，不能讓舊的加總蓋回去
+            instance.refresh_from_db(fields=PAPER_TOTAL_FIELDS)
+    elif action == 'pre_clear':
+        # 由題目端 clear()：此時關聯尚在，先查出受影響的考卷
+        instance._exam_paper_ids = _paper_ids_for_question(instance.pk)
+        grading.invalidate_papers(instance._exam_paper_ids)
+    elif action == 'post_clear':
+        refresh_paper_totals(getattr(instance, '_exam_paper_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        grading.invalidate_papers(pk_set)
+        refresh_paper_totals(pk_set)
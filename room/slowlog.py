@@ -0,0 +1,290 @@
+"""
+慢查詢記錄（settings.SLOW_QUERY_LOG）。
+
+以 connection_created 在每條資料庫連線掛上 execute wrapper，依 SQL 的形狀（參數、數字、字串常值拿掉，
+IN (...) 的項目數不計）累計每個請求的查詢。請求結束時（SlowQueryLogMiddleware）把下列項目寫成一行 JSON：
+
+- 慢查詢：單次執行超過 THRESHOLD_MS
+- 重複查詢：同一個形狀在一個請求內執行 REPEAT_THRESHOLD 次以上（N+1 迴圈）
+
+每筆附上發出查詢的程式位置（最內層的專案檔案，通常是 room/views.py 的函式與行號）。走訪堆疊不便宜，
+只在查詢變慢或形狀的次數達到 REPEAT_THRESHOLD 的那一次記錄位置，一般查詢只多一次字典查詢。
+請求以外（management command、背景 thread）的慢查詢則立即寫入，view 為 null。
+
+寫檔不在請求路徑上：_emit 只放進佇列（QueueHandler），由背景 thread（QueueListener）寫入。
+RotatingFileHandler 不能跨行程輪替同一個檔案，所以每個行程寫自己的檔案（PATH 的檔名加上 pid，
+例如 slow_queries.1234.log），各自依 MAX_BYTES、BACKUP_COUNT 輪替；manage.py slow_queries 合併讀取。
+"""
+import atexit
+import contextvars
+import heapq
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+
+import django.db
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils import timezone
+
+DEFAULTS = {
+    'ENABLED': True,
+    'THRESHOLD_MS': 100,
+    'REPEAT_THRESHOLD': 10,
+    'PATH': os.path.join(settings.BASE_DIR, 'logs', 'slow_queries.log'),
+    'MAX_BYTES': 10 * 1024 * 1024,
+    'BACKUP_COUNT': 5,
+}
+
+_logger = logging.getLogger(__name__)
+_logger.propagate = False
+_logger.setLevel(logging.INFO)
+_queue = None
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+_ROOT = str(settings.BASE_DIR) + os.sep
+# 虛擬環境可能放在專案目錄內；這些路徑下的檔案不算專案程式
+_EXCLUDED = tuple({p + os.sep for p in (sys.prefix, sys.base_prefix)})
+_DJANGO_DB = os.path.dirname(django.db.__file__) + os.sep
+# 請求外層的 middleware 不算呼叫位置（session / user 的延遲查詢改記在 view 或 Django 本身）
+_INFRA = {os.path.join('room', name) for name in ('metrics.py', 'middleware.py', 'profiling.py', 'slowlog.py')}
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+def options() -> dict:
+    return {**DEFAULTS, **getattr(settings, 'SLOW_QUERY_LOG', {})}
+
+
+@lru_cache(maxsize=2048)
+def shape(sql: str) -> str:
+    """SQL 的形狀：參數與常值換成 ?，IN (?, ?, ...) 合併成 IN (...)。"""
+    sql = sql.replace('%s', '?')
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDER_LIST.sub('(...)', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+@lru_cache(maxsize=4096)
+def _project_file(filename: str):
+    """專案內的檔案回傳相對路徑，否則 None。"""
+    if not filename.startswith(_ROOT) or filename.startswith(_EXCLUDED):
+        return None
+    path = filename[len(_ROOT):]
+    return None if path in _INFRA else path
+
+
+def _callsite():
+    # 先越過 django.db 的 cursor（其上是其他 execute wrapper，例如 room.metrics），再找最內層的專案檔案
+    frame = sys._getframe(2)
+    while frame is not None and not frame.f_code.co_filename.startswith(_DJANGO_DB):
+        frame = frame.f_back
+    while frame is not None:
+        path = _project_file(frame.f_code.co_filename)
+        if path is not None:
+            return f'{path}:{frame.f_lineno}', frame.f_code.co_name
+        frame = frame.f_back
+    return None, None
+
+
+class _Shape:
+    __slots__ = ('count', 'seconds', 'max_seconds', 'slow', 'callsites')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.slow = 0
+        self.callsites = Counter()   # (位置, 函式) -> 次數；只記錄慢查詢與達到重複門檻的那一次
+
+
+class _RequestLog:
+    __slots__ = ('queries', 'shapes')
+
+    def __init__(self):
+        self.queries = 0
+        self.shapes = {}   # 形狀 -> _Shape
+
+
+_request_log = contextvars.ContextVar('slowlog_request', default=None)
+
+
+def process_path(path, pid=None) -> str:
+    """這個行程實際寫入的檔案：logs/slow_queries.log → logs/slow_queries.<pid>.log。"""
+    root, ext = os.path.splitext(path)
+    return f'{root}.{pid or os.getpid()}{ext}'
+
+
+def _start_listener():
+    global _queue, _listener, _listener_pid
+    pid = os.getpid()
+    if _listener is None or _listener_pid != pid:   # fork 後子行程沒有父行程的 thread，重建
+        with _listener_lock:
+            if _listener is None or _listener_pid != pid:
+                opts = options()
+                os.makedirs(os.path.dirname(opts['PATH']), exist_ok=True)
+                handler = logging.handlers.RotatingFileHandler(
+                    process_path(opts['PATH'], pid), maxBytes=opts['MAX_BYTES'], backupCount=opts['BACKUP_COUNT'],
+                    encoding='utf-8',
+                )
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                records = queue.Queue()
+                listener = logging.handlers.QueueListener(records, handler)
+                listener.start()
+                for old in list(_logger.handlers):
+                    _logger.removeHandler(old)
+                _logger.addHandler(logging.handlers.QueueHandler(records))
+                _queue, _listener, _listener_pid = records, listener, pid
+
+
+def _stop_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            if _listener_pid == os.getpid():
+                _listener.stop()   # 寫完佇列中剩下的記錄
+                for handler in _listener.handlers:
+                    handler.close()
+            _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+@receiver(setting_changed)
+def _reset(setting, **kwargs):
+    if setting == 'SLOW_QUERY_LOG':
+        _stop_listener()
+
+
+def flush():
+    """等背景 thread 把已送出的記錄寫入檔案。"""
+    if _queue is not None and _listener_pid == os.getpid():
+        _queue.join()
+
+
+def _emit(entry):
+    _start_listener()
+    _logger.info(json.dumps(entry, ensure_ascii=False))
+
+
+def _entry(sql_shape, stats, **extra):
+    callsite, function = stats.callsites.most_common(1)[0][0] if stats.callsites else (None, None)
+    return {
+        'time': timezone.now().isoformat(),
+        **extra,
+        'shape': sql_shape,
+        'callsite': callsite,
+        'function': function,
+        'count': stats.count,
+        'slow': stats.slow,
+        'total_ms': round(stats.seconds * 1000, 2),
+        'max_ms': round(stats.max_seconds * 1000, 2),
+    }
+
+
+def _record_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        opts = options()
+        if opts['ENABLED']:
+            slow = elapsed * 1000 >= opts['THRESHOLD_MS']
+            log = _request_log.get()
+            if log is not None:
+                sql_shape = shape(sql)
+                stats = log.shapes.get(sql_shape)
+                if stats is None:
+                    stats = log.shapes[sql_shape] = _Shape()
+                stats.count += 1
+                stats.seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+                stats.slow += slow
+                log.queries += 1
+                if slow or stats.count == opts['REPEAT_THRESHOLD']:
+                    stats.callsites[_callsite()] += 1
+            elif slow:
+                stats = _Shape()
+                stats.count = stats.slow = 1
+                stats.seconds = stats.max_seconds = elapsed
+                stats.callsites[_callsite()] += 1
+                _emit(_entry(shape(sql), stats, view=None))
+
+
+@receiver(connection_created)
+def _instrument_connection(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def begin_request():
+    return _request_log.set(_RequestLog())
+
+
+def end_request(request, response, token):
+    log = _request_log.get()
+    _request_log.reset(token)
+    repeat_threshold = options()['REPEAT_THRESHOLD']
+    match = getattr(request, 'resolver_match', None)
+    for sql_shape, stats in log.shapes.items():
+        if stats.slow or stats.count >= repeat_threshold:
+            _emit(_entry(
+                sql_shape, stats,
+                view=match.view_name if match is not None else None,
+                method=request.method,
+                path=request.path,
+                status=response.status_code,
+                request_queries=log.queries,
+            ))
+
+
+def _log_files(path):
+    """PATH 對應的所有檔案，依寫入的行程分組；每組依時間排序（.N 最舊 … .1、目前的檔案最新）。"""
+    directory, name = os.path.split(path)
+    root, ext = os.path.splitext(name)
+    # slow_queries.log、slow_queries.<pid>.log 與它們輪替後的 .1 ~ .N
+    pattern = re.compile(rf'^({re.escape(root)}(?:\.\d+)?{re.escape(ext)})(?:\.(\d+))?$')
+    groups = {}
+    if os.path.isdir(directory or '.'):
+        for filename in os.listdir(directory or '.'):
+            match = pattern.match(filename)
+            if match:
+                base, backup = match.groups()
+                groups.setdefault(base, []).append((int(backup or 0), os.path.join(directory, filename)))
+    return [[p for _, p in sorted(files, reverse=True)] for _, files in sorted(groups.items())]
+
+
+def _read_lines(files):
+    for filename in files:
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def read_entries(path=None):
+    """依時間順序讀出所有行程的檔案與輪替後的舊檔；無法解析的行略過。"""
+    path = path or options()['PATH']
+    flush()
+    streams = [_read_lines(files) for files in _log_files(path)]
+    yield from heapq.merge(*streams, key=lambda entry: entry.get('time') or '')
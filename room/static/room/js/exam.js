@@ -1,5 +1,14 @@
 const currentIndices = {};
 
+// 自動儲存：把各題的最新答案暫存起來，防抖後以批次 API 一次送出
+const AUTOSAVE_DEBOUNCE_MS = 800;
+const AUTOSAVE_URL = '/exam/answers/batch/';
+const pendingAnswers = {};   // paperId -> { questionId: { answer, client_seq } }
+const autosaveTimers = {};
+const autosaveInFlight = {};
+const autosaveNext = {};     // paperId -> { promise, options }：送出期間再呼叫者共用的下一批
+let autosaveSeq = 0;
+
 document.addEventListener('DOMContentLoaded', () => {
     const paper = document.querySelector('.exam-paper');
     if (paper) {
@@ -12,9 +21,11 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    const aiRemaining = parseInt(document.getElementById('ai-remaining-display')?.dataset.limit) || 0;
+    // data-limit 為空：額度服務暫時無法取得剩餘次數，按鈕保持可用，由提問的回應決定
+    const limitText = document.getElementById('ai-remaining-display')?.dataset.limit;
+    const aiRemaining = limitText === '' ? null : (parseInt(limitText) || 0);
     const aiBtn = document.querySelector('.ai-btn');
-    if (aiRemaining <= 0 && aiBtn) {
+    if (aiRemaining !== null && aiRemaining <= 0 && aiBtn) {
         aiBtn.disabled = true;
         aiBtn.textContent = '已達上限';
     }
@@ -33,6 +44,18 @@ function setupEventListeners(paperId) {
 
     const form = document.getElementById(`exam-form-${paperId}`);
     if (form) {
+        const onAnswerChanged = (event) => {
+            const container = event.target.closest('.question-container');
+            if (container) {
+                queueAnswer(paperId, container);
+            }
+        };
+        form.addEventListener('change', onAnswerChanged);
+        form.addEventListener('input', onAnswerChanged);
+
+        // 離開頁面前把尚未送出的答案送出
+        window.addEventListener('pagehide', () => flushAnswers(paperId, { keepalive: true }));
+
         form.addEventListener('submit', (event) => {
             event.preventDefault();
             const answers = {};
@@ -117,65 +140,113 @@ function getAnswer(container) {
     return answer;
 }
 
-async function submitSingleAnswer(paperId, questionId) {
-    const currentQuestion = document.querySelector(`.exam-paper[data-paper-id="${paperId}"] .question-container[style*="display: block"]`);
-    if (!currentQuestion) {
-        console.error('No active question found');
-        return false;
+function queueAnswer(paperId, container) {
+    const questionId = container.getAttribute('data-question-id');
+    if (!pendingAnswers[paperId]) {
+        pendingAnswers[paperId] = {};
+    }
+    pendingAnswers[paperId][questionId] = {
+        answer: getAnswer(container),
+        client_seq: ++autosaveSeq
+    };
+
+    clearTimeout(autosaveTimers[paperId]);
+    autosaveTimers[paperId] = setTimeout(() => flushAnswers(paperId), AUTOSAVE_DEBOUNCE_MS);
+}
+
+function flushAnswers(paperId, { interactive = false, keepalive = false } = {}) {
+    clearTimeout(autosaveTimers[paperId]);
+
+    // 同一張考卷一次只送一個批次，避免舊請求覆蓋新答案。送出期間再呼叫的都等同一個「下一批」，
+    // 不會各自在上一批結束後重送同樣的答案
+    if (autosaveInFlight[paperId]) {
+        let next = autosaveNext[paperId];
+        if (!next) {
+            next = autosaveNext[paperId] = { options: { interactive: false, keepalive: false } };
+            next.promise = autosaveInFlight[paperId].then(() => {
+                autosaveNext[paperId] = null;
+                return sendAnswers(paperId, next.options);
+            });
+        }
+        next.options.interactive ||= interactive;
+        next.options.keepalive ||= keepalive;
+        return next.promise;
+    }
+    return sendAnswers(paperId, { interactive, keepalive });
+}
+
+async function sendAnswers(paperId, { interactive, keepalive }) {
+    const pending = pendingAnswers[paperId] || {};
+    const items = Object.entries(pending).map(([questionId, entry]) => ({
+        question_id: questionId,
+        answer: entry.answer,
+        client_seq: entry.client_seq
+    }));
+    if (!items.length) {
+        return true;
     }
 
-    const answer = getAnswer(currentQuestion);
     const csrfToken = getCSRFToken();
-    
     if (!csrfToken) {
         console.error('CSRF token not found');
-        alert('安全令牌不存在，請重新載入頁面');
+        if (interactive) alert('安全令牌不存在，請重新載入頁面');
         return false;
     }
 
-    try {
-        const response = await fetch(`/exam/`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-                'X-CSRFToken': csrfToken,
-                'X-Requested-With': 'XMLHttpRequest'
-            },
-            body: JSON.stringify({
-                action: 'submit_answer',
-                paper_id: paperId,
-                question_id: questionId || currentQuestion.getAttribute('data-question-id'),
-                answer: answer
-            }),
+    const request = fetch(AUTOSAVE_URL, {
+        method: 'POST',
+        keepalive: keepalive,
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': csrfToken,
+            'X-Requested-With': 'XMLHttpRequest'
+        },
+        body: JSON.stringify({ paper_id: paperId, answers: items }),
+    }).then(async (response) => {
+        const data = await response.json().catch(() => ({}));
+        if (!response.ok || data.status !== 'success') {
+            throw new Error(data.message || `HTTP ${response.status}: ${response.statusText}`);
+        }
+        (data.results || []).forEach(result => {
+            const entry = pending[result.question_id];
+            // 送出期間又有新的修改時保留，等下一批再送
+            if (entry && entry.client_seq <= result.client_seq && result.status !== 'error') {
+                delete pending[result.question_id];
+            }
+            if (result.status === 'error') {
+                console.error(`Autosave failed for question ${result.question_id}: ${result.message}`);
+            }
         });
-
-        if (!response.ok) {
-            throw new Error(`HTTP ${response.status}: ${response.statusText}`);
+        return true;
+    }).catch(error => {
+        console.error('Error saving answers:', error);
+        if (interactive) {
+            alert(error.message || '儲存答案時發生錯誤，請重試。');
         }
+        return false;
+    });
 
-        const data = await response.json();
-        
-        if (data.status === 'success') {
-            console.log(`Submission successful for question ${questionId}, score: ${data.score}`);
-            return true;
-        } else {
-            console.error(`Submission failed: ${data.message}`);
-            alert(data.message || '提交失敗，請重試。');
-            return false;
-        }
-    } catch (error) {
-        console.error('Error submitting answer:', error);
-        if (error.message.includes('404')) {
-            alert('找不到提交路徑，請檢查 URL 配置');
-        } else if (error.message.includes('403')) {
-            alert('權限不足或 CSRF 驗證失敗，請重新載入頁面');
-        } else if (error.message.includes('500')) {
-            alert('伺服器內部錯誤，請聯繫管理員');
-        } else {
-            alert('提交答案時發生錯誤，請重試。');
+    autosaveInFlight[paperId] = request;
+    try {
+        return await request;
+    } finally {
+        if (autosaveInFlight[paperId] === request) {
+            autosaveInFlight[paperId] = null;
         }
+    }
+}
+
+async function submitSingleAnswer(paperId, questionId) {
+    const currentQuestion = questionId
+        ? document.querySelector(`.exam-paper[data-paper-id="${paperId}"] .question-container[data-question-id="${questionId}"]`)
+        : document.querySelector(`.exam-paper[data-paper-id="${paperId}"] .question-container[style*="display: block"]`);
+    if (!currentQuestion) {
+        console.error('No active question found');
         return false;
     }
+
+    queueAnswer(paperId, currentQuestion);
+    return flushAnswers(paperId, { interactive: true });
 }
 
 async function handleNextQuestion(paperId) {
@@ -273,29 +344,130 @@ function getCookie(name) {
     return cookieValue;
 }
 
-async function callWebhook(prompt, paperId) {
-    const payload = paperId ? { prompt, paper_id: paperId } : { prompt };
+// 目前顯示的題目 ID（AI 回覆快取以題目分桶，沒帶題目時伺服器不使用快取）
+function currentQuestionId(paperId) {
+    const questions = document.querySelectorAll(`.exam-paper[data-paper-id="${paperId}"] .question-container`);
+    const question = questions[currentIndices[paperId] || 0];
+    return question ? question.getAttribute('data-question-id') : null;
+}
+
+function aiPayload(prompt, paperId, questionId) {
+    if (!paperId) return { prompt };
+    return questionId ? { prompt, paper_id: paperId, question_id: questionId } : { prompt, paper_id: paperId };
+}
+
+// 以 SSE（Accept: text/event-stream）串流 /webhooks/ai/；錯誤（例如額度用盡的 429）仍是 JSON
+async function callWebhook(prompt, paperId, questionId, onText) {
+    const payload = aiPayload(prompt, paperId, questionId);
     const csrfToken = getCSRFToken();
     
     const res = await fetch('/webhooks/ai/', {
         method: 'POST',
         headers: { 
             'Content-Type': 'application/json',
+            'Accept': 'text/event-stream',
             'X-CSRFToken': csrfToken,
             'X-Requested-With': 'XMLHttpRequest'
         },
         body: JSON.stringify(payload),
     });
     
-    const data = await res.json().catch(() => ({}));
-    if (!res.ok) {
-        const msg = data.response || data.error || `HTTP ${res.status}`;
-        const err = new Error(msg); 
-        err.status = res.status; 
-        err.payload = data;
-        throw err;
+    const contentType = res.headers.get('Content-Type') || '';
+    if (!res.ok || !contentType.startsWith('text/event-stream') || !res.body) {
+        const data = await res.json().catch(() => ({}));
+        if (!res.ok) {
+            const msg = data.response || data.error || `HTTP ${res.status}`;
+            const err = new Error(msg); 
+            err.status = res.status; 
+            err.payload = data;
+            throw err;
+        }
+        return data;
+    }
+
+    const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    let text = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += value;
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) >= 0) {
+            const block = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            block.split('\n').forEach(line => {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            });
+            const msg = data ? JSON.parse(data) : {};
+            if (event === 'chunk') {
+                text += msg.data;
+                onText(text);
+            } else if (event === 'done') {
+                return { response: text, remaining: msg.remaining };
+            } else if (event === 'error') {
+                const err = new Error(msg.message);
+                err.payload = msg;
+                throw err;
+            }
+        }
     }
-    return data;
+    throw new Error('❌ 連線中斷，請稍後再試。');
+}
+
+// AI 回覆以 WebSocket（ws/gemini/chat/）逐段串流；伺服器 / 代理不支援 WebSocket 時改用 /webhooks/ai/ 的 SSE
+let aiSocketPromise = null;
+
+function connectAISocket() {
+    if (aiSocketPromise) return aiSocketPromise;
+    aiSocketPromise = new Promise((resolve, reject) => {
+        if (!('WebSocket' in window)) {
+            reject(new Error('WebSocket not supported'));
+            return;
+        }
+        const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+        const socket = new WebSocket(`${scheme}://${window.location.host}/ws/gemini/chat/`);
+        socket.addEventListener('open', () => resolve(socket), { once: true });
+        socket.addEventListener('error', () => reject(new Error('WebSocket connection failed')), { once: true });
+        socket.addEventListener('close', () => { aiSocketPromise = null; });
+    });
+    aiSocketPromise.catch(() => { aiSocketPromise = null; });
+    return aiSocketPromise;
+}
+
+function streamAI(socket, prompt, paperId, questionId, onText) {
+    return new Promise((resolve, reject) => {
+        let text = '';
+        const cleanup = () => {
+            socket.removeEventListener('message', onMessage);
+            socket.removeEventListener('close', onClose);
+        };
+        const onMessage = (event) => {
+            const msg = JSON.parse(event.data);
+            if (msg.type === 'chunk') {
+                text += msg.data;
+                onText(text);
+            } else if (msg.type === 'done') {
+                cleanup();
+                resolve({ response: text, remaining: msg.remaining });
+            } else if (msg.type === 'error') {
+                cleanup();
+                const err = new Error(msg.message);
+                err.payload = msg;
+                reject(err);
+            }
+        };
+        const onClose = () => {
+            cleanup();
+            reject(new Error('❌ 連線中斷，請稍後再試。'));
+        };
+        socket.addEventListener('message', onMessage);
+        socket.addEventListener('close', onClose);
+        socket.send(JSON.stringify(aiPayload(prompt, paperId, questionId)));
+    });
 }
 
 async function askAI() {
@@ -304,6 +476,7 @@ async function askAI() {
     const left = document.getElementById('ai-remaining-display');
     const btn = document.querySelector('.ai-btn');
     const paperId = document.getElementById('current-paper-id')?.value || '';
+    const questionId = paperId ? currentQuestionId(paperId) : null;
 
     const question = (qEl?.value || '').trim();
     if (!question) { 
@@ -319,7 +492,11 @@ async function askAI() {
     }
 
     try {
-        const data = await callWebhook(question, paperId || null);
+        const showText = text => { resp.textContent = text; };
+        const socket = await connectAISocket().catch(() => null);
+        const data = socket
+            ? await streamAI(socket, question, paperId || null, questionId, showText)
+            : await callWebhook(question, paperId || null, questionId, showText);
         resp.innerHTML = data.response || '無法獲得回應，請稍後再試。';
 
         if (typeof data.remaining === 'number' && left) {
@@ -0,0 +1,281 @@
+"""
+作答寫入流程（整卷提交、單題 / 批次自動儲存）。
+
+整卷提交在單一 transaction 內完成：讀一次既有答案，再以 bulk_create / bulk_update
+寫入 ExamAnswer、InteractionLog 一次交給 room.logsink，查詢數不隨題數增加。
+
+單題儲存不重新加總，而是以新舊得分差（delta）配合 F() 更新 ExamRecord.score
+與 StudentExamHistory.total_score，查詢數與該份作答已有幾題無關；批次儲存則把
+多題的得分差合併成一次更新。
+
+考卷套用了曲線（ExamPaper.curve）時，總分不是各題得分加總，原始分數與得分差都不能
+直接寫入；改由 regrade.recompute_totals 重算整張考卷（百分位曲線與其他學生的分數有關）。
+"""
+from django.db import transaction
+from django.db.models import F
+
+from .grading import get_paper_graders
+from .logsink import log_interactions
+from .models import ExamAnswer, ExamRecord, InteractionLog, StudentExamHistory
+
+ANSWER_UPDATE_FIELDS = ['student_answer', 'score', 'is_correct']
+
+
+def grade_letter(total_score: int) -> str:
+    return 'A' if total_score >= 90 else 'B' if total_score >= 80 else 'C'
+
+
+def normalize_submitted_answer(answer):
+    """整卷提交的答案正規化：空列表視為未作答（None），空白字串視為 ''。"""
+    if answer is None or (isinstance(answer, list) and not any(answer)):
+        return None
+    if isinstance(answer, str) and not answer.strip():
+        return ''
+    return answer
+
+
+def build_answer_log(user, grader, exam_paper, answer, is_correct, score) -> InteractionLog:
+    """建立（未儲存的）作答互動紀錄。"""
+    return InteractionLog(
+        user=user,
+        question=f"題目: {grader.label}..., 回答: {answer if answer is not None else '未作答'}",
+        response=f"回答 {'正確' if is_correct else '錯誤' if grader.has_key else '已記錄'}, 得分: {score}/{grader.points}",
+        exam_question_id=grader.question_id,
+        exam_paper=exam_paper,
+        score=score,
+    )
+
+
+def submit_paper(student, exam_paper, answers: dict, submitted_at) -> ExamRecord:
+    """
+    整卷提交：判分並寫入 ExamRecord / ExamAnswer / InteractionLog / StudentExamHistory。
+    answers 為 {question_id(str): answer}。回傳更新後的 ExamRecord（score 為總分）。
+    """
+    graders = get_paper_graders(exam_paper)
+
+    with transaction.atomic():
+        exam_record, created = ExamRecord.objects.update_or_create(
+            student=student,
+            exam_paper=exam_paper,
+            defaults={'submitted_at': submitted_at, 'is_completed': True}
+        )
+
+        existing = {}
+        if not created:
+            existing = {a.exam_question_id: a for a in ExamAnswer.objects.filter(exam_record=exam_record)}
+
+        to_create, to_update, logs = [], [], []
+        total_score = 0
+        for grader in graders.values():
+            student_answer = normalize_submitted_answer(answers.get(str(grader.question_id)))
+            is_correct, score = grader.grade(student_answer)
+            total_score += score
+
+            answer = existing.get(grader.question_id)
+            if answer is None:
+                to_create.append(ExamAnswer(
+                    exam_record=exam_record,
+                    exam_question_id=grader.question_id,
+                    student_answer=student_answer,
+                    score=score,
+                    is_correct=is_correct,
+                ))
+            else:
+                answer.student_answer = student_answer
+                answer.score = score
+                answer.is_correct = is_correct
+                to_update.append(answer)
+
+            logs.append(build_answer_log(student, grader, exam_paper, student_answer, is_correct, score))
+
+        if to_create:
+            ExamAnswer.objects.bulk_create(to_create)
+        if to_update:
+            ExamAnswer.objects.bulk_update(to_update, ANSWER_UPDATE_FIELDS)
+        log_interactions(logs)
+
+        StudentExamHistory.objects.update_or_create(
+            student=student,
+            exam_paper=exam_paper,
+            defaults={
+                'total_score': total_score,
+                'completed_at': submitted_at,
+                'grade': grade_letter(total_score)
+            }
+        )
+
+        exam_record.score = total_score
+        exam_record.save(update_fields=['score'])
+        if exam_paper.curve:
+            _recompute_curved(exam_paper, exam_record)
+
+    return exam_record
+
+
+def _recompute_curved(exam_paper, exam_record):
+    """有曲線的考卷：整張考卷重算總分，並把 exam_record.score 更新為曲線後的總分。"""
+    from .regrade import recompute_totals   # regrade 依賴本模組的 grade_letter
+
+    recompute_totals(exam_paper.id)
+    exam_record.score = ExamRecord.objects.values_list('score', flat=True).get(pk=exam_record.pk)
+
+
+def apply_score_delta(student, exam_paper, exam_record, delta: int, completed_at):
+    """把單題得分差套用到 ExamRecord 與 StudentExamHistory 的總分。"""
+    if exam_paper.curve:
+        StudentExamHistory.objects.update_or_create(
+            student=student,
+            exam_paper=exam_paper,
+            defaults={'completed_at': completed_at},
+        )
+        _recompute_curved(exam_paper, exam_record)
+        return
+
+    if delta:
+        ExamRecord.objects.filter(pk=exam_record.pk).update(score=F('score') + delta)
+        exam_record.score += delta
+
+    updated = StudentExamHistory.objects.filter(
+        student=student,
+        exam_paper=exam_paper,
+    ).update(total_score=F('total_score') + delta, completed_at=completed_at)
+    if not updated:
+        StudentExamHistory.objects.create(
+            student=student,
+            exam_paper=exam_paper,
+            total_score=exam_record.score,
+            completed_at=completed_at,
+        )
+
+
+def save_single_answer(student, exam_paper, grader, student_answer, answered_at, update_totals=True):
+    """
+    單題儲存：寫入 / 更新 ExamAnswer，並以得分差增量維護總分。
+    update_totals=False（考試頁 exam() 的 JSON 自動儲存）只寫入答案與互動紀錄，
+    ExamRecord.score 與 StudentExamHistory 留到整卷提交時才計算。
+    回傳 (exam_record, is_correct, score)。
+    """
+    is_correct, score = grader.grade(student_answer)
+    record_defaults = {'score': 0, 'is_completed': False}
+    if not update_totals:
+        record_defaults['submitted_at'] = answered_at
+
+    with transaction.atomic():
+        exam_record, created = ExamRecord.objects.get_or_create(
+            student=student,
+            exam_paper=exam_paper,
+            defaults=record_defaults
+        )
+
+        old_score = 0
+        previous = None
+        if not created:
+            previous = (ExamAnswer.objects.select_for_update()
+                        .filter(exam_record=exam_record, exam_question_id=grader.question_id)
+                        .values('id', 'score').first())
+        if previous is None:
+            ExamAnswer.objects.create(
+                exam_record=exam_record,
+                exam_question_id=grader.question_id,
+                student_answer=student_answer,
+                score=score,
+                is_correct=is_correct,
+            )
+        else:
+            old_score = previous['score']
+            ExamAnswer.objects.filter(pk=previous['id']).update(
+                student_answer=student_answer,
+                score=score,
+                is_correct=is_correct,
+                answered_at=answered_at,
+            )
+
+        if update_totals:
+            apply_score_delta(student, exam_paper, exam_record, score - old_score, answered_at)
+        log_interactions([build_answer_log(student, grader, exam_paper, student_answer, is_correct, score)])
+
+    return exam_record, is_correct, score
+
+
+def save_answers_batch(student, exam_paper, items, answered_at):
+    """
+    批次自動儲存：items 為 [{'question_id', 'answer', 'client_seq'}]。
+    以考卷判分快取一次解析所有題目，在單一 transaction 內 bulk 寫入，
+    回傳與 items 對應的逐項結果。同一題出現多次時以 client_seq 最大者為準。
+    """
+    graders = get_paper_graders(exam_paper)
+
+    results = []
+    latest = {}
+    for item in items:
+        try:
+            question_id = int(item.get('question_id'))
+        except (TypeError, ValueError):
+            question_id = None
+        client_seq = item.get('client_seq')
+        result = {'question_id': item.get('question_id'), 'client_seq': client_seq}
+        results.append(result)
+        if question_id not in graders:
+            result.update(status='error', message='題目不存在')
+            continue
+        seq = client_seq if isinstance(client_seq, (int, float)) else 0
+        previous = latest.get(question_id)
+        if previous is not None and previous[0] > seq:
+            result.update(status='superseded')
+            continue
+        if previous is not None:
+            previous[1].update(status='superseded')
+        latest[question_id] = (seq, result, item.get('answer'))
+
+    if not latest:
+        return results
+
+    with transaction.atomic():
+        exam_record, created = ExamRecord.objects.get_or_create(
+            student=student,
+            exam_paper=exam_paper,
+            defaults={'score': 0, 'is_completed': False}
+        )
+        existing = {}
+        if not created:
+            existing = {a.exam_question_id: a for a in ExamAnswer.objects.select_for_update().filter(
+                exam_record=exam_record, exam_question_id__in=list(latest)
+            )}
+
+        to_create, to_update, logs = [], [], []
+        delta = 0
+        for question_id, (seq, result, student_answer) in latest.items():
+            grader = graders[question_id]
+            if isinstance(student_answer, str) and not student_answer.strip():
+                student_answer = ""
+            is_correct, score = grader.grade(student_answer)
+
+            answer = existing.get(question_id)
+            if answer is None:
+                to_create.append(ExamAnswer(
+                    exam_record=exam_record,
+                    exam_question_id=question_id,
+                    student_answer=student_answer,
+                    score=score,
+                    is_correct=is_correct,
+                ))
+                delta += score
+            else:
+                delta += score - answer.score
+                answer.student_answer = student_answer
+                answer.score = score
+                answer.is_correct = is_correct
+                answer.answered_at = answered_at
+                to_update.append(answer)
+
+            logs.append(build_answer_log(student, grader, exam_paper, student_answer, is_correct, score))
+            result.update(status='success', score=score, is_correct=is_correct)
+
+        if to_create:
+            ExamAnswer.objects.bulk_create(to_create)
+        if to_update:
+            ExamAnswer.objects.bulk_update(to_update, ANSWER_UPDATE_FIELDS + ['answered_at'])
+        log_interactions(logs)
+        apply_score_delta(student, exam_paper, exam_record, delta, answered_at)
+
+    return results
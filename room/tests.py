@@ -1,3 +1,1080 @@
-from django.test import TestCase
+import asyncio
+import fnmatch
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import redis
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from gemini_api import answer_cache, gemini, scheduler
+from gemini_api.stubserver import StubGeminiServer
+
+from . import logsink, profiling, quota, slowlog
+from .gradebook import load_gradebook_page
+from .export import iter_rows as iter_export_rows
+from .grading import get_paper_graders
+from .management.commands.loadtest_exam import _percentile
+from .models import CustomUser, ExamAnswer, ExamPaper, ExamQuestion, ExamRecord, InteractionLog, StudentExamHistory
+from .papers import ACTIVE_PAPERS_CACHE_KEY, get_active_papers
+from .regrade import apply_curve, regrade_paper
+from .submission import save_answers_batch, save_single_answer, submit_paper
+from .views import _paper_ai_settings_sync
+
+
+class GradingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.teacher = CustomUser.objects.create_user(username='t1', password='pw', student_id='T1', is_staff=True)
+        make = lambda **kw: ExamQuestion.objects.create(title='q', content='<p>q</p>', points=10, created_by=cls.teacher, **kw)
+        cls.sc = make(question_type='sc', options=['a', 'b'], correct_option_indices='1')
+        cls.mcq = make(question_type='mcq', options=['a', 'b', 'c'], correct_option_indices='0,2')
+        cls.tf = make(question_type='tf', is_correct=False)
+        cls.sa = make(question_type='sa', correct_option_indices=' Paris ')
+        cls.paper = ExamPaper.objects.create(title='p', created_by=cls.teacher)
+        cls.paper.questions.set([cls.sc, cls.mcq, cls.tf, cls.sa])
+
+    def setUp(self):
+        cache.clear()
+
+    def test_grades_each_question_type(self):
+        graders = get_paper_graders(self.paper)
+        self.assertEqual(graders[self.sc.id].grade('1'), (True, 10))
+        self.assertEqual(graders[self.sc.id].grade(''), (False, 0))
+        self.assertTrue(graders[self.mcq.id].is_correct(['2', '0']))
+        self.assertTrue(graders[self.mcq.id].is_correct('2,0'))
+        self.assertFalse(graders[self.mcq.id].is_correct(['0']))
+        self.assertTrue(graders[self.tf.id].is_correct('false'))
+        self.assertFalse(graders[self.tf.id].is_correct(None))
+        self.assertTrue(graders[self.sa.id].is_correct('paris'))
+
+    def test_cache_is_invalidated_on_question_save(self):
+        get_paper_graders(self.paper)
+        with self.assertNumQueries(0):
+            get_paper_graders(self.paper.id)
+        self.sc.correct_option_indices = '0'
+        self.sc.save()
+        self.assertTrue(get_paper_graders(self.paper.id)[self.sc.id].is_correct('0'))
+
+    def test_key_change_reaches_other_workers_through_shared_cache(self):
+        # 以檔案快取模擬多 worker 共用的後端：另一條快取連線不共用任何行程內狀態
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}):
+            other_worker = caches.create_connection('default')
+            get_paper_graders(self.paper)
+            self.assertTrue(other_worker.get(f'grading:paper:{self.paper.id}')[self.sc.id].is_correct('1'))
+            self.sc.correct_option_indices = '0'
+            self.sc.save()
+            self.assertIsNone(other_worker.get(f'grading:paper:{self.paper.id}'))
+
+
+class SubmissionQueryCountTests(TestCase):
+    """作答寫入的查詢數不應隨題數或已作答題數增加。"""
+
+    def setUp(self):
+        cache.clear()
+        self.teacher = CustomUser.objects.create_user(username='t1', password='pw', student_id='T1', is_staff=True)
+        self.student = CustomUser.objects.create_user(username='s1', password='pw', student_id='S1')
+
+    def _paper(self, n):
+        questions = ExamQuestion.objects.bulk_create([
+            ExamQuestion(title=f'q{i}', content='<p>q</p>', question_type='sc', options=['a', 'b'],
+                         correct_option_indices='0', points=1, created_by=self.teacher)
+            for i in range(n)
+        ])
+        paper = ExamPaper.objects.create(title=f'p{n}', created_by=self.teacher)
+        paper.questions.set(questions)
+        return paper, {str(q.id): '0' for q in questions}
+
+    def _count_submit(self, paper, answers):
+        get_paper_graders(paper)  # 判分快取暖機
+        with CaptureQueriesContext(connection) as ctx:
+            record = submit_paper(self.student, paper, answers, timezone.now())
+        return len(ctx.captured_queries), record
+
+    def test_query_count_is_constant(self):
+        small, small_answers = self._paper(5)
+        large, large_answers = self._paper(50)
+        small_count, _ = self._count_submit(small, small_answers)
+        large_count, record = self._count_submit(large, large_answers)
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(record.score, 50)
+        self.assertEqual(InteractionLog.objects.filter(exam_paper=large).count(), 50)
+
+        # 重新提交（走 bulk_update）也維持相同查詢數
+        resubmit_count, record = self._count_submit(large, {})
+        self.assertLessEqual(resubmit_count, large_count)
+        self.assertEqual(record.score, 0)
+
+    def test_single_answer_maintains_totals_incrementally(self):
+        paper, answers = self._paper(30)
+        graders = list(get_paper_graders(paper).values())
+        for grader in graders[:20]:
+            save_single_answer(self.student, paper, grader, '0', timezone.now())
+
+        with CaptureQueriesContext(connection) as ctx:
+            record, is_correct, score = save_single_answer(self.student, paper, graders[0], '1', timezone.now())
+        self.assertLessEqual(len(ctx.captured_queries), 8)  # 含 savepoint 與 release
+        self.assertEqual(score, 0)
+
+        record.refresh_from_db()
+        history = StudentExamHistory.objects.get(student=self.student, exam_paper=paper)
+        self.assertEqual(record.score, 19)
+        self.assertEqual(history.total_score, 19)
+
+    def test_exam_page_autosave_leaves_totals_to_submission(self):
+        paper, answers = self._paper(3)
+        paper.end_time = timezone.now() + timezone.timedelta(hours=1)
+        paper.save()
+        self.client.force_login(self.student)
+        response = self.client.post(reverse('room:exam'), {
+            'action': 'submit_answer', 'paper_id': paper.id, 'question_id': int(next(iter(answers))), 'answer': '0',
+        }, content_type='application/json')
+        self.assertEqual(response.json()['score'], 1)
+
+        record = ExamRecord.objects.get(student=self.student, exam_paper=paper)
+        self.assertEqual(record.score, 0)
+        self.assertIsNotNone(record.submitted_at)
+        self.assertEqual(ExamAnswer.objects.get(exam_record=record).score, 1)
+        self.assertFalse(StudentExamHistory.objects.filter(student=self.student, exam_paper=paper).exists())
+
+    def test_batch_autosave_endpoint(self):
+        paper, answers = self._paper(3)
+        paper.end_time = timezone.now() + timezone.timedelta(hours=1)
+        paper.save()
+        q1, q2, q3 = [int(qid) for qid in answers]
+        self.client.force_login(self.student)
+        response = self.client.post(reverse('room:submit_answers_batch'), data={
+            'paper_id': paper.id,
+            'answers': [
+                {'question_id': q1, 'answer': '1', 'client_seq': 1},
+                {'question_id': q1, 'answer': '0', 'client_seq': 2},
+                {'question_id': q2, 'answer': '0', 'client_seq': 3},
+                {'question_id': 999999, 'answer': '0', 'client_seq': 4},
+            ],
+        }, content_type='application/json')
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], ['superseded', 'success', 'success', 'error'])
+        self.assertEqual(ExamRecord.objects.get(student=self.student, exam_paper=paper).score, 2)
+
+
+class ActivePapersIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher = CustomUser.objects.create_user(username='t1', password='pw', student_id='T1', is_staff=True)
+        now = timezone.now()
+        self.open = ExamPaper.objects.create(title='open', created_by=self.teacher,
+                                             publish_time=now - timezone.timedelta(hours=1),
+                                             end_time=now + timezone.timedelta(hours=1))
+        self.upcoming = ExamPaper.objects.create(title='upcoming', created_by=self.teacher,
+                                                 publish_time=now + timezone.timedelta(minutes=10),
+                                                 end_time=now + timezone.timedelta(hours=2))
+
+    def test_index_is_cached_and_refreshed(self):
+        now = timezone.now()
+        self.assertEqual([p.id for p in get_active_papers(now)], [self.open.id])
+        with self.assertNumQueries(0):
+            get_active_papers(now)
+        # 到了下一個發佈時間點自動重建
+        later = now + timezone.timedelta(minutes=11)
+        self.assertEqual([p.id for p in get_active_papers(later)], [self.open.id, self.upcoming.id])
+
+    def test_end_exam_invalidates_index(self):
+        get_active_papers()
+        self.open.end_time = timezone.now()
+        self.open.save()
+        self.assertEqual(get_active_papers(), [])
+
+    def test_index_is_shared_with_other_workers(self):
+        # 以檔案快取模擬多 worker 共用的後端（正式環境為 RedisCache）
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}):
+            other_worker = caches.create_connection('default')
+            get_active_papers()
+            self.assertEqual([p.id for p in other_worker.get(ACTIVE_PAPERS_CACHE_KEY)['papers']], [self.open.id])
+            self.open.end_time = timezone.now()
+            self.open.save()
+            self.assertIsNone(other_worker.get(ACTIVE_PAPERS_CACHE_KEY))
+
+
+class PaperTotalsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher = CustomUser.objects.create_user(username='t1', password='pw', student_id='T1', is_staff=True)
+        make = lambda points, ai: ExamQuestion.objects.create(title='q', content='<p>q</p>', question_type='tf',
+                                                             is_correct=True, points=points, ai_limit=ai,
+                                                             created_by=self.teacher)
+        self.q1, self.q2, self.q3 = make(10, 2), make(20, 3), make(5, 1)
+        self.paper = ExamPaper.objects.create(title='p', created_by=self.teacher)
+
+    def assertTotals(self, points, ai):
+        self.paper.refresh_from_db()
+        self.assertEqual((self.paper.total_points, self.paper.ai_total_limit), (points, ai))
+
+    def test_totals_follow_question_and_m2m_changes(self):
+        self.paper.questions.set([self.q1, self.q2])
+        self.assertEqual((self.paper.total_points, self.paper.ai_total_limit), (30, 5))  # 呼叫端物件也同步
+        self.q2.points, self.q2.ai_limit = 15, 4
+        self.q2.save()
+        self.assertTotals(25, 6)
+        self.q3.exampaper_set.add(self.paper)
+        self.assertTotals(30, 7)
+        self.q3.exampaper_set.clear()
+        self.assertTotals(25, 6)
+        self.q1.delete()
+        self.assertTotals(15, 4)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(_paper_ai_settings_sync(self.paper.id), (4, False))
+        self.assertNotIn('exampaper_questions', ctx.captured_queries[0]['sql'])
+
+    def test_verify_and_backfill_command(self):
+        self.paper.questions.set([self.q1, self.q2])
+        ExamPaper.objects.filter(id=self.paper.id).update(total_points=0, ai_total_limit=0)
+        with self.assertRaises(CommandError):
+            call_command('refresh_paper_totals', '--verify', stdout=io.StringIO())
+        call_command('refresh_paper_totals', stdout=io.StringIO())
+        self.assertTotals(30, 5)
+        call_command('refresh_paper_totals', '--verify', stdout=io.StringIO())
+
+
+class AIQuotaTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher = CustomUser.objects.create_user(username='t1', password='pw', student_id='T1', is_staff=True)
+        self.student = CustomUser.objects.create_user(username='s1', password='pw', student_id='S1')
+        question = ExamQuestion.objects.create(title='q', content='<p>q</p>', question_type='tf', is_correct=True,
+                                               points=10, ai_limit=2, created_by=self.teacher)
+        now = timezone.now()
+        self.paper = ExamPaper.objects.create(title='p', created_by=self.teacher,
+                                              publish_time=now - timezone.timedelta(hours=1),
+                                              start_time=now - timezone.timedelta(hours=1),
+                                              end_time=now + timezone.timedelta(hours=1))
+        self.paper.questions.add(question)
+        quota.reset(quota.subject_for(self.student.pk), self.paper.id)
+
+    def _ask(self, client):
+        return client.post(reverse('room:exam'), {'action': 'ai_question', 'prompt': 'hi', 'paper_id': self.paper.id})
+
+    def test_quota_is_shared_across_devices_without_session_writes(self):
+        laptop, phone = Client(), Client()
+        laptop.force_login(self.student)
+        phone.force_login(self.student)
+        self.assertEqual(self._ask(laptop).json()['remaining'], 1)
+        self.assertEqual(self._ask(phone).json()['remaining'], 0)
+        self.assertEqual(self._ask(laptop).status_code, 403)
+        self.assertFalse(any(key.startswith('ai_remaining_') for key in laptop.session.keys()))
+
+        response = laptop.get(reverse('room:exam'))
+        self.assertEqual(response.context['ai_remaining'], 0)
+
+    def test_concurrent_consume_never_overspends(self):
+        subject = quota.subject_for(self.student.pk)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(quota.consume(subject, self.paper.id, 5)))
+                   for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sum(ok for ok, _ in results), 5)
+        self.assertEqual(quota.refund(subject, self.paper.id, 5), 1)
+
+    @override_settings(AI_QUOTA={'BACKEND': 'redis', 'REDIS_URL': 'redis://127.0.0.1:9/0'})   # 無人監聽
+    def test_unreachable_quota_service_degrades_instead_of_erroring(self):
+        self.client.force_login(self.student)
+        page = self.client.get(reverse('room:exam'))
+        self.assertEqual(page.status_code, 200)
+        self.assertIsNone(page.context['ai_remaining'])
+        self.assertContains(page, '暫時無法取得')
+
+        self.assertEqual(self._ask(self.client).status_code, 503)
+        response = self.client.post(reverse('room:ai_webhook'), {'prompt': 'hi', 'paper_id': self.paper.id},
+                                    content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['remaining']), (503, None))
+        self.assertFalse(InteractionLog.objects.filter(user=self.student).exists())
+
+    @override_settings(AI_BACKEND={'BACKEND': 'stub', 'LATENCY_MEAN': 0, 'TOKENS_PER_SECOND': 0})
+    def test_answer_cache_is_scoped_to_the_question(self):
+        other = ExamQuestion.objects.create(title='q2', content='<p>q2</p>', question_type='tf', is_correct=True,
+                                            points=10, ai_limit=3, created_by=self.teacher)
+        self.paper.questions.add(other)
+        ExamPaper.objects.filter(id=self.paper.id).update(ai_answer_cache=True)
+        first = self.paper.questions.exclude(id=other.id).get()
+        answer_cache.clear()
+        self.addCleanup(answer_cache.clear)
+        self.client.force_login(self.student)
+
+        def ask(**extra):
+            response = self.client.post(reverse('room:ai_webhook'), {'prompt': '選項 B 是什麼意思？', 'paper_id': self.paper.id, **extra},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+
+        ask(question_id=first.id)
+        ask(question_id=other.id)   # 另一題的同一句話不能命中第一題的回覆
+        ask()                       # 沒帶題目：不查也不存
+        stats = answer_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (0, 2, 2))
+        ask(question_id=other.id)
+        self.assertEqual(answer_cache.stats()['hits'], 1)
+
+    # WhiteNoise、ProfilingMiddleware 是同步 middleware：測試 client 在同一個 thread 裡跑所有請求，
+    # 經過它們會讓並發請求逐一執行（ASGIHandler 下每個請求各有 thread，不受影響）
+    @override_settings(MIDDLEWARE=[m for m in settings.MIDDLEWARE
+                                   if 'whitenoise' not in m and 'ProfilingMiddleware' not in m])
+    async def test_coalesced_webhook_calls_still_charge_and_log_each_student(self):
+        students = [await CustomUser.objects.acreate(username=f'w{i}', student_id=f'W{i}') for i in range(5)]
+        clients = []
+        for student in students:
+            client = AsyncClient()
+            await client.aforce_login(student)
+            clients.append(client)
+
+        with StubGeminiServer(latency=0.2, reply='stub answer') as server:
+            gemini.configure_client(base_url=server.base_url, api_key='stub')
+            try:
+                body = json.dumps({'prompt': '第一題在問什麼？', 'paper_id': self.paper.id})
+                responses = await asyncio.gather(*(
+                    c.post(reverse('room:ai_webhook'), body, content_type='application/json') for c in clients
+                ))
+            finally:
+                gemini.configure_client()
+            self.assertEqual(server.requests, 1)
+
+        self.assertEqual([r.json() for r in responses], [{'response': 'stub answer', 'remaining': 1}] * 5)
+        self.assertEqual(await InteractionLog.objects.filter(user__in=students, exam_paper=self.paper).acount(), 5)
+        remaining = [await sync_to_async(quota.remaining_many)(quota.subject_for(s.pk), {self.paper.id: 2})
+                     for s in students]
+        self.assertEqual(remaining, [{self.paper.id: 1}] * 5)
+
+    async def test_upstream_rate_limit_returns_503_and_refunds(self):
+        scheduler.configure(retries=0)
+        self.addCleanup(scheduler.configure)
+        client = AsyncClient()
+        await client.aforce_login(self.student)
+        with StubGeminiServer(latency=0.01, rate_limited=100) as server:
+            gemini.configure_client(base_url=server.base_url, api_key='stub')
+            try:
+                response = await client.post(reverse('room:ai_webhook'),
+                                             json.dumps({'prompt': 'hi', 'paper_id': self.paper.id}),
+                                             content_type='application/json')
+            finally:
+                gemini.configure_client()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(response.json()['remaining'], 2)
+
+    async def _ask_sse(self, client):
+        body = json.dumps({'prompt': 'hi', 'paper_id': self.paper.id})
+        response = await client.post(reverse('room:ai_webhook'), body, content_type='application/json',
+                                     headers={'Accept': 'text/event-stream'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        raw = b''.join([part async for part in response.streaming_content]).decode()
+        events = []
+        for block in filter(None, raw.split('\n\n')):
+            name, data = block.split('\n')
+            events.append((name.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+        return events
+
+    async def test_webhook_sse_streams_chunks_and_refunds_on_failure(self):
+        client = AsyncClient()
+        await client.aforce_login(self.student)
+        with StubGeminiServer(latency=0.1, reply='abcdef', chunks=3) as server:
+            gemini.configure_client(base_url=server.base_url, api_key='stub')
+            try:
+                events = await self._ask_sse(client)
+            finally:
+                gemini.configure_client()
+        self.assertEqual(events, [('chunk', {'data': 'ab'}), ('chunk', {'data': 'cd'}), ('chunk', {'data': 'ef'}),
+                                  ('done', {'remaining': 1})])
+        self.assertEqual(await InteractionLog.objects.filter(user=self.student).acount(), 1)
+
+        gemini.configure_client(base_url='http://127.0.0.1:9/', api_key='stub')   # 無人監聽
+        try:
+            events = await self._ask_sse(client)
+        finally:
+            gemini.configure_client()
+        self.assertEqual([(name, data['remaining']) for name, data in events], [('error', 1)])
+        self.assertEqual(await InteractionLog.objects.filter(user=self.student).acount(), 1)
+
+
+class GradebookTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher = CustomUser.objects.create_user(username='t1', password='pw', student_id='T1', is_staff=True)
+        questions = ExamQuestion.objects.bulk_create([
+            ExamQuestion(title=f'q{i}', content='<p>q</p>', question_type='sc', options=['a', 'b'],
+                         correct_option_indices='0', points=1, created_by=self.teacher)
+            for i in range(5)
+        ])
+        self.paper = ExamPaper.objects.create(title='p', created_by=self.teacher)
+        self.paper.questions.set(questions)
+        self.answers = {str(q.id): '0' for q in questions}
+
+    def _add_students(self, start, count):
+        password = make_password('pw')   # 共用一個雜湊，避免逐一雜湊拖慢測試
+        for i in range(start, start + count):
+            student = CustomUser.objects.create(username=f's{i}', password=password, student_id=f'S{i}', class_name='A')
+            submit_paper(student, self.paper, self.answers, timezone.now())
+
+    def _render_queries(self):
+        self.client.force_login(self.teacher)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('room:student_exam_history'))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self._add_students(0, 2)
+        few, _ = self._render_queries()
+        self._add_students(2, 8)
+        many, response = self._render_queries()
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.context['detailed_records']), 10)
+        self.assertEqual(len(response.context['detailed_records'][0]['answers']), 5)
+
+    def test_filters_and_pagination(self):
+        self._add_students(0, 25)
+        page, records = load_gradebook_page(2, class_name='A', paper_id=self.paper.id)
+        self.assertEqual(len(records), 5)
+        page, records = load_gradebook_page(1, student_id='S3')
+        self.assertEqual([r['student_id'] for r in records], ['S3'])
+
+    def test_streaming_export(self):
+        self._add_students(0, 3)
+        self.client.force_login(self.teacher)
+        response = self.client.get(reverse('room:export_gradebook'), {'paper': self.paper.id})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(len(lines), 1 + 3 * (5 + 1))  # 表頭 + 每人 5 題與 1 列總分
+        self.assertTrue(lines[6].startswith('total,S0,'))
+
+        apply_curve(self.paper.id, 'linear', never_lower=False, scale=1, offset=-2)
+        rows = list(iter_export_rows(paper_id=self.paper.id))
+        total = dict(zip(rows[0], rows[6]))
+        self.assertEqual((total['score'], total['raw_score']), (3, 5))   # 總分為曲線後的 ExamRecord.score
+
+        response = self.client.get(reverse('room:export_gradebook'), {'paper': self.paper.id, 'format': 'xlsx'})
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as zf:
+            sheet = zf.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        self.assertEqual(sheet.count('<row>'), 19)
+
+    async def test_asgi_export_streams_before_reading_everything(self):
+        # 600 列以上：stream_csv 每 500 列送出一段，第一段送出時資料尚未讀完
+        await sync_to_async(self._add_students)(0, 100)
+        consumed = 0
+
+        def counting_rows(**kwargs):
+            nonlocal consumed
+            for row in iter_export_rows(**kwargs):
+                consumed += 1
+                yield row
+
+        client = AsyncClient()
+        await client.aforce_login(self.teacher)
+        with mock.patch('room.views.iter_export_rows', counting_rows):
+            response = await client.get(reverse('room:export_gradebook'), {'paper': self.paper.id})
+            chunks = aiter(response.streaming_content)
+            first = await anext(chunks)
+            self.assertTrue(first.startswith('\ufeff'.encode('utf-8')))
+            self.assertLess(consumed, 1 + 100 * 6)
+            rest = [chunk async for chunk in chunks]
+        self.assertEqual(consumed, 1 + 100 * 6)
+        self.assertEqual(len(b''.join([first] + rest).decode('utf-8-sig').splitlines()), 1 + 100 * 6)
+
+    def test_bulk_adjustments(self):
+        self._add_students(0, 4)
+        first_q = int(next(iter(self.answers)))
+        self.client.force_login(self.teacher)
+        url = reverse('room:bulk_adjust_scores')
+
+        response = self.client.post(url, {'paper_id': self.paper.id, 'action': 'shift', 'question_id': first_q, 'delta': -1},
+                                    content_type='application/json')
+        self.assertEqual(response.json()['updated'], 4)
+        self.assertEqual(set(ExamRecord.objects.values_list('score', flat=True)), {4})
+        self.assertEqual(set(StudentExamHistory.objects.values_list('total_score', flat=True)), {4})
+
+        apply_curve(self.paper.id, 'linear', scale=2, offset=1)
+        self.assertEqual(set(ExamRecord.objects.values_list('score', flat=True)), {5})  # 9 截到考卷總分 5
+
+        history = StudentExamHistory.objects.get(student__student_id='S0')
+        self.client.post(reverse('room:student_exam_history'), {'update_scores': history.id, f'score_{first_q}': '1'})
+        history.refresh_from_db()
+        self.assertEqual(history.total_score, 5)
+
+        response = self.client.post(url, {'paper_id': self.paper.id, 'action': 'curve', 'method': 'bogus'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_curve_is_reapplied_after_later_adjustments(self):
+        self._add_students(0, 3)
+        first_q = int(next(iter(self.answers)))
+        apply_curve(self.paper.id, 'linear', never_lower=False, scale=1, offset=-2)
+        self.assertEqual(set(ExamRecord.objects.values_list('score', flat=True)), {3})
+
+        self.client.force_login(self.teacher)
+        url = reverse('room:bulk_adjust_scores')
+        response = self.client.post(url, {'paper_id': str(self.paper.id), 'action': 'shift', 'question_id': first_q,
+                                          'delta': -1}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(ExamRecord.objects.values_list('score', flat=True)), {2})   # 原始 4，仍套用曲線
+        self.assertEqual(set(StudentExamHistory.objects.values_list('total_score', flat=True)), {2})
+        self.assertContains(self.client.get(reverse('room:student_exam_history'), {'paper': self.paper.id}), '移除曲線')
+
+        self.client.post(url, {'paper_id': self.paper.id, 'action': 'clear_curve'}, content_type='application/json')
+        self.assertEqual(set(ExamRecord.objects.values_list('score', flat=True)), {4})
+        response = self.client.post(url, {'paper_id': 'abc', 'action': 'clear_curve'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_curve_survives_resubmission_and_autosave(self):
+        self._add_students(0, 2)
+        apply_curve(self.paper.id, 'linear', never_lower=False, scale=1, offset=-2)
+        self.paper.refresh_from_db()
+        student = CustomUser.objects.get(student_id='S0')
+
+        def totals():
+            record = ExamRecord.objects.get(student=student, exam_paper=self.paper)
+            history = StudentExamHistory.objects.get(student=student, exam_paper=self.paper)
+            return record.score, history.total_score
+
+        record = submit_paper(student, self.paper, self.answers, timezone.now())   # 重新提交：原始 5 分
+        self.assertEqual((record.score, totals()), (3, (3, 3)))
+
+        grader = next(iter(get_paper_graders(self.paper).values()))
+        save_single_answer(student, self.paper, grader, '1', timezone.now())       # 答錯一題：原始 4 分
+        self.assertEqual(totals(), (2, 2))
+        save_answers_batch(student, self.paper, [{'question_id': grader.question_id, 'answer': '0', 'client_seq': 1}],
+                           timezone.now())
+        self.assertEqual(totals(), (3, 3))
+
+    def test_key_edit_regrades_only_when_confirmed(self):
+        self._add_students(0, 2)
+        first_q = int(next(iter(self.answers)))
+        ExamAnswer.objects.filter(exam_question_id=first_q, exam_record__student__student_id='S0').update(score=0)  # 手動調分
+        self.client.force_login(self.teacher)
+        edit = {'question_id': first_q, 'question_text': '<p>q</p>', 'title': 'q0', 'question_type': 'sc',
+                'option_1': 'a', 'option_2': 'b', 'correct_option': '1', 'points': 1, 'ai_limit': 1}
+
+        response = self.client.post(reverse('room:teacher_exam'), edit, follow=True)
+        self.assertContains(response, '2 筆既有作答未重新判分')
+        self.assertEqual(sorted(ExamAnswer.objects.filter(exam_question_id=first_q).values_list('score', flat=True)), [0, 1])
+
+        self.client.post(reverse('room:teacher_exam'), {**edit, 'correct_option': '0', 'regrade_existing': '1'})
+        self.client.post(reverse('room:teacher_exam'), {**edit, 'regrade_existing': '1'})
+        self.assertEqual(set(ExamAnswer.objects.filter(exam_question_id=first_q).values_list('score', flat=True)), {0})
+
+    def test_percentile_curve(self):
+        self._add_students(0, 3)
+        ExamAnswer.objects.filter(exam_record__student__student_id='S0').update(score=0)
+        ExamAnswer.objects.filter(exam_record__student__student_id='S1', exam_question_id__in=list(self.answers)[:2]).update(score=0)
+        apply_curve(self.paper.id, 'percentile', never_lower=False, floor=1, ceiling=5)
+        scores = dict(ExamRecord.objects.values_list('student__student_id', 'score'))
+        self.assertEqual(scores, {'S0': 1, 'S1': 3, 'S2': 5})
+
+    def test_regrade_after_key_edit(self):
+        mcq = ExamQuestion.objects.create(title='m', content='<p>m</p>', question_type='mcq', options=['a', 'b', 'c'],
+                                          correct_option_indices='0,2', points=2, created_by=self.teacher)
+        self.paper.questions.add(mcq)
+        self.answers[str(mcq.id)] = ['0', '2']  # 多選答案以 str(list) 存入
+        self._add_students(0, 3)
+        self.assertEqual(regrade_paper(self.paper.id)['changed'], 0)  # 與提交時的判分一致
+
+        first_q = ExamQuestion.objects.get(id=int(next(iter(self.answers))))
+        first_q.correct_option_indices = '1'
+        first_q.save()
+        mcq.correct_option_indices = '0'
+        mcq.save()
+        call_command('regrade_paper', self.paper.id, stdout=io.StringIO())
+        self.assertEqual(set(ExamRecord.objects.values_list('score', flat=True)), {4})
+        self.assertEqual(set(StudentExamHistory.objects.values_list('total_score', flat=True)), {4})
+        self.assertFalse(ExamAnswer.objects.filter(exam_question=mcq, is_correct=True).exists())
+
+
+class FakeRedis:
+    """RedisSink 用到的 list 指令；down=True 時模擬 Redis 斷線。"""
+
+    def __init__(self):
+        self.lists, self.keys, self.down = {}, set(), False
+
+    def _check(self):
+        if self.down:
+            raise redis.ConnectionError('down')
+
+    def rpush(self, key, *values):
+        self._check()
+        self.lists.setdefault(key, []).extend(v.encode() for v in values)
+
+    def lrange(self, key, start, end):
+        self._check()
+        return list(self.lists.get(key, []))
+
+    def llen(self, key):
+        self._check()
+        return len(self.lists.get(key, []))
+
+    def lmove(self, src, dst, wherefrom, whereto):
+        self._check()
+        src, dst = (k.decode() if isinstance(k, bytes) else k for k in (src, dst))
+        items = self.lists.get(src)
+        if not items:
+            return None
+        item = items.pop(0 if wherefrom == 'LEFT' else -1)
+        target = self.lists.setdefault(dst, [])
+        target.insert(0 if whereto == 'LEFT' else len(target), item)
+        return item
+
+    def set(self, key, value, ex=None):
+        self._check()
+        self.keys.add(key)
+
+    def exists(self, key):
+        self._check()
+        return key in self.keys
+
+    def delete(self, key):
+        self._check()
+        self.lists.pop(key, None)
+
+    def scan_iter(self, match):
+        self._check()
+        return [k.encode() for k in list(self.lists) if fnmatch.fnmatchcase(k, match) and self.lists[k]]
+
+    def pipeline(self):
+        client, calls = self, []
+
+        class Pipeline:
+            def lmove(self, *args):
+                calls.append(args)
+
+            def execute(self):
+                return [client.lmove(*args) for args in calls]
+
+        return Pipeline()
+
+
+class InteractionLogSinkTests(TestCase):
+    def setUp(self):
+        self.student = CustomUser.objects.create_user(username='s1', password='pw', student_id='S1')
+
+    def _sink(self, backend=logsink.BufferedSink, **options):
+        sink = backend({**logsink.DEFAULTS, 'BATCH_SIZE': 2, 'FLUSH_INTERVAL': 0.01, **options})
+        self.addCleanup(sink.close)
+        return sink
+
+    def _entries(self, n):
+        return [logsink.to_entry(InteractionLog(user=self.student, question=f'Q{i}', response='A')) for i in range(n)]
+
+    def test_buffered_sink_writes_in_batches_and_drains_on_close(self):
+        sink = self._sink()
+        entries = self._entries(5)
+        for entry in entries:
+            entry['created_at'] -= timezone.timedelta(minutes=5)
+        sink._put(entries)   # 不啟動 flusher，由 close() 在本執行緒寫完
+        with mock.patch.object(logsink, '_write', wraps=logsink._write) as write:
+            sink.close()
+
+        self.assertEqual([len(call.args[0]) for call in write.call_args_list], [2, 2, 1])
+        self.assertEqual(sorted(InteractionLog.objects.values_list('question', 'created_at')),
+                         [(e['question'], e['created_at']) for e in entries])
+
+    def test_flusher_keeps_running_after_errors(self):
+        sink = self._sink()
+        take = sink._take
+        failures = iter([ConnectionError('redis down')])
+
+        def flaky_take(limit, block):
+            for error in failures:
+                raise error
+            return take(limit, block)
+
+        written = threading.Event()
+        with mock.patch.object(sink, '_take', side_effect=flaky_take), \
+                mock.patch.object(logsink, '_write', side_effect=lambda entries, size: written.set()), \
+                self.assertLogs('room.logsink', 'WARNING') as logs:
+            sink.enqueue(self._entries(1))
+            self.assertTrue(written.wait(5))
+            self.assertTrue(sink._thread.is_alive())
+        self.assertIn('flusher 發生錯誤', logs.output[0])
+
+    @override_settings(INTERACTION_LOG_SINK={'BACKEND': 'redis', 'REDIS_URL': 'redis://127.0.0.1:9/0'})   # 無人監聽
+    def test_enqueue_failure_after_commit_falls_back_to_direct_write(self):
+        with self.assertLogs('room.logsink', 'WARNING') as logs:
+            with self.captureOnCommitCallbacks(execute=True):
+                logsink.log_interaction(user=self.student, question='Q', response='A')
+            logsink.shutdown()
+
+        self.assertEqual(InteractionLog.objects.filter(user=self.student, question='Q').count(), 1)
+        self.assertIn('入列失敗', logs.output[0])
+
+    def _redis_sink(self):
+        client = FakeRedis()
+        with mock.patch('redis.Redis.from_url', return_value=client):
+            sink = self._sink(logsink.RedisSink)
+        return sink, client
+
+    def test_redis_batches_are_acked_only_after_the_write(self):
+        sink, client = self._redis_sink()
+        processing = sink._worker_key('processing')
+        entries = self._entries(3)
+        sink._put(entries)
+
+        with mock.patch.object(logsink, '_write', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                sink._flush_batch(block=False)
+        self.assertEqual(len(client.lists[processing]), 2)   # 未確認的批次留在處理中 list
+        self.assertEqual(len(client.lists[sink._key]), 1)
+
+        client.down = True
+        with self.assertRaises(redis.ConnectionError):
+            sink._flush_batch(block=False)
+        client.down = False
+
+        sink.drain()
+        self.assertEqual(sorted(InteractionLog.objects.values_list('question', 'created_at')),
+                         [(e['question'], e['created_at']) for e in entries])   # 保留入列時的時間
+        self.assertFalse(client.lists.get(processing))
+        self.assertFalse(client.lists[sink._key])
+
+    def test_redis_batches_of_dead_workers_are_requeued(self):
+        sink, client = self._redis_sink()
+        dead, alive = self._entries(2)
+        client.rpush(sink._worker_key('processing', 'host:1'), sink._encode(dead))
+        client.rpush(sink._worker_key('processing', 'host:2'), sink._encode(alive))
+        client.set(sink._worker_key('heartbeat', 'host:2'), 1)
+
+        self.assertEqual(sink._flush_batch(block=True), 0)   # 閒置時回收心跳已過期的 worker
+        self.assertEqual(sink._flush_batch(block=False), 1)
+        self.assertEqual(list(InteractionLog.objects.values_list('question', flat=True)), ['Q0'])
+        self.assertEqual(len(client.lists[sink._worker_key('processing', 'host:2')]), 1)
+
+
+class LoadTestCommandTests(TransactionTestCase):
+    # 壓測的同步 view 在各自的 thread（各自的連線）執行，需要看得到已提交的種子資料；
+    # 測試用的 in-memory SQLite 併發寫入會鎖表，因此一次只跑一位學生
+    def test_reports_every_endpoint_and_cleans_up(self):
+        out = io.StringIO()
+        call_command('loadtest_exam', '--students', '2', '--questions', '3', '--ai-questions', '1',
+                     '--ai-latency', '0', '--concurrency', '1', '--no-redis', stdout=out, stderr=io.StringIO())
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['students_completed'], 2)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(set(report['endpoints']), {
+            'login', 'select_exam', 'exam', 'submit_single_answer', 'exam_json', 'answers_batch',
+            'ai_webhook', 'submit',
+        })
+        self.assertEqual(report['endpoints']['ai_webhook']['requests'], 2)
+        self.assertGreater(report['endpoints']['submit']['queries'], 0)
+        self.assertFalse(CustomUser.objects.filter(username__startswith='loadtest_').exists())
+
+    def test_percentiles_use_nearest_rank(self):
+        values = list(range(1, 11))
+        self.assertEqual([_percentile(values, p) for p in (50, 90, 95, 100)], [5, 9, 10, 10])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.student = CustomUser.objects.create_user(username='s1', password='pw', student_id='S1')
+
+    def _scrape(self, **headers):
+        response = self.client.get(reverse('room:metrics'), **headers)
+        self.assertEqual(response.status_code, 200)
+        return dict(line.rsplit(' ', 1) for line in response.content.decode().splitlines()
+                    if not line.startswith('#'))
+
+    @override_settings(AI_BACKEND={'BACKEND': 'stub', 'LATENCY_MEAN': 0, 'TOKENS_PER_SECOND': 0, 'REPLY_TOKENS': 5})
+    def test_requests_queries_and_ai_calls_are_exported(self):
+        key = 'http_request_duration_seconds_count{view="room:home",method="GET",status="200"}'
+        before = float(self._scrape().get(key, 0))
+        self.client.get(reverse('room:home'))
+        self.client.get(reverse('room:home'))
+        self.client.force_login(self.student)
+        self.client.get(reverse('room:profile'))
+        tokens = 'ai_tokens_total{backend="stub",kind="completion"}'
+        tokens_before = float(self._scrape().get(tokens, 0))
+        self.client.post(reverse('room:ai_webhook'), {'prompt': '你好'}, content_type='application/json')
+
+        samples = self._scrape()
+        self.assertEqual(float(samples[key]) - before, 2)
+        self.assertEqual(samples['http_request_duration_seconds_bucket{view="room:home",method="GET",status="200",le="+Inf"}'],
+                         samples[key])
+        self.assertGreater(float(samples['http_request_db_queries_sum{view="room:profile"}']), 0)
+        self.assertIn('ai_call_duration_seconds_count{backend="stub",mode="generate",outcome="ok"}', samples)
+        self.assertEqual(float(samples[tokens]) - tokens_before, 5)
+        self.assertIn('ai_scheduler_events_total{event="admitted"}', samples)
+
+        with override_settings(METRICS={'BACKEND': 'memory', 'TOKEN': 'secret'}):
+            self.assertEqual(self.client.get(reverse('room:metrics')).status_code, 401)
+            self._scrape(HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(self.client.get(reverse('room:metrics'), HTTP_AUTHORIZATION='Bearer secreT').status_code, 401)
+            self._scrape(HTTP_AUTHORIZATION='Bearer secret', REMOTE_ADDR='8.8.8.8')
+
+        # 沒有 token 時只接受內部位址
+        self.assertEqual(self.client.get(reverse('room:metrics'), REMOTE_ADDR='8.8.8.8').status_code, 403)
+        self._scrape(REMOTE_ADDR='10.0.0.8')
+
+
+class SlowQueryLogTests(TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.log_dir.cleanup)
+        self.path = os.path.join(self.log_dir.name, 'slow.log')
+        self.teacher = CustomUser.objects.create_user(username='t1', password='pw', student_id='T1', is_staff=True)
+        paper = ExamPaper.objects.create(title='期中考', created_by=self.teacher)
+        for i in range(3):
+            paper.questions.add(ExamQuestion.objects.create(
+                title=f'Q{i}', content=f'第 {i} 題', question_type='tf', is_correct=True, created_by=self.teacher,
+            ))
+        self.client.force_login(self.teacher)
+
+    def test_shape_strips_parameters(self):
+        self.assertEqual(
+            slowlog.shape("SELECT * FROM t WHERE a = %s AND b IN (%s, %s, %s) AND c = 'x' LIMIT 21"),
+            'SELECT * FROM t WHERE a = ? AND b IN (...) AND c = ? LIMIT ?',
+        )
+
+    def test_repeated_shapes_are_logged_with_callsite_and_summarized(self):
+        with override_settings(SLOW_QUERY_LOG={'ENABLED': True, 'THRESHOLD_MS': 10 ** 6, 'REPEAT_THRESHOLD': 3,
+                                               'PATH': self.path}):
+            self.client.get(reverse('room:teacher_exam'))
+            entries = list(slowlog.read_entries())
+            out = io.StringIO()
+            call_command('slow_queries', '--sort', 'count', stdout=out)
+
+        self.assertTrue(entries)
+        entry = max(entries, key=lambda e: e['count'])
+        self.assertEqual(entry['view'], 'room:teacher_exam')
+        self.assertGreaterEqual(entry['count'], 3)
+        self.assertEqual(entry['slow'], 0)
+        self.assertTrue(entry['callsite'].startswith('room/views.py:'), entry['callsite'])
+        self.assertNotIn('%s', entry['shape'])
+        self.assertIn(entry['callsite'], out.getvalue())
+
+    def test_each_process_writes_its_own_file_and_reads_merge_them(self):
+        older = {'time': '2000-01-01T00:00:00+00:00', 'view': None, 'shape': 'SELECT ?', 'callsite': None,
+                 'function': None, 'count': 1, 'slow': 1, 'total_ms': 500.0, 'max_ms': 500.0}
+        with open(slowlog.process_path(self.path, pid=1), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(older) + '\n')
+        with override_settings(SLOW_QUERY_LOG={'ENABLED': True, 'THRESHOLD_MS': 10 ** 6, 'REPEAT_THRESHOLD': 3,
+                                               'PATH': self.path}):
+            self.client.get(reverse('room:teacher_exam'))
+            entries = list(slowlog.read_entries())
+
+        self.assertTrue(os.path.exists(slowlog.process_path(self.path)))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(entries[0], older)   # 另一個行程較早的記錄排在前面
+        self.assertEqual({e['view'] for e in entries[1:]}, {'room:teacher_exam'})
+
+
+@override_settings(PROFILING={**settings.PROFILING, 'ENABLED': True})
+class ProfilingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher = CustomUser.objects.create_user(username='t1', password='pw', student_id='T1', is_staff=True)
+        self.client.force_login(self.teacher)
+
+    def test_signed_header_and_rate_select_requests(self):
+        self.client.get(reverse('room:home'), headers={profiling.HEADER: 'forged'})
+        self.assertEqual(profiling.views(), [])
+
+        self.client.get(reverse('room:home'), headers={profiling.HEADER: profiling.make_token()})
+        [profile] = profiling.profiles('room:home')
+        self.assertEqual((profile['trigger'], profile['status']), ('header', 200))
+
+        self.client.post(reverse('room:profiling'), {'rate': '1', 'views': ['room:readme']})
+        self.client.get(reverse('room:home'))
+        self.client.get(reverse('room:readme'))
+        self.assertEqual(len(profiling.profiles('room:home')), 1)
+        self.assertEqual(profiling.profiles('room:readme')[0]['trigger'], 'rate')
+
+        response = self.client.get(reverse('room:profiling'), {'view': 'room:readme'})
+        self.assertContains(response, 'room:readme')
+        self.client.post(reverse('room:profiling'), {'rate': '0'})
+
+    def test_async_views_are_not_sampled(self):
+        self.client.post(reverse('room:ai_webhook'), {'prompt': ''}, content_type='application/json',
+                         headers={profiling.HEADER: profiling.make_token()})
+        self.assertEqual(profiling.views(), [])
+
+    def test_sampler_collapses_stacks(self):
+        def busy_view():
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+
+        sampler = profiling.Sampler(threading.get_ident(), 0.002, 64).start()
+        busy_view()
+        sampler.stop()
+        stacks = list(sampler.stacks)
+        self.assertTrue(stacks)
+        self.assertTrue(any('busy_view (room/tests.py:' in stack.rsplit(';', 1)[-1] for stack in stacks))
+
+
+QUERY_BUDGETS_PATH = Path(__file__).with_name('query_budgets.json')
+
+
+@override_settings(AI_BACKEND={'BACKEND': 'stub', 'LATENCY_MEAN': 0, 'TOKENS_PER_SECOND': 0})
+class ViewQueryBudgetTests(TestCase):
+    """
+    以接近實際規模的資料（題數、學生數見 query_budgets.json 的 fixture）逐一呼叫 room/urls.py 的每個 view，
+    查詢數不得超過 query_budgets.json 的預算；耗時超過 ms 預算只輸出提醒（會隨機器負載浮動）。
+    每個請求先送一次暖機（判分快取、session），量第二次。
+    調整預算：UPDATE_QUERY_BUDGETS=1 python manage.py test room.tests.ViewQueryBudgetTests
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        budgets = json.loads(QUERY_BUDGETS_PATH.read_text(encoding='utf-8'))
+        n_questions, n_students = budgets['fixture']['questions'], budgets['fixture']['students']
+        password = make_password('pw')
+        cls.teacher = CustomUser.objects.create(username='t1', student_id='T1', password=password, is_staff=True)
+        kinds = [
+            dict(question_type='sc', options=['a', 'b', 'c'], correct_option_indices='0'),
+            dict(question_type='mcq', options=['a', 'b', 'c'], correct_option_indices='0,2'),
+            dict(question_type='tf', is_correct=True),
+        ]
+        questions = ExamQuestion.objects.bulk_create([
+            ExamQuestion(title=f'q{i}', content=f'<p>q{i}</p>', points=2, ai_limit=1, created_by=cls.teacher,
+                         **kinds[i % 3])
+            for i in range(n_questions)
+        ])
+        now = timezone.now()
+        cls.paper = ExamPaper.objects.create(title='期中考', created_by=cls.teacher,
+                                             publish_time=now - timezone.timedelta(hours=1),
+                                             start_time=now - timezone.timedelta(hours=1),
+                                             end_time=now + timezone.timedelta(hours=2))
+        cls.paper.questions.set(questions)
+        sample = {'sc': '0', 'mcq': ['0', '2'], 'tf': 'true'}
+        cls.answers = {str(q.id): sample[q.question_type] for q in questions}
+        cls.question_ids = [q.id for q in questions]
+
+        students = CustomUser.objects.bulk_create([
+            CustomUser(username=f's{i}', student_id=f'S{i}', password=password, class_name='AB'[i % 2])
+            for i in range(n_students)
+        ])
+        # students[0] 為作答中的學生（已自動儲存一半的題目），其他人都已交卷
+        cls.student = students[0]
+        graders = list(get_paper_graders(cls.paper).values())
+        for grader in graders[:len(graders) // 2]:
+            save_single_answer(cls.student, cls.paper, grader, '0', now)
+        for student in students[1:]:
+            submit_paper(student, cls.paper, cls.answers, now)
+        cls.history_id = StudentExamHistory.objects.filter(student=students[1]).values_list('id', flat=True).first()
+
+    def _cases(self):
+        """(名稱, 登入者, method, URL name, 參數)；依序執行，會改變狀態的放在後面。"""
+        qid = self.question_ids[0]
+        single = {'paper_id': self.paper.id, 'question_id': qid, 'answer': '0'}
+        return [
+            ('home GET', None, 'get', 'room:home', {}),
+            ('readme GET', None, 'get', 'room:readme', {}),
+            ('login GET', None, 'get', 'room:login', {}),
+            ('login POST', None, 'post', 'room:login', {'data': {'student_id': 'S0', 'password': 'pw'}}),
+            ('register GET', None, 'get', 'room:register', {}),
+            ('select_exam GET', self.student, 'get', 'room:select_exam', {}),
+            ('select_exam POST', self.student, 'post', 'room:select_exam', {'data': {'exam_paper': self.paper.id}}),
+            ('exam GET', self.student, 'get', 'room:exam', {}),
+            ('history GET', self.student, 'get', 'room:history', {}),
+            ('profile GET', self.student, 'get', 'room:profile', {}),
+            ('teacher_exam GET', self.teacher, 'get', 'room:teacher_exam', {}),
+            ('teacher_exam GET edit_exam', self.teacher, 'get', 'room:teacher_exam',
+             {'data': {'edit_exam': self.paper.id}}),
+            ('student_exam_history GET', self.teacher, 'get', 'room:student_exam_history', {}),
+            ('student_exam_history GET paper', self.teacher, 'get', 'room:student_exam_history',
+             {'data': {'paper': self.paper.id, 'page': 2}}),
+            ('export_gradebook GET', self.teacher, 'get', 'room:export_gradebook', {'data': {'paper': self.paper.id}}),
+            ('submit_single_answer POST', self.student, 'post', 'room:submit_single_answer',
+             {'data': single, 'content_type': 'application/json'}),
+            ('exam POST submit_answer', self.student, 'post', 'room:exam',
+             {'data': {'action': 'submit_answer', **single}, 'content_type': 'application/json'}),
+            ('submit_answers_batch POST', self.student, 'post', 'room:submit_answers_batch',
+             {'data': {'paper_id': self.paper.id, 'answers': [
+                 {'question_id': q, 'answer': '0', 'client_seq': i} for i, q in enumerate(self.question_ids)
+             ]}, 'content_type': 'application/json'}),
+            ('ask_exam_question POST', self.student, 'post', 'room:ask_exam_question',
+             {'data': {'question_id': qid, 'answer': '0'}}),
+            ('ask_ai POST', self.student, 'post', 'room:ask_ai', {'data': {'prompt': '提示', 'paper_id': self.paper.id}}),
+            ('ai_webhook POST', self.student, 'post', 'room:ai_webhook',
+             {'data': {'prompt': '提示', 'paper_id': self.paper.id}, 'content_type': 'application/json'}),
+            ('upload_question POST', self.teacher, 'post', 'room:upload_question',
+             {'data': {'title': '新題', 'question': '<p>新題</p>', 'ai_limit': 1}}),
+            ('bulk_adjust_scores POST', self.teacher, 'post', 'room:bulk_adjust_scores',
+             {'data': {'paper_id': self.paper.id, 'action': 'shift', 'question_id': qid, 'delta': -1},
+              'content_type': 'application/json'}),
+            ('student_exam_history POST update_scores', self.teacher, 'post', 'room:student_exam_history',
+             {'data': {'update_scores': self.history_id, f'score_{qid}': '1'}}),
+            ('exam POST submit', self.student, 'post', 'room:exam',
+             {'data': {'paper_id': self.paper.id, 'answers': json.dumps(self.answers)}}),
+            ('metrics GET', None, 'get', 'room:metrics', {}),
+            ('profiling GET', self.teacher, 'get', 'room:profiling', {}),
+            ('logout GET', self.student, 'get', 'room:logout', {}),
+        ]
+
+    def _measure(self, user, method, name, kwargs):
+        for attempt in range(2):
+            if user is None:
+                self.client.logout()
+            else:
+                self.client.force_login(user)
+            with CaptureQueriesContext(connection) as ctx:
+                started = time.perf_counter()
+                response = getattr(self.client, method)(reverse(name), **kwargs)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                elapsed = time.perf_counter() - started
+        self.assertLess(response.status_code, 400, name)
+        return len(ctx.captured_queries), elapsed * 1000
+
+    def test_views_within_budget(self):
+        budgets = json.loads(QUERY_BUDGETS_PATH.read_text(encoding='utf-8'))
+        cases = self._cases()
+
+        from . import urls
+        covered = {name.split(':')[1] for _, _, _, name, _ in cases}
+        self.assertEqual({p.name for p in urls.urlpatterns} - covered, set(), "有 view 沒有列入查詢預算")
+
+        measured = {}
+        for key, user, method, name, kwargs in cases:
+            with self.subTest(view=key):
+                measured[key] = self._measure(user, method, name, kwargs)
+
+        if os.getenv('UPDATE_QUERY_BUDGETS'):
+            budgets['views'] = {
+                key: {'queries': queries, 'ms': max(1000, math.ceil(ms * 5 / 100) * 100)}
+                for key, (queries, ms) in sorted(measured.items())
+            }
+            QUERY_BUDGETS_PATH.write_text(json.dumps(budgets, indent=2, ensure_ascii=False) + '\n', encoding='utf-8')
+            return
+
+        over, slow = [], []
+        for key, (queries, ms) in sorted(measured.items()):
+            budget = budgets['views'].get(key)
+            if budget is None:
+                over.append(f"{key}: 沒有預算（實測 {queries} 次查詢）")
+                continue
+            if queries > budget['queries']:
+                over.append(f"{key}: 查詢 {queries} 次，預算 {budget['queries']} 次（+{queries - budget['queries']}）")
+            if ms > budget['ms']:
+                slow.append(f"{key}: 耗時 {ms:.0f} ms，預算 {budget['ms']} ms")
+        # 耗時受機器與負載影響，只回報不判失敗；查詢數才是硬性門檻
+        if slow:
+            sys.stderr.write(f"\n{QUERY_BUDGETS_PATH.name} 耗時超出預算（僅供參考）：\n" + "\n".join(slow) + "\n")
+        if over:
+            self.fail(f"超出 {QUERY_BUDGETS_PATH.name} 的查詢預算：\n" + "\n".join(over))
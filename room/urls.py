@@ -18,6 +18,11 @@ urlpatterns = [
     path('upload_question/', views.upload_question, name='upload_question'),  # 出題提交
     path('ask_exam_question/', views.ask_exam_question, name='ask_exam_question'),  # 回答問題
     path('student_exam_history/', views.student_exam_history, name='student_exam_history'),
+    path('student_exam_history/adjust/', views.bulk_adjust_scores, name='bulk_adjust_scores'),
+    path('student_exam_history/export/', views.export_gradebook, name='export_gradebook'),  # 成績匯出
     path('submit_single_answer/', views.submit_single_answer, name='submit_single_answer'),
+    path('exam/answers/batch/', views.submit_answers_batch, name='submit_answers_batch'),  # 批次自動儲存
     path("webhooks/ai/", views.ai_webhook, name="ai_webhook"),  # 新增路由
+    path('metrics', views.prometheus_metrics, name='metrics'),  # Prometheus 指標
+    path('profiling/', views.profiling_page, name='profiling'),  # 取樣 profiler（教師）
 ]
\ No newline at end of file
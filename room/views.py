@@ -1,5 +1,8 @@
+import hmac
+import ipaddress
+
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.contrib.auth.views import LogoutView
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
@@ -7,10 +10,23 @@ from django.core.files.storage import default_storage
 from django.contrib.auth import login, authenticate, get_user_model
 from django.contrib.auth import logout as auth_logout
 from django.utils import timezone
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.asgi import ASGIRequest
 from django.db import IntegrityError
-from django.db.models import Sum
+from django.db.models import prefetch_related_objects
 from .models import CustomUser, ExamQuestion, ExamPaper, InteractionLog, StudentExamHistory, ExamAnswer, ExamRecord
 from .forms import CustomLoginForm, CustomUserCreationForm, AvatarUpdateForm
+from .grading import compile_question, get_paper_graders
+from .logsink import alog_interaction, log_interaction
+from .export import FORMATS as EXPORT_FORMATS, aiter_chunks, iter_rows as iter_export_rows, parse_day
+from .gradebook import load_gradebook_page
+from . import metrics, profiling, quota
+from .papers import get_active_papers
+from .regrade import (
+    RegradeError, apply_curve, clear_curve, override_question, regrade_paper, regrade_questions, set_record_scores,
+    shift_question,
+)
+from .submission import save_answers_batch, save_single_answer, submit_paper
 import bleach
 from django.utils.html import strip_tags
 import re
@@ -18,11 +34,15 @@ import json
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 import traceback
+from gemini_api import answer_cache
 from gemini_api.gemini import GeminiAPIWrapper
+from gemini_api.scheduler import Busy
 from asgiref.sync import sync_to_async
 from django.template.response import TemplateResponse
 import logging
 
+MAX_BATCH_ANSWERS = 200  # 批次自動儲存單次上限
+
 def home(request):
     return render(request, 'home.html')  # 首頁
 
@@ -49,7 +69,9 @@ def exam(request):
                     
                     try:
                         exam_paper = ExamPaper.objects.get(id=paper_id)
-                        question = exam_paper.questions.get(id=question_id)
+                        grader = get_paper_graders(exam_paper).get(int(question_id))
+                        if grader is None:
+                            raise ExamQuestion.DoesNotExist
                         
                         if current_time < exam_paper.start_time or current_time > exam_paper.end_time:
                             return JsonResponse({
@@ -57,55 +79,9 @@ def exam(request):
                                 'message': '考試時間已過或尚未開始'
                             }, status=403)
                         
-                        exam_record, created = ExamRecord.objects.get_or_create(
-                            student=request.user,
-                            exam_paper=exam_paper,
-                            defaults={'submitted_at': current_time, 'is_completed': False}
-                        )
-                        
-                        is_correct = False
-                        score = 0
-                        
-                        if answer is not None:
-                            if question.question_type == 'sc':
-                                try:
-                                    user_option_index = int(answer) if isinstance(answer, (str, int)) else None
-                                    correct_option_index = int(question.correct_option_indices) if question.correct_option_indices else None
-                                    is_correct = user_option_index == correct_option_index
-                                except (ValueError, TypeError):
-                                    is_correct = False
-                            elif question.question_type == 'mcq':
-                                try:
-                                    user_options = sorted(map(str, answer)) if isinstance(answer, list) else sorted(answer.split(',')) if answer else []
-                                    correct_options = sorted(question.correct_option_indices.split(',')) if question.correct_option_indices else []
-                                    is_correct = user_options == correct_options
-                                except Exception:
-                                    is_correct = False
-                            elif question.question_type == 'tf':
-                                student_bool = str(answer).lower() in ['true', '1', 't', 'yes', 'y', '是', '對', '正確']
-                                is_correct = student_bool == question.is_correct
-                            elif question.question_type in ['sa', 'essay']:
-                                is_correct = str(answer).strip().lower() == str(question.correct_option_indices).strip().lower() if question.correct_option_indices else False
-                            
-                            score = question.points if is_correct else 0
-                        
-                        ExamAnswer.objects.update_or_create(
-                            exam_record=exam_record,
-                            exam_question=question,
-                            defaults={
-                                'student_answer': answer,
-                                'score': score,
-                                'is_correct': is_correct
-                            }
-                        )
-                        
-                        InteractionLog.objects.create(
-                            user=request.user,
-                            question=f"題目: {question.title or question.content[:50]}..., 回答: {answer if answer is not None else '未作答'}",
-                            response=f"回答 {'正確' if is_correct else '錯誤' if question.correct_option_indices or question.is_correct else '已記錄'}, 得分: {score}/{question.points}",
-                            exam_question=question,
-                            exam_paper=exam_paper,
-                            score=score
+                        # 自動儲存只寫入答案；總分與成績紀錄在整卷提交時計算
+                        exam_record, is_correct, score = save_single_answer(
+                            request.user, exam_paper, grader, answer, current_time, update_totals=False
                         )
                         
                         return JsonResponse({
@@ -137,18 +113,18 @@ def exam(request):
                 if paper_id:
                     try:
                         exam_paper = ExamPaper.objects.get(id=paper_id)
-                        session_key = f'ai_remaining_{paper_id}'
-                        remaining = request.session.get(session_key, sum(q.ai_limit for q in exam_paper.questions.all()))
-                        
-                        if remaining <= 0:
+                        try:
+                            ok, remaining = quota.consume(
+                                quota.subject_for(request.user.pk), exam_paper.id, exam_paper.ai_total_limit
+                            )
+                        except quota.Unavailable:
+                            return JsonResponse({'error': 'AI 額度服務暫時無法使用，請稍後再試'}, status=503)
+                        if not ok:
                             return JsonResponse({'response': '已達 AI 提問上限！', 'remaining': 0}, status=403)
                         
                         response = "這是 AI 的模擬回應..."  # 請替換
                         
-                        remaining -= 1
-                        request.session[session_key] = remaining
-                        
-                        InteractionLog.objects.create(
+                        log_interaction(
                             user=request.user,
                             question=prompt,
                             response=response,
@@ -198,84 +174,8 @@ def exam(request):
                         answers = {}
                         print(f"JSON decode error: {e}")
 
-                    exam_record, created = ExamRecord.objects.update_or_create(
-                        student=student,
-                        exam_paper=exam_paper,
-                        defaults={'submitted_at': current_time, 'is_completed': True}
-                    )
-
-                    total_score = 0
-                    questions = exam_paper.questions.all()
-                    for question in questions:
-                        question_id = str(question.id)
-                        student_answer = answers.get(question_id)
-                        is_correct = False
-
-                        if student_answer is None or (isinstance(student_answer, list) and not any(student_answer)):
-                            student_answer = None
-                        elif isinstance(student_answer, str) and not student_answer.strip():
-                            student_answer = ''  
-
-                        print(f"Processing question {question_id}: student_answer = {student_answer}")  # 調試
-
-                        if student_answer is not None:
-                            if question.question_type == 'sc':
-                                try:
-                                    user_option_index = int(student_answer) if isinstance(student_answer, (str, int)) else None
-                                    correct_option_index = int(question.correct_option_indices) if question.correct_option_indices else None
-                                    is_correct = user_option_index == correct_option_index
-                                except (ValueError, TypeError):
-                                    is_correct = False
-                            elif question.question_type == 'mcq':
-                                try:
-                                    user_options = sorted(map(str, student_answer)) if isinstance(student_answer, list) else sorted(student_answer.split(',')) if student_answer else []
-                                    correct_options = sorted(question.correct_option_indices.split(',')) if question.correct_option_indices else []
-                                    is_correct = user_options == correct_options
-                                except Exception as e:
-                                    print(f"MCQ error: {e}")
-                                    is_correct = False
-                            elif question.question_type == 'tf':
-                                student_bool = str(student_answer).lower() in ['true', '1', 't', 'yes', 'y', '是', '對', '正確']
-                                is_correct = student_bool == question.is_correct
-                            elif question.question_type in ['sa', 'essay']:
-                                is_correct = str(student_answer).strip().lower() == str(question.correct_option_indices).strip().lower() if question.correct_option_indices else False
-
-                            score = question.points if is_correct else 0
-                            total_score += score
-                        else:
-                            score = 0
-
-                        ExamAnswer.objects.update_or_create(
-                            exam_record=exam_record,
-                            exam_question=question,
-                            defaults={
-                                'student_answer': student_answer,
-                                'score': score,
-                                'is_correct': is_correct
-                            }
-                        )
-
-                        InteractionLog.objects.create(
-                            user=student,
-                            question=f"題目: {question.title or question.content[:50]}..., 回答: {student_answer if student_answer is not None else '未作答'}",
-                            response=f"回答 {'正確' if is_correct else '錯誤' if question.correct_option_indices or question.is_correct else '已記錄'}, 得分: {score}/{question.points}",
-                            exam_question=question,
-                            exam_paper=exam_paper,
-                            score=score
-                        )
-
-                    StudentExamHistory.objects.update_or_create(
-                        student=student,
-                        exam_paper=exam_paper,
-                        defaults={
-                            'total_score': total_score,
-                            'completed_at': current_time,
-                            'grade': 'A' if total_score >= 90 else 'B' if total_score >= 80 else 'C'
-                        }
-                    )
-
-                    exam_record.score = total_score
-                    exam_record.save()
+                    exam_record = submit_paper(student, exam_paper, answers, current_time)
+                    total_score = exam_record.score
                     messages.success(request, f"考試 '{exam_paper.title}' 已提交，總分 {total_score} / {exam_paper.total_points} 分！")
                     return redirect('room:exam')
 
@@ -310,20 +210,21 @@ def exam(request):
             request.session.pop('selected_exam_paper_id', None)
     else:
         # 如果沒有選定考卷，顯示所有可用的考卷
-        all_papers = ExamPaper.objects.all().prefetch_related('questions')
         available_papers = [
-            paper for paper in all_papers
-            if paper.publish_time <= current_time and paper.end_time > current_time and
-            not exam_records_dict.get(paper.id, {}).get('is_completed', False)
+            paper for paper in get_active_papers(current_time)
+            if not exam_records_dict.get(paper.id, {}).get('is_completed', False)
         ]
+        prefetch_related_objects(available_papers, 'questions')
 
-    # 計算 AI 提問次數並初始化 session
+    # AI 剩餘次數（所有考卷一次讀取，不寫 session）；額度服務無法連線時照常作答，只是不顯示剩餘次數
+    try:
+        remaining_by_paper = quota.remaining_many(
+            quota.subject_for(request.user.pk), {paper.id: paper.ai_total_limit for paper in available_papers}
+        )
+    except quota.Unavailable:
+        remaining_by_paper = {}
     for paper in available_papers:
-        paper.ai_total_limit = sum(q.ai_limit for q in paper.questions.all())
-        session_key = f'ai_remaining_{paper.id}'
-        if session_key not in request.session:
-            request.session[session_key] = paper.ai_total_limit
-        paper.ai_remaining = request.session[session_key]
+        paper.ai_remaining = remaining_by_paper.get(paper.id)
 
     student_answers = {}
     
@@ -383,14 +284,12 @@ def exam(request):
 def select_exam(request):
     current_time = timezone.now()
 
-    all_papers = ExamPaper.objects.all().prefetch_related('questions')
     exam_records = ExamRecord.objects.filter(student=request.user).values('exam_paper_id', 'is_completed')
     exam_records_dict = {r['exam_paper_id']: {'is_completed': r['is_completed']} for r in exam_records}
 
     available_papers = [
-        p for p in all_papers
-        if p.publish_time <= current_time < p.end_time
-        and not exam_records_dict.get(p.id, {}).get('is_completed', False)
+        p for p in get_active_papers(current_time)
+        if not exam_records_dict.get(p.id, {}).get('is_completed', False)
     ]
 
     if request.method == 'POST':
@@ -563,6 +462,8 @@ def teacher_exam(request):
             try:
                 if question_id:
                     exam_question = get_object_or_404(ExamQuestion, id=question_id, created_by=request.user)
+                    old_key = (exam_question.question_type, exam_question.correct_option_indices,
+                               exam_question.is_correct, exam_question.points)
                     exam_question.title = title
                     exam_question.content = content
                     exam_question.question_type = question_type
@@ -575,6 +476,23 @@ def teacher_exam(request):
                         exam_question.image = image
                     exam_question.save()
                     messages.success(request, f"題目 '{title}' 已成功更新！")
+                    if old_key != (question_type, correct_option_indices, is_correct, points):
+                        # 正解或配分改變：重新判分會覆蓋手動調分，須由教師勾選確認
+                        if request.POST.get('regrade_existing') == '1':
+                            try:
+                                result = regrade_questions([exam_question.id])
+                                if result['changed']:
+                                    messages.info(request, f"已依新正解重新判分 {result['changed']} 筆作答。")
+                            except ImproperlyConfigured as e:
+                                messages.warning(request, f"無法重新判分：{e}，請稍後執行 regrade_paper。")
+                        else:
+                            answered = ExamAnswer.objects.filter(exam_question=exam_question).count()
+                            if answered:
+                                messages.warning(
+                                    request,
+                                    f"正解或配分已變更，{answered} 筆既有作答未重新判分；需要時請勾選「重新判分既有作答」"
+                                    f"或於成績頁按「重新判分」（會覆蓋手動調分）。",
+                                )
                     print(f"Question updated: {exam_question.id}")
                 else:
                     exam_question = ExamQuestion.objects.create(
@@ -590,7 +508,7 @@ def teacher_exam(request):
                         image=image
                     )
                     print(f"Question created: {exam_question.id}")
-                    InteractionLog.objects.create(
+                    log_interaction(
                         user=request.user,
                         question=f"題目: {content}, AI 次數限制: {ai_limit}",
                         response="題目已成功創建",
@@ -619,7 +537,6 @@ def teacher_exam(request):
                     if not valid_questions.exists():
                         messages.error(request, f"所選題目無效。檢查 ID: {question_ids}")
                     else:
-                        total_points = sum(q.points for q in valid_questions)
                         publish_time = timezone.datetime.strptime(
                             request.POST.get('publish_time', timezone.now().strftime('%Y-%m-%dT%H:%M')), 
                             '%Y-%m-%dT%H:%M'
@@ -641,13 +558,13 @@ def teacher_exam(request):
                         else:
                             exam_paper = ExamPaper.objects.create(
                                 title=exam_title,
-                                total_points=total_points,
                                 created_by=request.user,
                                 publish_time=publish_time,
                                 start_time=start_time,
                                 end_time=end_time,
                                 duration_minutes=duration_minutes,
-                                description=request.POST.get('exam_description', '').strip()
+                                description=request.POST.get('exam_description', '').strip(),
+                                ai_answer_cache=bool(request.POST.get('ai_answer_cache')),
                             )
                             exam_paper.questions.set(valid_questions)
                             messages.success(request, f"考卷 '{exam_title}' 已成功創建！")
@@ -681,6 +598,7 @@ def teacher_exam(request):
                     '%Y-%m-%dT%H:%M'
                 ).replace(tzinfo=timezone.get_current_timezone())
                 exam_paper.duration_minutes = int(request.POST.get('duration_minutes', 60))
+                exam_paper.ai_answer_cache = bool(request.POST.get('ai_answer_cache'))
 
                 if exam_paper.start_time > exam_paper.end_time:
                     messages.error(request, "開始時間不能晚於截止時間。")
@@ -691,11 +609,9 @@ def teacher_exam(request):
                         if not valid_questions.exists():
                             messages.error(request, f"所選題目無效。檢查 ID: {question_ids}")
                         else:
-                            exam_paper.total_points = sum(q.points for q in valid_questions)
-                            exam_paper.questions.set(valid_questions)
+                            exam_paper.questions.set(valid_questions)  # total_points 由 signals 重算
                     else:
                         exam_paper.questions.clear()
-                        exam_paper.total_points = 0
 
                     exam_paper.save()
                     messages.success(request, f"考卷 '{exam_title}' 已成功更新！")
@@ -771,99 +687,235 @@ def student_exam_history(request):
         messages.error(request, "您無權限訪問此頁面。")
         return redirect('room:teacher_exam')
 
-    # 獲取所有學生的考試歷史
-    histories = StudentExamHistory.objects.all().order_by('-completed_at')
-    User = get_user_model()  # 獲取 CustomUser 模型
-    detailed_records = []
-
-    for history in histories:
-        exam_record = ExamRecord.objects.filter(
-            student=history.student,
-            exam_paper=history.exam_paper
+    if request.method == 'POST' and 'regrade_paper' in request.POST:
+        paper = ExamPaper.objects.filter(
+            pk=request.POST['regrade_paper'] if request.POST['regrade_paper'].isdigit() else None
         ).first()
-        
-        if exam_record:
-            exam_answers = exam_record.answer_details.all()
-            questions_with_answers = []
-            for answer in exam_answers:
-                question = ExamQuestion.objects.get(id=answer.exam_question.id)
-                questions_with_answers.append({
-                    'question_title': question.title,
-                    'question_content': question.content,
-                    'student_answer': answer.student_answer,
-                    'score': answer.score,
-                    'is_correct': answer.is_correct,
-                    'question_type': question.get_question_type_display(),
-                    'question_id': question.id,
-                    'points': question.points,
-                })
-            # 使用 get_full_name() 獲取學生姓名
-            student_name = history.student.get_full_name() or history.student.username
-            
-            detailed_records.append({
-                'student_id': history.student.student_id,
-                'student_name': student_name,  # 使用 get_full_name() 或 username
-                'exam_title': history.exam_paper.title,
-                'total_score': history.total_score,
-                'completed_at': history.completed_at,
-                'answers': questions_with_answers,
-            })
+        if not paper:
+            messages.error(request, "考卷不存在。")
+        else:
+            try:
+                result = regrade_paper(paper.id)
+                messages.success(request, f"'{paper.title}' 已重新判分：檢查 {result['answers']} 筆，更新 {result['changed']} 筆。")
+            except ImproperlyConfigured as e:
+                messages.error(request, f"重新判分失敗：{e}")
+        return redirect(request.get_full_path())
+
+    if request.method == 'POST' and 'clear_curve' in request.POST:
+        paper = ExamPaper.objects.filter(
+            pk=request.POST['clear_curve'] if request.POST['clear_curve'].isdigit() else None
+        ).first()
+        if not paper:
+            messages.error(request, "考卷不存在。")
+        else:
+            changed = clear_curve(paper.id)
+            messages.success(request, f"'{paper.title}' 已移除曲線，{changed} 筆總分回到各題得分加總。")
+        return redirect(request.get_full_path())
 
     if request.method == 'POST' and 'update_scores' in request.POST:
-        try:
-            student_exam_key = request.POST['update_scores'].split('_')
-            student_id = student_exam_key[0]
-            exam_title = '_'.join(student_exam_key[1:])
-            
-            history = StudentExamHistory.objects.filter(
-                student__student_id=student_id,
-                exam_paper__title=exam_title
-            ).first()
-
-            if not history:
-                messages.error(request, "找不到對應的考試歷史紀錄。")
-                return render(request, 'student_exam_history.html', {'detailed_records': detailed_records})
-
-            exam_record = ExamRecord.objects.filter(
-                student=history.student,
-                exam_paper=history.exam_paper
-            ).first()
-
-            if not exam_record:
-                messages.error(request, "找不到對應的考試紀錄。")
-                return render(request, 'student_exam_history.html', {'detailed_records': detailed_records})
-
-            total_score = 0
-            for answer in exam_record.answer_details.all():
-                new_score = request.POST.get(f'score_{answer.exam_question.id}')
-                if new_score is not None:
-                    try:
-                        new_score = int(new_score)
-                        max_score = answer.exam_question.points
-                        if 0 <= new_score <= max_score:
-                            answer.score = new_score
-                            answer.is_correct = (new_score == max_score)  # 滿分視為正確
-                            answer.save()
-                            total_score += new_score
-                        else:
-                            messages.warning(request, f"題目 ID {answer.exam_question.id} 的調分 {new_score} 超出範圍 (0-{max_score})，未更新。")
-                    except ValueError:
-                        messages.warning(request, f"題目 ID {answer.exam_question.id} 的調分無效，需為數字。")
-
-            # 更新總分
-            history.total_score = total_score
-            history.save()
-            exam_record.score = total_score
-            exam_record.save()
-            messages.success(request, f"已成功更新 {student_id} 的 '{exam_title}' 考試成績，總分為 {total_score}。")
+        history = StudentExamHistory.objects.select_related('student', 'exam_paper').filter(
+            pk=request.POST['update_scores'] if request.POST['update_scores'].isdigit() else None
+        ).first()
+        if not history:
+            messages.error(request, "找不到對應的考試歷史紀錄。")
             return redirect('room:student_exam_history')
 
-        except (ValueError, CustomUser.DoesNotExist, ExamPaper.DoesNotExist) as e:
-            messages.error(request, f"更新分數失敗，無效的學生或考卷：{str(e)}")
-        except Exception as e:
-            messages.error(request, f"更新分數時發生錯誤：{str(e)}")
+        exam_record = ExamRecord.objects.filter(student=history.student, exam_paper=history.exam_paper).first()
+        if not exam_record:
+            messages.error(request, "找不到對應的考試紀錄。")
+            return redirect('room:student_exam_history')
+
+        scores = {}
+        for key, value in request.POST.items():
+            if not key.startswith('score_') or not key[6:].isdigit():
+                continue
+            try:
+                scores[int(key[6:])] = int(value)
+            except ValueError:
+                messages.warning(request, f"題目 ID {key[6:]} 的調分無效，需為數字。")
+
+        total_score, rejected = set_record_scores(exam_record, scores)
+        for question_id in rejected:
+            messages.warning(request, f"題目 ID {question_id} 的調分 {scores[question_id]} 超出範圍，未更新。")
+        messages.success(
+            request,
+            f"已成功更新 {history.student.student_id} 的 '{history.exam_paper.title}' 考試成績，總分為 {total_score}。",
+        )
+        return redirect(request.get_full_path())
+
+    paper_param = request.GET.get('paper', '')
+    filters = {
+        'paper_id': int(paper_param) if paper_param.isdigit() else None,
+        'class_name': request.GET.get('class_name') or None,
+        'student_id': request.GET.get('student') or None,
+    }
+    page, detailed_records = load_gradebook_page(request.GET.get('page'), **filters)
+
+    # 分頁連結需保留篩選條件
+    query = request.GET.copy()
+    query.pop('page', None)
+    papers = list(ExamPaper.objects.order_by('-id').values('id', 'title', 'curve'))
+
+    return render(request, 'student_exam_history.html', {
+        'detailed_records': detailed_records,
+        'page_obj': page,
+        'filters': filters,
+        'curve': next((p['curve'] for p in papers if p['id'] == filters['paper_id']), None),
+        'filter_query': query.urlencode(),
+        'papers': papers,
+        'class_names': CustomUser.objects.exclude(class_name__isnull=True).exclude(class_name='')
+                        .order_by('class_name').values_list('class_name', flat=True).distinct(),
+    })
+
+@login_required
+def export_gradebook(request):
+    """
+    GET /student_exam_history/export/?paper=<id>&since=YYYY-MM-DD&until=YYYY-MM-DD&format=csv|xlsx
+    串流輸出每題得分與總分；不指定 paper 時以 since/until（考卷發佈時間）匯出整個學期。
+    """
+    if not request.user.is_staff:
+        return HttpResponse("您無權限匯出成績。", status=403)
+
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return HttpResponseBadRequest("format 僅支援 csv 或 xlsx")
+    paper_param = request.GET.get('paper', '')
+    try:
+        since = parse_day(request.GET.get('since'))
+        until = parse_day(request.GET.get('until'))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    stream, content_type = EXPORT_FORMATS[fmt]
+    rows = iter_export_rows(
+        paper_id=int(paper_param) if paper_param.isdigit() else None,
+        since=since,
+        until=until,
+    )
+    content = stream(rows)
+    if isinstance(request, ASGIRequest):
+        content = aiter_chunks(content)  # ASGI 下同步 iterator 會被整份讀進記憶體才送出
+    response = StreamingHttpResponse(content, content_type=content_type)
+    filename = f"gradebook_{paper_param or 'term'}_{timezone.localdate():%Y%m%d}.{fmt}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
-    return render(request, 'student_exam_history.html', {'detailed_records': detailed_records})
+@login_required
+@require_POST
+def bulk_adjust_scores(request):
+    """
+    POST /student_exam_history/adjust/（僅限教師）
+    JSON: {"paper_id": int, "action": "override" | "shift" | "curve" | "clear_curve", ...}
+    - override：{"question_id", "score"}  該題全部學生改為 score
+    - shift：{"question_id", "delta"}     該題全部學生加減分（限制在 0 ~ 配分）
+    - curve：{"method": "linear" | "percentile", "params": {...}, "never_lower": true}
+      linear 參數 scale / offset；percentile 參數 floor / ceiling。曲線會保存，之後重算總分時再套用
+    - clear_curve：移除曲線，總分回到各題得分加總
+    回傳: {"status": "success", "updated": 受影響筆數}
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'status': 'error', 'message': '您無權限調整成績'}, status=403)
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JsonResponse({'status': 'error', 'message': '無效的 JSON 數據'}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({'status': 'error', 'message': '無效的 JSON 數據'}, status=400)
+
+    try:
+        paper_id = int(data.get('paper_id'))
+    except (TypeError, ValueError):
+        return JsonResponse({'status': 'error', 'message': '無效的 paper_id'}, status=400)
+    if not ExamPaper.objects.filter(id=paper_id).exists():
+        return JsonResponse({'status': 'error', 'message': '考卷不存在'}, status=404)
+
+    action = data.get('action')
+    try:
+        if action == 'override':
+            updated = override_question(paper_id, int(data['question_id']), int(data['score']))
+        elif action == 'shift':
+            updated = shift_question(paper_id, int(data['question_id']), int(data['delta']))
+        elif action == 'curve':
+            params = {k: float(v) for k, v in (data.get('params') or {}).items()
+                      if k in ('scale', 'offset', 'floor', 'ceiling')}
+            updated = apply_curve(paper_id, data.get('method'), never_lower=bool(data.get('never_lower', True)), **params)
+        elif action == 'clear_curve':
+            updated = clear_curve(paper_id)
+        else:
+            return JsonResponse({'status': 'error', 'message': 'action 僅支援 override、shift、curve 或 clear_curve'},
+                                status=400)
+    except (KeyError, TypeError, ValueError) as e:
+        # RegradeError 為 ValueError 子類別
+        message = str(e) if isinstance(e, RegradeError) else '缺少或無效的參數'
+        return JsonResponse({'status': 'error', 'message': message}, status=400)
+    return JsonResponse({'status': 'success', 'updated': updated})
+
+@login_required
+def profiling_page(request):
+    """
+    /profiling/（僅限教師）：設定取樣比例與路由、產生 X-Profile token、檢視各路由的 profile。
+    ?download=<路由名稱> 下載合併後的 collapsed stacks（flamegraph.pl / speedscope）。
+    """
+    if not request.user.is_staff:
+        messages.error(request, "您無權限訪問此頁面。")
+        return redirect('room:teacher_exam')
+
+    if request.method == 'POST':
+        if 'clear' in request.POST:
+            profiling.clear()
+            messages.success(request, "已清除所有 profile。")
+        else:
+            try:
+                rate = float(request.POST.get('rate') or 0)
+            except ValueError:
+                messages.error(request, "取樣比例需為 0 ~ 1 的數字。")
+                return redirect('room:profiling')
+            control = profiling.set_control(rate, request.POST.getlist('views'))
+            messages.success(request, f"已更新取樣設定：比例 {control['rate']:g}。")
+        return redirect('room:profiling')
+
+    download = request.GET.get('download')
+    if download:
+        response = HttpResponse(profiling.collapsed(download), content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="{download.replace(":", "_")}.folded"'
+        return response
+
+    selected = request.GET.get('view')
+    from .urls import app_name, urlpatterns
+    return render(request, 'profiling.html', {
+        'enabled': profiling.options()['ENABLED'],
+        'control': profiling.get_control(),
+        'route_names': sorted(f'{app_name}:{p.name}' for p in urlpatterns),
+        'profiled_views': [(view, profiling.profiles(view)) for view in profiling.views()],
+        'selected': selected,
+        'selected_profiles': profiling.profiles(selected) if selected else [],
+        'top_frames': profiling.top_frames(selected) if selected else [],
+        'header': profiling.HEADER,
+        'token': profiling.make_token(),
+        'token_max_age': profiling.options()['TOKEN_MAX_AGE'],
+    })
+
+def _is_internal_address(address) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return ip.is_loopback or ip.is_private
+
+def prometheus_metrics(request):
+    """
+    GET /metrics：Prometheus text format（所有 worker 的合計，見 room/metrics.py）。
+    settings.METRICS['TOKEN'] 有設定時需帶 Authorization: Bearer <token>；
+    未設定時只接受內部位址（loopback / 私有網段）的請求。
+    """
+    token = metrics.auth_token()
+    if token:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode()):
+            return HttpResponse("Unauthorized", status=401)
+    elif not _is_internal_address(request.META.get('REMOTE_ADDR', '')):
+        return HttpResponse("Forbidden：未設定 METRICS_TOKEN 時只接受內部位址", status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 def readme(request):
     return render(request, 'readme.html')  # ReadMe 頁
@@ -946,16 +998,29 @@ async def ask_ai(request):
 
     session_key = await ensure_session_and_touch()
 
-    # 呼叫 Gemini（你的 wrapper 內部已處理 Redis 與聯網工具）
-    wrapper = GeminiAPIWrapper(session_key=session_key)
-    answer_text = await wrapper.async_get_response(prompt)
+    # 帶 paper_id 與 question_id 且考卷啟用回覆快取時，同一題的重複提問直接回傳快取
+    cache_scope = None
+    paper_id = request.POST.get('paper_id')
+    if paper_id:
+        try:
+            _, cache_enabled = await sync_to_async(_paper_ai_settings_sync)(int(paper_id))
+            cache_scope = _answer_cache_scope(paper_id, request.POST.get('question_id'), cache_enabled)
+        except (ExamPaper.DoesNotExist, ValueError):
+            pass
 
     # 避免觸發 request.user → 直接從 session 取 user_id
     user_id = await sync_to_async(lambda: request.session.get('_auth_user_id'))()
     user_id = int(user_id) if user_id else None
 
-    # ORM 寫入放到 thread
-    await sync_to_async(InteractionLog.objects.create)(
+    # 呼叫 Gemini（你的 wrapper 內部已處理 Redis 與聯網工具；排程器依學生輪流）
+    wrapper = GeminiAPIWrapper(session_key=session_key, owner=quota.subject_for(user_id, session_key))
+    try:
+        answer_text = await wrapper.async_get_response(prompt, cache_scope=cache_scope)
+    except Busy as busy:
+        return HttpResponse(str(busy), status=503, headers={"Retry-After": str(busy.retry_after)})
+
+    # 交給 logsink（非同步後端只入列，不等 INSERT）
+    await alog_interaction(
         user_id=user_id,
         question=prompt,
         response=answer_text,
@@ -980,7 +1045,7 @@ def upload_question(request):
                 created_by=request.user,
                 image=image
             )
-            InteractionLog.objects.create(
+            log_interaction(
                 user=request.user,
                 question=f"題目: {content}, AI 次數限制: {ai_limit}",
                 response="題目已成功創建",
@@ -997,22 +1062,8 @@ def ask_exam_question(request):
         if question_id:
             try:
                 exam_question = ExamQuestion.objects.get(id=question_id)
-                is_correct = False
-                if exam_question.question_type == 'mcq':
-                    try:
-                        user_options = sorted(map(str, answer)) if isinstance(answer, (list, tuple)) else sorted(answer.split(',')) if answer else []
-                        correct_options = sorted(exam_question.correct_option_indices.split(',')) if exam_question.correct_option_indices else []
-                        is_correct = user_options == correct_options
-                    except:
-                        is_correct = False
-                elif exam_question.question_type == 'tf':
-                    user_bool = str(answer).lower() in ['true', '1', 't', 'yes', 'y', '是', '對', '正確']
-                    is_correct = user_bool == exam_question.is_correct
-                elif exam_question.question_type in ['sa', 'essay']:
-                    is_correct = str(answer).strip().lower() == str(exam_question.correct_option_indices).strip().lower() if exam_question.correct_option_indices else False
-
-                score = exam_question.points if is_correct else 0
-                InteractionLog.objects.create(
+                is_correct, score = compile_question(exam_question).grade(answer)
+                log_interaction(
                     user=request.user,
                     question=f"題目: {exam_question.title}, 回答: {answer}",
                     response=f"回答 {'正確' if is_correct else '錯誤'}, 得分: {score}",
@@ -1041,13 +1092,9 @@ def submit_single_answer(request):
 
             # 獲取相關物件
             exam_paper = get_object_or_404(ExamPaper, id=paper_id)
-            exam_question = get_object_or_404(ExamQuestion, id=question_id)
-            exam_record, created = ExamRecord.objects.get_or_create(
-                student=request.user,
-                exam_paper=exam_paper,
-                defaults={'score': 0, 'is_completed': False}
-            )
-
+            grader = get_paper_graders(exam_paper).get(int(question_id))
+            if grader is None:
+                raise ExamQuestion.DoesNotExist
             # 處理 answer，可能為 None、空字符串或空列表
             if answer is None:
                 student_answer = None
@@ -1058,63 +1105,12 @@ def submit_single_answer(request):
             else:
                 student_answer = answer
 
-            # 判斷答案是否正確
-            is_correct = False
-            if exam_question.question_type == 'sc':
-                try:
-                    user_option = int(student_answer) if student_answer is not None and student_answer != "" else None
-                    correct_option = int(exam_question.correct_option_indices) if exam_question.correct_option_indices else None
-                    is_correct = user_option == correct_option
-                except (ValueError, TypeError):
-                    is_correct = False
-            elif exam_question.question_type == 'mcq':
-                try:
-                    user_options = sorted(map(str, student_answer)) if isinstance(student_answer, list) else sorted(student_answer.split(',')) if student_answer else []
-                    correct_options = sorted(exam_question.correct_option_indices.split(',')) if exam_question.correct_option_indices else []
-                    is_correct = user_options == correct_options
-                except:
-                    is_correct = False
-            elif exam_question.question_type == 'tf':
-                user_bool = str(student_answer).lower() in ['true', '1', 't', 'yes', 'y', '是', '對', '正確'] if student_answer else None
-                is_correct = user_bool == exam_question.is_correct
-            elif exam_question.question_type in ['sa', 'essay']:
-                is_correct = str(student_answer).strip().lower() == str(exam_question.correct_option_indices).strip().lower() if student_answer and exam_question.correct_option_indices else False
-
-            # 儲存或更新答題紀錄
-            exam_answer, created = ExamAnswer.objects.update_or_create(
-                exam_record=exam_record,
-                exam_question=exam_question,
-                defaults={
-                    'student_answer': student_answer,
-                    'score': exam_question.points if is_correct else 0,
-                    'is_correct': is_correct,
-                    'answered_at': timezone.now()
-                }
+            # 判分、儲存答題紀錄並以增量更新總分與 StudentExamHistory
+            exam_record, is_correct, score = save_single_answer(
+                request.user, exam_paper, grader, student_answer, timezone.now()
             )
 
-            # 更新總分
-            total_score = ExamAnswer.objects.filter(exam_record=exam_record).aggregate(total=Sum('score'))['total'] or 0
-            exam_record.score = total_score
-            exam_record.save()
-
-            # 記錄互動
-            InteractionLog.objects.create(
-                user=request.user,
-                question=f"題目: {exam_question.title or exam_question.content[:50]}..., 回答: {student_answer if student_answer is not None else '未作答'}",
-                response=f"回答 {'正確' if is_correct else '錯誤' if exam_question.correct_option_indices or exam_question.is_correct else '已記錄'}, 得分: {exam_answer.score}/{exam_question.points}",
-                exam_question=exam_question,
-                exam_paper=exam_paper,
-                score=exam_answer.score
-            )
-
-            # 更新 StudentExamHistory
-            StudentExamHistory.objects.update_or_create(
-                student=request.user,
-                exam_paper=exam_paper,
-                defaults={'total_score': total_score, 'completed_at': timezone.now()}
-            )
-
-            return JsonResponse({'status': 'success', 'message': '答案提交成功', 'score': exam_answer.score})
+            return JsonResponse({'status': 'success', 'message': '答案提交成功', 'score': score})
         except ExamPaper.DoesNotExist:
             return JsonResponse({'status': 'error', 'message': '考卷不存在'}, status=404)
         except ExamQuestion.DoesNotExist:
@@ -1125,6 +1121,43 @@ def submit_single_answer(request):
             return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
     return JsonResponse({'status': 'error', 'message': '僅接受 POST 請求'}, status=405)
 
+@login_required
+@require_POST
+def submit_answers_batch(request):
+    """
+    POST /exam/answers/batch/
+    JSON: {"paper_id": int, "answers": [{"question_id": int, "answer": ..., "client_seq": int}, ...]}
+    回傳: {"status": "success", "results": [{"question_id", "client_seq", "status", "score", "is_correct"}, ...]}
+    """
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JsonResponse({'status': 'error', 'message': '無效的 JSON 數據'}, status=400)
+
+    paper_id = data.get('paper_id')
+    items = data.get('answers')
+    if not paper_id or not isinstance(items, list):
+        return JsonResponse({'status': 'error', 'message': '缺少必要參數（考卷 ID 或答案列表）'}, status=400)
+    if len(items) > MAX_BATCH_ANSWERS:
+        return JsonResponse({'status': 'error', 'message': f'單次最多儲存 {MAX_BATCH_ANSWERS} 題'}, status=400)
+    if not all(isinstance(item, dict) for item in items):
+        return JsonResponse({'status': 'error', 'message': '答案格式錯誤'}, status=400)
+
+    try:
+        exam_paper = ExamPaper.objects.get(id=paper_id)
+    except (ExamPaper.DoesNotExist, ValueError, TypeError):
+        return JsonResponse({'status': 'error', 'message': '考卷不存在'}, status=404)
+
+    current_time = timezone.now()
+    if current_time < exam_paper.start_time or current_time > exam_paper.end_time:
+        return JsonResponse({'status': 'error', 'message': '考試時間已過或尚未開始'}, status=403)
+
+    try:
+        results = save_answers_batch(request.user, exam_paper, items, current_time)
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': f'保存答案失敗: {str(e)}'}, status=500)
+    return JsonResponse({'status': 'success', 'results': results})
+
 def logout(request):
     auth_logout(request)  # 執行登出
     return redirect('room:home')
@@ -1134,35 +1167,43 @@ def _session_touch(session):
     session["last_seen"] = timezone.now().isoformat()
     session.save()
 
-def _sum_ai_limit_sync(paper_id: int) -> int:
-    """同步函式：計算一張考卷的 AI 總額度（各題 ai_limit 加總）。"""
-    paper = ExamPaper.objects.get(id=paper_id)
-    return sum(q.ai_limit for q in paper.questions.all())
+def _paper_ai_settings_sync(paper_id: int):
+    """同步函式：一次讀出考卷的 AI 總額度（各題 ai_limit 加總）與是否啟用回覆快取。"""
+    return ExamPaper.objects.values_list('ai_total_limit', 'ai_answer_cache').get(id=paper_id)
 
-def _consume_once_sync(session, paper_id: int):
-    """
-    同步函式：從 session 扣 1 次。
-    - 首次使用先初始化 total。
-    - 回傳 (ok:boolean, remaining:int)。
-    """
-    key = f"ai_remaining_{paper_id}"
-    remaining = session.get(key)
-    if remaining is None:
-        total = _sum_ai_limit_sync(paper_id)
-        session[key] = total
-        remaining = total
-    if remaining <= 0:
-        return False, 0
-    session[key] = remaining - 1
-    session.modified = True
-    return True, remaining - 1
-
-def _rollback_once_sync(session, paper_id: int):
-    """同步函式：AI 失敗時把剛扣的 1 次加回去。"""
-    key = f"ai_remaining_{paper_id}"
-    if key in session:
-        session[key] = int(session[key]) + 1
-        session.modified = True
+def _answer_cache_scope(paper_id, question_id, enabled):
+    """考卷啟用回覆快取且帶有效的 question_id 時回傳 answer_cache 分桶，否則 None（不查也不存）。"""
+    if not enabled:
+        return None
+    try:
+        return answer_cache.scope_for(paper_id, question_id)
+    except (ValueError, TypeError):
+        return None
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _ai_sse_events(wrapper, prompt, cache_scope, *, user_id, paper_id, subject, limit, remaining):
+    """ai_webhook 的串流模式：逐段送出模型輸出，結束後記錄互動並送出剩餘次數。"""
+    parts = []
+    try:
+        async for chunk in wrapper.async_stream_response(prompt, cache_scope=cache_scope):
+            parts.append(chunk)
+            yield _sse("chunk", {"data": chunk})
+    except Exception as ai_err:
+        if subject is not None:
+            remaining = await sync_to_async(quota.try_refund)(subject, paper_id, limit)
+        message = str(ai_err) if isinstance(ai_err, Busy) else f"AI 服務錯誤：{ai_err}"
+        yield _sse("error", {"message": message, "remaining": remaining})
+        return
+
+    await alog_interaction(
+        user_id=user_id,
+        question=prompt,
+        response="".join(parts),
+        exam_paper_id=paper_id,
+    )
+    yield _sse("done", {"remaining": remaining})
 
 @csrf_exempt
 @require_POST
@@ -1172,11 +1213,17 @@ async def ai_webhook(request):
     JSON:
       - 必填:  prompt: str
       - 可選:  paper_id: int（考場情境就帶，會執行扣次並回 remaining）
+      - 可選:  question_id: int（考卷啟用回覆快取時，以題目分桶比對重複提問；未帶則不使用快取）
       - 可選:  session_key: str（外部來源自帶 session）
     回傳:
       - 一般: {"response": "..."}
       - 考場: {"response": "...", "remaining": <int>}
       - 用盡: {"response": "已達 AI 提問上限！", "remaining": 0}  (HTTP 429)
+      - 忙碌: {"error": "...", "remaining": <int 或 null>}  (HTTP 503 + Retry-After；排隊已滿或上游限流，額度已回補)
+      - 額度服務（Redis）無法連線: {"error": "...", "remaining": null}  (HTTP 503；不呼叫模型)
+    串流（Accept: text/event-stream）:
+      - text/event-stream，依序為 chunk 事件（{"data": "..."}）與最後的 done（{"remaining": ...}）
+        或 error（{"message": "...", "remaining": ...}）；額度扣除 / 回補與 JSON 模式相同
     """
     # 1) 解析 JSON
     try:
@@ -1201,39 +1248,56 @@ async def ai_webhook(request):
 
     session_key = await ensure_session_and_touch()
 
-    # 3) 若有 paper_id → 先檢查考卷存在並先扣 1 次
+    # 3) 取得 user_id（避免在 async context 直接觸 ORM 或 request.user）
+    if incoming_session_key:
+        user_id = None
+    else:
+        user_id = await sync_to_async(lambda: request.session.get("_auth_user_id"))()
+        user_id = int(user_id) if user_id else None
+
+    # 4) 若有 paper_id → 先檢查考卷存在並先扣 1 次（額度服務一次往返，不寫 session）
     remaining = None
-    did_decrement = False
+    subject = limit = cache_scope = None
     if paper_id is not None:
         try:
-            # 確認考卷存在
-            await sync_to_async(ExamPaper.objects.get)(id=paper_id)
-        except ExamPaper.DoesNotExist:
+            paper_id = int(paper_id)
+            limit, cache_enabled = await sync_to_async(_paper_ai_settings_sync)(paper_id)
+        except (ExamPaper.DoesNotExist, ValueError, TypeError):
             return JsonResponse({"error": "考卷不存在"}, status=404)
+        cache_scope = _answer_cache_scope(paper_id, payload.get("question_id"), cache_enabled)
 
-        ok, remaining = await sync_to_async(_consume_once_sync)(request.session, int(paper_id))
+        subject = quota.subject_for(user_id, session_key)
+        try:
+            ok, remaining = await sync_to_async(quota.consume)(subject, paper_id, limit)
+        except quota.Unavailable:
+            return JsonResponse({"error": "AI 額度服務暫時無法使用，請稍後再試", "remaining": None}, status=503)
         if not ok:
             return JsonResponse({"response": "已達 AI 提問上限！", "remaining": 0}, status=429)
-        did_decrement = True
 
-    # 4) 呼叫 Gemini（失敗就回補額度）
+    # 5) 呼叫 Gemini（失敗就回補額度；排程器依學生輪流，忙碌 / 上游限流時回 503）
+    wrapper = GeminiAPIWrapper(session_key=session_key, owner=quota.subject_for(user_id, session_key))
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        events = _ai_sse_events(
+            wrapper, prompt, cache_scope,
+            user_id=user_id, paper_id=paper_id, subject=subject, limit=limit, remaining=remaining,
+        )
+        response = StreamingHttpResponse(events, content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"   # 讓 nginx 等反向代理不要緩衝整段回應
+        return response
+
     try:
-        wrapper = GeminiAPIWrapper(session_key=session_key)
-        answer_text = await wrapper.async_get_response(prompt)
+        answer_text = await wrapper.async_get_response(prompt, cache_scope=cache_scope)
     except Exception as ai_err:
-        if did_decrement and paper_id is not None:
-            await sync_to_async(_rollback_once_sync)(request.session, int(paper_id))
+        if subject is not None:
+            remaining = await sync_to_async(quota.try_refund)(subject, paper_id, limit)
+        if isinstance(ai_err, Busy):
+            return JsonResponse({"error": str(ai_err), "remaining": remaining}, status=503,
+                                headers={"Retry-After": str(ai_err.retry_after)})
         return JsonResponse({"error": f"AI 服務錯誤：{ai_err}"}, status=500)
 
-    # 5) 取得 user_id（避免在 async context 直接觸 ORM 或 request.user）
-    if incoming_session_key:
-        user_id = None
-    else:
-        user_id = await sync_to_async(lambda: request.session.get("_auth_user_id"))()
-        user_id = int(user_id) if user_id else None
-
     # 6) 記錄互動
-    await sync_to_async(InteractionLog.objects.create)(
+    await alog_interaction(
         user_id=user_id,
         question=prompt,
         response=answer_text,